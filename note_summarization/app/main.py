@@ -6,23 +6,28 @@
 import os
 from pydantic import BaseModel
 
-# Imports needed for MemoryCache setup
+# Imports needed for LLM cache setup
 from langchain.globals import set_llm_cache
-from langchain_community.cache import InMemoryCache
+from core.llm_cache import create_llm_cache
 
 # Imports from custom libraries
 from core.config import ROOT_DIR, Config, setup_openai_api_key
 
 from core.summarizer import Summarizer
+from core.sql_cache import SQLQueryCache
+from core.summary_cache import SummaryCache
 #from core.json_schemas import  patient_templates
-from core.template_library import patient_templates, prompt_templates, sql_templates, output_schemas
-from  core.ns_utils import initialize_database, delete_database, generate_patient_summary
+from core.template_library import patient_templates
+from core.prewarm import LiveTraffic, PrewarmJob, load_schedule, parse_schedule, select_due_visits
+from  core.ns_utils import initialize_database, delete_database, sync_parquet, agenerate_patient_summary, agenerate_patient_summaries, astream_patient_summary, get_backend_options, get_template_registry
 
 # Imports for FastAPI
 import yaml
+import json
+import asyncio
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, Query, Body
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, Request, Query, Body, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from datetime import datetime
 
@@ -61,6 +66,16 @@ class NoteSummarizerFastAPI(FastAPI):
         self.version = self.config["app"]["version"]
         self.db_path = ROOT_DIR / self.config["database"]["path"]
         self.data_dir = ROOT_DIR / self.config["database"]["data_dir"]
+        # Serving backend of the Summarizer (sqlite or duckdb)
+        self.backend_options = get_backend_options(self.config["database"])
+        # Templates are validated and populated once, invalid references fail at startup
+        self.template_registry = get_template_registry(self.config)
+        missing_output_templates = sorted({
+            template["output_template"] for template in self.template_registry.values()
+            if not os.path.exists(os.path.join(BASE_DIR, "templates", template["output_template"] + ".html"))
+        })
+        if missing_output_templates:
+            raise ValueError(f"Output templates {missing_output_templates} not found.")
 
         # Load OpenAI API key from .env file
         setup_openai_api_key()
@@ -99,17 +114,56 @@ class NoteSummarizerFastAPI(FastAPI):
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     try:
-        # Set up the cache
-        set_llm_cache(InMemoryCache())
+        # Set up the LLM response cache
+        app.state.llm_cache = create_llm_cache(app.config.get("llm_cache", {}))
+        set_llm_cache(app.state.llm_cache)
         
         # Initialize the database
         if not os.path.exists(app.db_path):
-            initialize_database(db_path=app.db_path, data_dir=app.data_dir)
+            initialize_database(db_path=app.db_path, data_dir=app.data_dir, parquet_dir=app.backend_options.get("parquet_dir"), **app.config.get("ingest", {}))
+        elif app.backend_options.get("parquet_dir") is not None:
+            # The Parquet files of the duckdb backend may be missing or older than the existing database
+            sync_parquet(app.db_path, app.backend_options["parquet_dir"])
            
+        # Set up the persistent cache of generated SQL queries
+        sql_cache_config = app.config.get("sql_cache", {})
+        app.state.sql_cache = None
+        if sql_cache_config.get("enabled", False):
+            app.state.sql_cache = SQLQueryCache(ROOT_DIR / sql_cache_config.get("path", "db/sql_cache.db"))
+
+        # Set up the persistent cache of generated summaries
+        summary_cache_config = app.config.get("summary_cache", {})
+        app.state.summary_cache = None
+        if summary_cache_config.get("enabled", False):
+            app.state.summary_cache = SummaryCache(str(ROOT_DIR / summary_cache_config.get("path", "db/summary_cache.db")))
+            _prune_summary_cache(app)
+
         # Initialize the Summarizer
-        app.state.note_summarizer = Summarizer(db_path=app.db_path)
+        # The connection pool and the SQLite thread pool are sized by database.pool_size
+        pool_size = app.config.get("database", {}).get("pool_size", 5)
+        patient_cache_size = app.config.get("database", {}).get("patient_cache_size", 1024)
+        result_encoding = app.config.get("summarization", {}).get("result_encoding", "csv")
+        app.state.note_summarizer = Summarizer(db_path=app.db_path, pool_size=pool_size, sql_cache=app.state.sql_cache,
+                                               summary_cache=app.state.summary_cache, patient_cache_size=patient_cache_size,
+                                               result_encoding=result_encoding, **app.backend_options)
+        app.state.note_summarizer.metrics.track_cache("llm", app.state.llm_cache)
+        app.state.note_summarizer.compile_output_schemas(template["output_schema"] for template in app.template_registry.values())
         logging.info("Summarizer initialized successfully.")
 
+        # Limit the number of summaries generated concurrently by this worker process
+        max_concurrent_summaries = app.config.get("serving", {}).get("max_concurrent_summaries", 32)
+        app.state.summary_semaphore = asyncio.Semaphore(max_concurrent_summaries)
+
+        # Pre-warming of the summary cache from the appointment schedule, yielding to live requests
+        prewarm_config = app.config.get("prewarm", {})
+        app.state.live_traffic = LiveTraffic()
+        app.state.prewarm_job = PrewarmJob(app.state.note_summarizer, {}, max_per_minute=prewarm_config.get("max_per_minute", 30),
+                                           is_busy=lambda: app.state.live_traffic.active > 0)
+        app.state.prewarm_tasks = set()
+        app.state.prewarm_run = None
+        if prewarm_config.get("enabled", False):
+            _start_prewarm_task(app, _scheduled_prewarm(app))
+
         yield
 
     except Exception as e:
@@ -117,12 +171,62 @@ async def lifespan(app: FastAPI):
 
     finally:
         # Delete the database and clean up resources
+        for task in list(getattr(app.state, "prewarm_tasks", [])):
+            task.cancel()
         if hasattr(app.state, "note_summarizer"):
             app.state.note_summarizer.dispose()
             logging.info("note_summarizer cleaned up.")
+        if getattr(app.state, "sql_cache", None) is not None:
+            app.state.sql_cache.close()
+        if getattr(app.state, "summary_cache", None) is not None:
+            app.state.summary_cache.close()
+        if hasattr(getattr(app.state, "llm_cache", None), "close"):
+            app.state.llm_cache.close()
         if app.config.get("database", {}).get("delete_db", False):
             delete_database(app.db_path)
         logging.info("Closing FastAPI app.")
+
+def _prune_summary_cache(app: FastAPI) -> None:
+    """Delete the summary cache entries over the configured bounds, e.g. of patients no longer in the data."""
+    summary_cache_config = app.config.get("summary_cache", {})
+    deleted = app.state.summary_cache.prune(max_entries=summary_cache_config.get("max_entries"), ttl_seconds=summary_cache_config.get("ttl_seconds"))
+    logging.info(f"Summary cache pruned: {deleted} entries deleted.")
+
+def _start_prewarm_task(app: FastAPI, coroutine) -> asyncio.Task:
+    """Run a pre-warm coroutine in the background. The task is cancelled when the app stops."""
+    task = asyncio.create_task(coroutine)
+    app.state.prewarm_tasks.add(task)
+    task.add_done_callback(app.state.prewarm_tasks.discard)
+    return task
+
+def _start_prewarm_run(app: FastAPI, visits: list[dict]) -> asyncio.Task | None:
+    """Start pre-warming the summaries of the configured templates for the visits in the background.
+    Runs are not overlapped: returns None, without starting a run, while a run is in progress.
+    """
+    if app.state.prewarm_run is not None and not app.state.prewarm_run.done():
+        return None
+    template_names = app.config.get("prewarm", {}).get("templates") or list(patient_templates.keys())
+    app.state.prewarm_job.templates = {template_name: _populate_template(template_name) for template_name in template_names}
+    app.state.prewarm_run = _start_prewarm_task(app, app.state.prewarm_job.run(visits))
+    return app.state.prewarm_run
+
+async def _scheduled_prewarm(app: FastAPI) -> None:
+    """Pre-warm the visits of the configured schedule in the horizon, every interval_minutes."""
+    prewarm_config = app.config.get("prewarm", {})
+    schedule_path = ROOT_DIR / prewarm_config.get("schedule", "data/schedule.csv")
+    while True:
+        try:
+            visits = select_due_visits(load_schedule(schedule_path), prewarm_config.get("horizon_hours", 24))
+            prewarm_run = _start_prewarm_run(app, visits)
+            if prewarm_run is None:
+                logging.info("Scheduled pre-warm run skipped, a run is already in progress.")
+            else:
+                await prewarm_run
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Error pre-warming the schedule '{schedule_path}': {e}")
+        await asyncio.sleep(prewarm_config.get("interval_minutes", 60) * 60)
     
   
 # Initialize the FastAPI app with lifespan
@@ -139,9 +243,48 @@ def read_root():
     return {"message": f"Welcome to {app.title}!"}
 
 @app.get("/ingest")
-def ingest_database():
+def ingest_database(full_refresh: bool = Query(False, description="Re-import every CSV file instead of only new and changed files")):
     """Endpoint to initialize the database."""
-    return initialize_database(db_path=app.db_path, data_dir=app.data_dir)
+    response = initialize_database(db_path=app.db_path, data_dir=app.data_dir, full_refresh=full_refresh,
+                                   parquet_dir=app.backend_options.get("parquet_dir"), **app.config.get("ingest", {}))
+    if hasattr(app.state, "note_summarizer"):
+        app.state.note_summarizer.refresh_schema()
+    if getattr(app.state, "summary_cache", None) is not None:
+        _prune_summary_cache(app)
+    return response
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Endpoint to expose the pipeline metrics of this worker process in the Prometheus text format."""
+    if not hasattr(app.state, "note_summarizer"):
+        return PlainTextResponse("", media_type="text/plain; version=0.0.4")
+    return PlainTextResponse(app.state.note_summarizer.metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/prewarm")
+def get_prewarm_status():
+    """Endpoint to retrieve the status of the last pre-warm run."""
+    if not hasattr(app.state, "prewarm_job"):
+        return {"state": "unavailable"}
+    return app.state.prewarm_job.status
+
+@app.post("/prewarm", status_code=status.HTTP_202_ACCEPTED)
+async def start_prewarm(
+        visits: list[dict] | None = Body(None, description="Visits to pre-warm (first_name, last_name, optional patient_id, visit_time). Defaults to the configured schedule"),
+        horizon_hours: float = Query(None, description="Only pre-warm the visits of the next horizon_hours hours. Defaults to prewarm.horizon_hours")
+    ):
+    """Endpoint to pre-warm the summary cache for scheduled visits in the background.
+    Returns the scheduled visits and summaries, or 409 while a pre-warm run is in progress.
+    """
+    prewarm_config = app.config.get("prewarm", {})
+    try:
+        schedule = parse_schedule(visits) if visits is not None else load_schedule(ROOT_DIR / prewarm_config.get("schedule", "data/schedule.csv"))
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    due_visits = select_due_visits(schedule, horizon_hours if horizon_hours is not None else prewarm_config.get("horizon_hours", 24))
+    if _start_prewarm_run(app, due_visits) is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A pre-warm run is already in progress.")
+    jobs = len(due_visits) * len(app.state.prewarm_job.templates)
+    return {"message": f"Pre-warming {jobs} summaries of {len(due_visits)} scheduled visits.", "visits": len(due_visits), "jobs": jobs}
 
 @app.get("/templates")
 def get_templates():
@@ -193,9 +336,10 @@ async def answer_question(
         logging.error(f"Template '{template_name}' does not exist.")
         return _generate_response(data, response, response_type)
     
-    template = _populate_tempalate(patient_templates[template_name])
+    template = _populate_template(template_name)
     try:
-        response = generate_patient_summary(app.state.note_summarizer, patient_info=patient_info, template=template)
+        async with app.state.live_traffic, app.state.summary_semaphore:
+            response = await agenerate_patient_summary(app.state.note_summarizer, patient_info=patient_info, template=template)
         logging.info(f"Summary generated successfully for template: {template_name}")
     except Exception as e:
         response = {"error": str(e)}
@@ -205,23 +349,108 @@ async def answer_question(
     # Render only the output section of the template
     return _generate_response(data, response, response_type, template["output_template"])
 
-def _populate_tempalate(template:dict)-> dict:
-    """Format the template to be used to answer the question. Specificalliy, it will replace the prompt, sql_templates and output_schema with the actual templates:
-    {
-        "prompt",
-        "sql_prompts": [],
-        "output_schema",
-        "output_template"
-    }    
-    """   
-    populated_template = template.copy()
-    populated_template["prompt"] = prompt_templates[template["prompt"]]
-    populated_template["output_schema"] = output_schemas[template["output_schema"]]
-    sql_prompts = template.get("sql_prompts", [])
-    populated_template["sql_prompts"] = []
-    for sql_prompt in sql_prompts:
-        populated_template["sql_prompts"].append(sql_templates[sql_prompt])
-    return populated_template
+@app.post("/answer/stream")
+async def answer_question_stream(
+        request_body: RequestBody = Body(..., description="Request body containing patient info and template name")
+    ):
+    """Generate a patient summary, streaming the pipeline progress as Server-Sent Events.
+    The last event is either "result" with the summary and its rendered html, or "error".
+    """
+    data = request_body.model_dump()
+    logging.info(f"Stream request received: {data}")
+
+    patient_info = data.get("patient_info", {})
+    template_name = data.get("template_name", "")
+
+    async def event_stream():
+        # Validate patient_info fields
+        if not patient_info.get("first_name") or not patient_info.get("last_name"):
+            logging.error("Invalid patient_info: Missing first_name or last_name.")
+            yield _format_sse("error", {"error": "Invalid patient_info: Missing first_name or last_name."})
+            return
+
+        # Check if the template exists
+        if template_name not in patient_templates:
+            logging.error(f"Template '{template_name}' does not exist.")
+            yield _format_sse("error", {"error": f"Template '{template_name}' does not exist."})
+            return
+
+        template = _populate_template(template_name)
+        try:
+            async with app.state.live_traffic, app.state.summary_semaphore:
+                async for event, event_data in astream_patient_summary(app.state.note_summarizer, patient_info=patient_info, template=template):
+                    if event == "summary":
+                        html = templates.env.get_template(template["output_template"] + ".html").render(request=data, response=event_data)
+                        yield _format_sse("result", {"summary": event_data, "html": html})
+                    else:
+                        yield _format_sse(event, event_data)
+            logging.info(f"Summary streamed successfully for template: {template_name}")
+        except Exception as e:
+            logging.error(f"Error generating summary for patient {patient_info}: {e}")
+            yield _format_sse("error", {"error": str(e)})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def _format_sse(event: str, data: dict) -> str:
+    """Format a Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+class BatchRequestBody(BaseModel):
+    patient_info: dict
+    template_names: list[str]
+
+@app.post("/answer/batch")
+async def answer_batch(
+        request_body: BatchRequestBody = Body(..., description="Request body containing patient info and a list of template names"),
+        response_type: str = Query("html", description="Response type: 'html' or 'json'")
+    ):
+    """Generate summaries for several templates of the same patient. Data shared by the templates is retrieved once."""
+
+    data = request_body.model_dump()
+    logging.info(f"Batch request received: {data}")
+
+    patient_info = data.get("patient_info", {})
+    template_names = list(dict.fromkeys(data.get("template_names", [])))
+
+    # Validate patient_info fields
+    if not patient_info.get("first_name") or not patient_info.get("last_name"):
+        response = {"error": "Invalid patient_info: Missing first_name or last_name."}
+        logging.error("Invalid patient_info: Missing first_name or last_name.")
+        return _generate_response(data, response, response_type)
+
+    # Check if the templates exist
+    missing_templates = [template_name for template_name in template_names if template_name not in patient_templates]
+    if not template_names or missing_templates:
+        response = {"error": f"Templates {missing_templates} do not exist." if missing_templates else "No templates requested."}
+        logging.error(response["error"])
+        return _generate_response(data, response, response_type)
+
+    populated_templates = {
+        template_name: _populate_template(template_name)
+        for template_name in template_names
+    }
+    try:
+        async with app.state.live_traffic, app.state.summary_semaphore:
+            sections = await agenerate_patient_summaries(app.state.note_summarizer, patient_info=patient_info, templates=populated_templates)
+        logging.info(f"Batch summary generated for templates: {template_names}")
+    except Exception as e:
+        response = {"error": str(e)}
+        logging.error(f"Error generating batch summary for patient {patient_info}: {e}")
+        return _generate_response(data, response, response_type)
+
+    if response_type == "html":
+        # Render every section with its own output template, failed sections with the default one
+        html_sections = []
+        for template_name in template_names:
+            section = sections[template_name]
+            output_template = "default_output_template" if "error" in section else populated_templates[template_name]["output_template"]
+            html_sections.append(templates.env.get_template(output_template + ".html").render(request=data, response=section))
+        return HTMLResponse(content="".join(html_sections))
+    return JSONResponse(content={"sections": sections})
+
+def _populate_template(template_name: str) -> dict:
+    """Return the template populated at startup with the retrieval engine and token budget configured for it."""
+    return app.template_registry[template_name]
 
 def _generate_response(request: Request, response: dict, response_type: str, output_template: str = None):
     """Helper function to generate the appropriate response based on response_type."""
@@ -0,0 +1,288 @@
+# %% [markdown]
+# This script pre-generates note summaries for a cohort of patients.
+# The script:
+# 1. Creates the SQLite db file (if it does not exist yet) and ingests sample patient data from .csv files.
+# 2. Selects the cohort either from a list of patient names or from a SQL filter over the patients table.
+# 3. Runs every patient x template job on a bounded thread or process pool.
+# 4. Writes the results incrementally to a JSONL or SQLite result store. Jobs that already completed are skipped when the script is re-run.
+#
+# Usage (from the note_summarization directory):
+#   python -m cli.batch --patients "Lupe126 Rippin620" --templates medications allergies
+#   python -m cli.batch --where "deathdate IS NULL" --workers 8 --output output/summaries.db
+
+
+# %%
+# Import required libraries
+import os
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import multiprocessing.util
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# Imports needed for LLM cache setup
+from langchain.globals import set_llm_cache
+from core.llm_cache import create_llm_cache
+
+# Imports from custom libraries
+from core.config import ROOT_DIR, Config, setup_openai_api_key
+from core.summarizer import Summarizer
+from core.sql_cache import SQLQueryCache
+from core.summary_cache import SummaryCache
+from core.ns_utils import initialize_database, sync_parquet, generate_patient_summary, get_backend_options, get_template_registry
+from core.template_library import patient_templates
+
+# Define constants
+CONFIG_PATH = ROOT_DIR / "config/config.dev.yml"
+
+# Summarizer used by the jobs of the current worker process
+_worker_summarizer = None
+
+
+class JsonlResultStore:
+    """Append-only JSONL result store. One line per finished job."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def completed_jobs(self) -> set[tuple[str, str]]:
+        """Return the (patient_id, template_id) pairs that completed successfully."""
+        completed = set()
+        if not os.path.exists(self.path):
+            return completed
+        with open(self.path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A partially written last line after a crash
+                    continue
+                if record.get("status") == "ok":
+                    completed.add((record["patient_id"], record["template_id"]))
+        return completed
+
+    def write(self, record: dict) -> None:
+        with open(self.path, "a") as file:
+            file.write(json.dumps(record) + "\n")
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteResultStore:
+    """SQLite result store. The latest result of every job is kept."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS summaries (
+                patient_id TEXT,
+                template_id TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                status TEXT,
+                result TEXT,
+                elapsed_s REAL,
+                completed_at TEXT,
+                PRIMARY KEY (patient_id, template_id)
+            )"""
+        )
+        self._conn.commit()
+
+    def completed_jobs(self) -> set[tuple[str, str]]:
+        """Return the (patient_id, template_id) pairs that completed successfully."""
+        rows = self._conn.execute("SELECT patient_id, template_id FROM summaries WHERE status = 'ok'").fetchall()
+        return set(rows)
+
+    def write(self, record: dict) -> None:
+        result = record["summary"] if record["status"] == "ok" else record["error"]
+        self._conn.execute(
+            "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (record["patient_id"], record["template_id"], record["first_name"], record["last_name"],
+             record["status"], json.dumps(result), record["elapsed_s"], record["completed_at"]),
+        )
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def open_result_store(path: str):
+    """Open the result store based on the file extension (.jsonl or .db/.sqlite)."""
+    output_dir = os.path.dirname(path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    if path.endswith((".db", ".sqlite")):
+        return SQLiteResultStore(path)
+    return JsonlResultStore(path)
+
+
+def select_cohort(db_path: str, patients: list[str] = None, where: str = None) -> list[tuple[str, str, str]]:
+    """Return (id, first, last) of the cohort patients, from a list of "First Last" names or a SQL filter over patients.
+    where is trusted raw SQL from the operator running the script, it is inserted in the query as is.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        if patients:
+            cohort = []
+            for patient in patients:
+                first_name, _, last_name = patient.strip().partition(" ")
+                rows = conn.execute("SELECT id, first, last FROM patients WHERE first = ? AND last = ?", (first_name, last_name.strip())).fetchall()
+                if not rows:
+                    logging.warning(f"Patient '{patient}' not found.")
+                cohort.extend(rows)
+            return cohort
+        query = "SELECT id, first, last FROM patients"
+        if where:
+            query += f" WHERE {where}"
+        return conn.execute(query + " ORDER BY last, first").fetchall()
+    finally:
+        conn.close()
+
+
+def _init_worker(db_path: str, sql_cache_path: str | None, llm_cache_config: dict, summary_cache_path: str | None = None, result_encoding: str = "csv", backend_options: dict = None) -> None:
+    """Create the Summarizer of a worker process."""
+    global _worker_summarizer
+    setup_openai_api_key()
+    set_llm_cache(create_llm_cache(llm_cache_config))
+    sql_cache = SQLQueryCache(sql_cache_path) if sql_cache_path else None
+    summary_cache = SummaryCache(summary_cache_path) if summary_cache_path else None
+    _worker_summarizer = Summarizer(db_path=db_path, sql_cache=sql_cache, summary_cache=summary_cache, result_encoding=result_encoding,
+                                    **(backend_options or {}))
+    # Run when the worker process exits, pool workers do not run atexit handlers
+    multiprocessing.util.Finalize(None, _dispose_worker, exitpriority=10)
+
+
+def _dispose_worker() -> None:
+    """Dispose the Summarizer of the current worker and close its caches."""
+    global _worker_summarizer
+    if _worker_summarizer is None:
+        return
+    _worker_summarizer.dispose()
+    if _worker_summarizer.sql_cache is not None:
+        _worker_summarizer.sql_cache.close()
+    if _worker_summarizer.summary_cache is not None:
+        _worker_summarizer.summary_cache.close()
+    _worker_summarizer = None
+
+
+def _run_job(job: dict) -> dict:
+    """Generate the summary of a single patient x template job."""
+    start_time = time.perf_counter()
+    record = {
+        "patient_id": job["patient_id"],
+        "first_name": job["patient_info"]["first_name"],
+        "last_name": job["patient_info"]["last_name"],
+        "template_id": job["template_id"],
+    }
+    try:
+        record["summary"] = generate_patient_summary(_worker_summarizer, patient_info=job["patient_info"], template=job["template"])
+        record["status"] = "ok"
+    except Exception as e:
+        record["error"] = str(e)
+        record["status"] = "error"
+    record["elapsed_s"] = round(time.perf_counter() - start_time, 3)
+    record["completed_at"] = datetime.now(timezone.utc).isoformat()
+    return record
+
+
+def run_batch(jobs: list[dict], result_store, workers: int, executor_type: str, db_path: str, sql_cache_path: str | None, llm_cache_config: dict = None, summary_cache_path: str | None = None, result_encoding: str = "csv", backend_options: dict = None) -> dict:
+    """Run the jobs on a bounded worker pool and write every result to the store as soon as it is available."""
+    global _worker_summarizer
+    if executor_type == "process":
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(db_path, sql_cache_path, llm_cache_config or {}, summary_cache_path, result_encoding, backend_options))
+    else:
+        # Threads share a single Summarizer, its connection pool is sized to the number of workers
+        sql_cache = SQLQueryCache(sql_cache_path) if sql_cache_path else None
+        summary_cache = SummaryCache(summary_cache_path) if summary_cache_path else None
+        _worker_summarizer = Summarizer(db_path=db_path, pool_size=workers, sql_cache=sql_cache, summary_cache=summary_cache, result_encoding=result_encoding,
+                                        **(backend_options or {}))
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+    counts = {"ok": 0, "error": 0}
+
+    def collect(futures) -> None:
+        for future in futures:
+            record = future.result()
+            result_store.write(record)
+            counts[record["status"]] += 1
+            print(f"[{record['status']}] {record['first_name']} {record['last_name']} / {record['template_id']} ({record['elapsed_s']}s)")
+
+    pending = set()
+    try:
+        with executor:
+            # Keep at most 2 x workers jobs in flight so that large cohorts are not queued up front
+            for job in jobs:
+                pending.add(executor.submit(_run_job, job))
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            collect(wait(pending).done)
+    finally:
+        _dispose_worker()
+    return counts
+
+
+def parse_args() -> argparse.Namespace:
+    batch_config = Config.get().get("batch", {})
+    parser = argparse.ArgumentParser(description="Pre-generate note summaries for a cohort of patients.")
+    cohort = parser.add_mutually_exclusive_group()
+    cohort.add_argument("--patients", nargs="+", help='Patient names in "First Last" format.')
+    cohort.add_argument("--where", help="SQL filter over the patients table, e.g. \"deathdate IS NULL\". Trusted raw SQL, inserted in the query as is.")
+    parser.add_argument("--templates", nargs="+", default=list(patient_templates.keys()), choices=list(patient_templates.keys()), help="Templates to generate. Defaults to all templates.")
+    parser.add_argument("--workers", type=int, default=batch_config.get("workers", 4), help="Number of concurrent jobs.")
+    parser.add_argument("--executor", choices=["thread", "process"], default=batch_config.get("executor", "thread"), help="Worker pool type.")
+    parser.add_argument("--output", default=batch_config.get("output", "output/summaries.jsonl"), help="Result store, .jsonl or .db file.")
+    parser.add_argument("--rebuild-db", action="store_true", help="Re-ingest the CSV files before running the batch.")
+    return parser.parse_args()
+
+
+# Main execution
+if __name__ == "__main__":
+    Config.from_config_file(CONFIG_PATH)
+    config = Config.get()
+    args = parse_args()
+
+    db_path = str(ROOT_DIR / config["database"]["path"])
+    data_dir = ROOT_DIR / config["database"]["data_dir"]
+    sql_cache_config = config.get("sql_cache", {})
+    sql_cache_path = str(ROOT_DIR / sql_cache_config.get("path", "db/sql_cache.db")) if sql_cache_config.get("enabled", False) else None
+    summary_cache_config = config.get("summary_cache", {})
+    summary_cache_path = str(ROOT_DIR / summary_cache_config.get("path", "db/summary_cache.db")) if summary_cache_config.get("enabled", False) else None
+
+    # The database is only (re)built when needed, it is not deleted at the end of the run
+    backend_options = get_backend_options(config["database"])
+    if args.rebuild_db or not os.path.exists(db_path):
+        initialize_database(db_path=db_path, data_dir=data_dir, parquet_dir=backend_options.get("parquet_dir"), **config.get("ingest", {}))
+        print("Database initialized successfully.")
+    elif backend_options.get("parquet_dir") is not None:
+        sync_parquet(db_path, backend_options["parquet_dir"])
+
+    setup_openai_api_key()
+    set_llm_cache(create_llm_cache(config.get("llm_cache", {})))
+
+    # Build the patient x template jobs, skipping the ones already completed in a previous run
+    result_store = open_result_store(str(ROOT_DIR / args.output))
+    completed_jobs = result_store.completed_jobs()
+    template_registry = get_template_registry(config)
+    templates = {template_id: template_registry[template_id] for template_id in args.templates}
+    cohort = select_cohort(db_path, patients=args.patients, where=args.where)
+    jobs = [
+        # The patient id is resolved already, patients sharing a name get their own summaries
+        {"patient_id": patient_id, "patient_info": {"first_name": first_name, "last_name": last_name, "patient_id": patient_id}, "template_id": template_id, "template": template}
+        for patient_id, first_name, last_name in cohort
+        for template_id, template in templates.items()
+        if (patient_id, template_id) not in completed_jobs
+    ]
+    print(f"{len(cohort)} patients, {len(templates)} templates: {len(jobs)} jobs to run, {len(cohort) * len(templates) - len(jobs)} already completed.")
+
+    start_time = time.perf_counter()
+    counts = run_batch(jobs, result_store, workers=args.workers, executor_type=args.executor, db_path=db_path, sql_cache_path=sql_cache_path, llm_cache_config=config.get("llm_cache", {}),
+                       summary_cache_path=summary_cache_path, result_encoding=config.get("summarization", {}).get("result_encoding", "csv"),
+                       backend_options=backend_options)
+    result_store.close()
+    print(f"Finished in {time.perf_counter() - start_time:.1f}s: {counts['ok']} succeeded, {counts['error']} failed.")
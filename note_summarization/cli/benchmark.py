@@ -0,0 +1,224 @@
+# %% [markdown]
+# This script benchmarks the summary pipeline offline, without OpenAI calls.
+# The Summarizer uses a deterministic fake chat model (core/fake_llm.py) returning the library SQL query of every
+# SQL prompt and schema-valid summaries after a configurable latency. The script:
+# 1. Ingests the CSV files into a fresh database and times initialize_database.
+# 2. Times each pipeline stage separately: get_table_info, generate_sql_query, execute_query, format_data
+#    (the configured result encoder) and get_summary_from_openai.
+# 3. Times the full generate_patient_summary of every template, with the SQL and summary caches disabled.
+# 4. Writes the results as JSON, and optionally compares them with the results of another commit.
+#
+# Usage (from the note_summarization directory):
+#   python -m cli.benchmark --output output/benchmark.json
+#   python -m cli.benchmark --patients 10 --repeat 5 --llm-latency 0.05 --compare output/benchmark_main.json
+
+
+# %%
+# Import required libraries
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import statistics
+import subprocess
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+# Imports from custom libraries
+from core.config import ROOT_DIR, Config
+from core.fake_llm import FakeChatModel
+from core.summarizer import Summarizer
+from core.ns_utils import initialize_database, generate_patient_summary, get_template_registry, get_patient_context, summary_prompts
+from core.template_library import patient_templates, sql_queries, sql_templates, sql_template_tables
+from cli.batch import select_cohort
+
+# Define constants
+CONFIG_PATH = ROOT_DIR / "config/config.dev.yml"
+# Template whose prompt and output schema are used by the get_summary_from_openai stage
+STAGE_TEMPLATE = "visit_priorities"
+
+# Prompt prefixes of the SQL templates, e.g. "Retrieve all medications associated with the patient "
+_SQL_PROMPT_PREFIXES = {sql_prompt_id: template.split("{patient_details}")[0] for sql_prompt_id, template in sql_templates.items()}
+_PATIENT_ID = re.compile(r"patient id exactly '([^']+)'")
+
+
+def library_sql_responder(prompt: str) -> str | None:
+    """Answer a SQL generation prompt with the library query of its SQL template, bound to the patient id of the prompt."""
+    patient_id = _PATIENT_ID.search(prompt)
+    for sql_prompt_id, prefix in _SQL_PROMPT_PREFIXES.items():
+        if prefix in prompt and sql_prompt_id in sql_queries and patient_id:
+            # Literal patient id, as generated by the LLM. The Summarizer parameterizes it before caching.
+            return sql_queries[sql_prompt_id].replace(":patient_id", f"'{patient_id.group(1)}'")
+    return None
+
+
+def measure(function: Callable[[], Any], repeat: int) -> dict[str, Any]:
+    """Call the function repeat times and return the statistics of the durations in milliseconds."""
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - start_time) * 1000)
+    return _summarize(durations)
+
+
+def _summarize(durations: list[float]) -> dict[str, Any]:
+    durations = sorted(durations)
+    return {
+        "n": len(durations),
+        "mean_ms": round(statistics.fmean(durations), 3),
+        "median_ms": round(statistics.median(durations), 3),
+        "p95_ms": round(durations[min(len(durations) - 1, int(0.95 * len(durations)))], 3),
+        "min_ms": round(durations[0], 3),
+        "total_ms": round(sum(durations), 3),
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(db_path: str, data_dir: str, patients: int, repeat: int, llm_latency: float, templates: list[str], config: dict[str, Any]) -> dict[str, Any]:
+    """Run the stage and template benchmarks. Returns the JSON results."""
+    results = {"stages": {}, "templates": {}, "errors": {}}
+    stages = results["stages"]
+
+    # Ingestion into a fresh database, then a second run where every file is unchanged
+    start_time = time.perf_counter()
+    initialize_database(db_path=db_path, data_dir=data_dir, **config.get("ingest", {}))
+    stages["initialize_database"] = _summarize([(time.perf_counter() - start_time) * 1000])
+    stages["initialize_database_unchanged"] = measure(lambda: initialize_database(db_path=db_path, data_dir=data_dir, **config.get("ingest", {})), repeat)
+
+    llm = FakeChatModel(latency_s=llm_latency, sql_responder=library_sql_responder)
+    summarizer = Summarizer(db_path=db_path, pool_size=config["database"].get("pool_size", 5), llm=llm,
+                            result_encoding=config.get("summarization", {}).get("result_encoding", "csv"),
+                            connection_options=config["database"].get("connection"))
+    template_registry = get_template_registry(config)
+    summarizer.compile_output_schemas(template["output_schema"] for template in template_registry.values())
+    try:
+        cohort = select_cohort(db_path)[:patients]
+        sql_prompt_ids = [sql_prompt_id for sql_prompt_id in sql_templates if sql_prompt_id in sql_queries]
+
+        def table_info() -> None:
+            summarizer.db_chain.reset_table_info()
+            for sql_prompt_id in sql_prompt_ids:
+                summarizer.db_chain.get_table_info(sql_template_tables.get(sql_prompt_id))
+        stages["get_table_info"] = measure(table_info, repeat)
+
+        # Per patient x SQL template stages
+        stage_template = template_registry[STAGE_TEMPLATE]
+        generate_durations, execute_durations, format_durations, summary_durations = [], [], [], []
+        for patient_id, first_name, last_name in cohort:
+            patient_details, patient_header, parameters = get_patient_context({"first_name": first_name, "last_name": last_name}, patient_id)
+            for sql_prompt_id in sql_prompt_ids:
+                prompt = sql_templates[sql_prompt_id].format(patient_details=patient_details)
+                for _ in range(repeat):
+                    start_time = time.perf_counter()
+                    summarizer.generate_sql_query(prompt, sql_template_tables.get(sql_prompt_id))
+                    generate_durations.append((time.perf_counter() - start_time) * 1000)
+
+                    # Rows are encoded with the configured result encoder as they are fetched, like in the pipeline
+                    timings = {}
+                    try:
+                        data, _ = summarizer.execute_query_formatted(sql_queries[sql_prompt_id], parameters, timings=timings)
+                    except Exception as e:
+                        # e.g. observations were not ingested
+                        results["errors"][sql_prompt_id] = str(e).splitlines()[0]
+                        break
+                    execute_durations.append(timings["execute_s"] * 1000)
+                    format_durations.append(timings["format_s"] * 1000)
+
+                    start_time = time.perf_counter()
+                    summarizer.get_summary_from_openai(*summary_prompts(stage_template["prompt"], patient_header, data), stage_template["output_schema"], template_id=STAGE_TEMPLATE)
+                    summary_durations.append((time.perf_counter() - start_time) * 1000)
+        stages["generate_sql_query"] = _summarize(generate_durations)
+        stages["execute_query"] = _summarize(execute_durations)
+        stages["format_data"] = _summarize(format_durations)
+        stages["get_summary_from_openai"] = _summarize(summary_durations)
+
+        # Full pipeline per template
+        for template_name in templates:
+            template = template_registry[template_name]
+            durations = []
+            for patient_id, first_name, last_name in cohort:
+                patient_info = {"first_name": first_name, "last_name": last_name}
+                for _ in range(repeat):
+                    start_time = time.perf_counter()
+                    try:
+                        generate_patient_summary(summarizer, patient_info=patient_info, template=template)
+                    except Exception as e:
+                        results["errors"][template_name] = str(e).splitlines()[0]
+                        break
+                    durations.append((time.perf_counter() - start_time) * 1000)
+            if durations:
+                results["templates"][template_name] = _summarize(durations)
+    finally:
+        summarizer.dispose()
+    return results
+
+
+def compare_results(results: dict[str, Any], baseline: dict[str, Any]) -> None:
+    """Print the median durations of the results next to the baseline results."""
+    print(f"{'benchmark':<40}{'baseline ms':>14}{'current ms':>14}{'change':>10}")
+    for section in ("stages", "templates"):
+        for name, current in results[section].items():
+            previous = baseline.get(section, {}).get(name)
+            if previous is None:
+                print(f"{name:<40}{'-':>14}{current['median_ms']:>14.3f}{'new':>10}")
+                continue
+            change = f"{(current['median_ms'] / previous['median_ms'] - 1) * 100:+.1f}%" if previous["median_ms"] else "-"
+            print(f"{name:<40}{previous['median_ms']:>14.3f}{current['median_ms']:>14.3f}{change:>10}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the summary pipeline offline with a fake LLM.")
+    parser.add_argument("--patients", type=int, default=5, help="Number of patients.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of every measurement.")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Latency of every fake LLM call, in seconds.")
+    parser.add_argument("--templates", nargs="+", default=list(patient_templates.keys()), choices=list(patient_templates.keys()), help="Templates benchmarked end to end. Defaults to all templates.")
+    parser.add_argument("--output", default="output/benchmark.json", help="JSON results file.")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with.")
+    return parser.parse_args()
+
+
+# Main execution
+if __name__ == "__main__":
+    Config.from_config_file(CONFIG_PATH)
+    config = Config.get()
+    args = parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="ns-benchmark-")
+    try:
+        results = run_benchmark(os.path.join(work_dir, "healthcare_data.db"), str(ROOT_DIR / config["database"]["data_dir"]),
+                                args.patients, args.repeat, args.llm_latency, args.templates, config)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    results = {
+        "commit": _git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "parameters": {"patients": args.patients, "repeat": args.repeat, "llm_latency": args.llm_latency},
+        **results,
+    }
+
+    output_path = ROOT_DIR / args.output
+    os.makedirs(output_path.parent, exist_ok=True)
+    with open(output_path, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {output_path}")
+    # Runs that failed are left out of the timings, e.g. patients without medications
+    for name, error in results["errors"].items():
+        print(f"Last error of {name}: {error}")
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            compare_results(results, json.load(file))
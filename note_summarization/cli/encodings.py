@@ -0,0 +1,88 @@
+# %% [markdown]
+# This script compares the prompt size of the query result encodings (core/result_encoders.py).
+# The script runs the prepared library queries of the selected templates for the selected patients and prints
+# the number of prompt tokens of every result in every encoding, and the totals.
+#
+# Usage (from the note_summarization directory):
+#   python -m cli.encodings --patients "Lupe126 Rippin620" --templates visit_priorities critical_changes
+#   python -m cli.encodings --limit 20
+
+
+# %%
+# Import required libraries
+import os
+import sqlite3
+import argparse
+
+# Imports from custom libraries
+from core.config import ROOT_DIR, Config
+from core.result_encoders import RESULT_ENCODERS, count_encoding_tokens
+from core.template_library import patient_templates, sql_queries
+from cli.batch import select_cohort
+
+# Define constants
+CONFIG_PATH = ROOT_DIR / "config/config.dev.yml"
+
+
+def measure_encodings(db_path: str, patient_ids: list[str], sql_prompt_ids: list[str], model_name: str = "gpt-4o") -> dict[str, dict[str, int]]:
+    """Return the number of prompt tokens per encoding of every library query, summed over the patients."""
+    totals = {sql_prompt_id: dict.fromkeys(RESULT_ENCODERS, 0) for sql_prompt_id in sql_prompt_ids}
+    conn = sqlite3.connect(db_path)
+    try:
+        for patient_id in patient_ids:
+            for sql_prompt_id in list(totals):
+                try:
+                    cursor = conn.execute(sql_queries[sql_prompt_id], {"patient_id": patient_id})
+                except sqlite3.OperationalError as e:
+                    # e.g. observations were not ingested
+                    print(f"Skipping {sql_prompt_id}: {e}")
+                    totals.pop(sql_prompt_id, None)
+                    continue
+                columns = [description[0] for description in cursor.description]
+                rows = cursor.fetchall()
+                if not rows:
+                    continue
+                for name, tokens in count_encoding_tokens(columns, rows, model_name).items():
+                    totals[sql_prompt_id][name] += tokens
+    finally:
+        conn.close()
+    return totals
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare the prompt tokens of the query result encodings.")
+    cohort = parser.add_mutually_exclusive_group()
+    cohort.add_argument("--patients", nargs="+", help='Patient names in "First Last" format.')
+    cohort.add_argument("--where", help="SQL filter over the patients table, e.g. \"deathdate IS NULL\".")
+    parser.add_argument("--limit", type=int, default=10, help="Maximum number of patients when no patient names are given.")
+    parser.add_argument("--templates", nargs="+", default=list(patient_templates.keys()), choices=list(patient_templates.keys()), help="Templates whose queries are measured. Defaults to all templates.")
+    return parser.parse_args()
+
+
+# Main execution
+if __name__ == "__main__":
+    Config.from_config_file(CONFIG_PATH)
+    config = Config.get()
+    args = parse_args()
+
+    db_path = str(ROOT_DIR / config["database"]["path"])
+    if not os.path.exists(db_path):
+        raise SystemExit(f"Database '{db_path}' not found, ingest the data first.")
+
+    cohort = select_cohort(db_path, patients=args.patients, where=args.where)
+    if not args.patients:
+        cohort = cohort[:args.limit]
+    sql_prompt_ids = sorted({
+        sql_prompt for template_name in args.templates for sql_prompt in patient_templates[template_name].get("sql_prompts", [])
+        if sql_prompt in sql_queries
+    })
+    totals = measure_encodings(db_path, [patient_id for patient_id, _, _ in cohort], sql_prompt_ids)
+
+    print(f"Prompt tokens for {len(cohort)} patients")
+    print(f"{'query':<22}" + "".join(f"{name:>12}" for name in RESULT_ENCODERS))
+    for sql_prompt_id, tokens in totals.items():
+        print(f"{sql_prompt_id:<22}" + "".join(f"{tokens[name]:>12}" for name in RESULT_ENCODERS))
+    overall = {name: sum(tokens[name] for tokens in totals.values()) for name in RESULT_ENCODERS}
+    print(f"{'total':<22}" + "".join(f"{overall[name]:>12}" for name in RESULT_ENCODERS))
+    if overall["plain"]:
+        print(f"{'vs plain':<22}" + "".join(f"{(overall[name] / overall['plain'] - 1) * 100:>11.0f}%" for name in RESULT_ENCODERS))
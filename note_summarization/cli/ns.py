@@ -14,25 +14,30 @@
 
 # Import required libraries
 import json
+import asyncio
 
 # Set up logging if needed
 # Uncomment the following lines to enable logging
 # import logging
 # logging.basicConfig(level=logging.INFO, format="%(message)s")
 
-# Imports needed for MemoryCache setup
+# Imports needed for LLM cache setup
 from langchain.globals import set_llm_cache
-from langchain_community.cache import InMemoryCache
+from core.llm_cache import create_llm_cache
 
 # Imports from custom libraries
-from core.config import ROOT_DIR, setup_openai_api_key
+from core.config import ROOT_DIR, Config, setup_openai_api_key
 from core.summarizer import Summarizer
-from core.ns_utils import initialize_database, delete_database, generate_patient_summary
-from core.json_schemas import patient_templates
+from core.sql_cache import SQLQueryCache
+from core.summary_cache import SummaryCache
+from core.ns_utils import initialize_database, delete_database, generate_patient_summary, agenerate_patient_summaries, get_template_registry
 
 # Define constants
+CONFIG_PATH = ROOT_DIR / "config/config.dev.yml"  # Configuration of the LLM cache, retrieval engines, token budgets and result encoding
 DATA_DIR = ROOT_DIR / "data"  # Directory with your CSVs
 DB_PATH = ROOT_DIR / "db/healthcare_data.db"  # Path to your SQLite database
+SQL_CACHE_PATH = ROOT_DIR / "db/sql_cache.db"  # Path to the persistent cache of generated SQL queries
+SUMMARY_CACHE_PATH = ROOT_DIR / "db/summary_cache.db"  # Path to the persistent cache of generated summaries
 OUTPUT_DIR = ROOT_DIR / "output"  # Directory for output files
 
 
@@ -48,15 +53,34 @@ def generate_note_summarization(note_summarizer, patient_info, template_id, temp
     except Exception as e:
         print(f"Error processing template {template["name"]}: {e}\n")
 
+def generate_note_summarizations(note_summarizer, patient_info, templates):
+    """Generate summaries for several templates of a patient in one batch. Shared data is retrieved only once."""
+    print(f"Processing templates: {', '.join(template['name'] for template in templates.values())}")
+    note_summaries = asyncio.run(agenerate_patient_summaries(note_summarizer, patient_info=patient_info, templates=templates))
+    for template_id, note_summary in note_summaries.items():
+        if "error" in note_summary:
+            print(f"Error processing template {templates[template_id]['name']}: {note_summary['error']}\n")
+            continue
+        ns_filename = OUTPUT_DIR / f"note_summary_{template_id}_{patient_info['first_name']}_{patient_info['last_name']}.json"
+        with open(ns_filename, "w") as file:
+            json.dump(note_summary, file, indent=4)
+        print(f"Summary saved to {ns_filename}\n")
+
 # Main execution
 if __name__ == "__main__":
     # Initialize the database
     initialize_database(db_path=DB_PATH, data_dir=DATA_DIR)
     print("Database initialized successfully.")
 
-    # Set up OpenAI API key and cache
+    # Set up OpenAI API key and cache, with the limits of the llm_cache section of the configuration
     setup_openai_api_key()
-    set_llm_cache(InMemoryCache())
+    Config.from_config_file(CONFIG_PATH)
+    config = Config.get()
+    llm_cache = create_llm_cache(config.get("llm_cache", {}))
+    set_llm_cache(llm_cache)
+
+    # Templates populated with the configured retrieval engines and token budgets, as served by the API
+    patient_templates = get_template_registry(config)
 
     # Ensure output directory exists
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
@@ -71,17 +95,26 @@ if __name__ == "__main__":
     template_id = None
 
     patient_info = {"first_name": first_name, "last_name": last_name}
-    note_summarizer = Summarizer(db_path=DB_PATH)
+    sql_cache = SQLQueryCache(SQL_CACHE_PATH)
+    summary_cache = SummaryCache(str(SUMMARY_CACHE_PATH))
+    result_encoding = config.get("summarization", {}).get("result_encoding", "csv")
+    note_summarizer = Summarizer(db_path=DB_PATH, sql_cache=sql_cache, summary_cache=summary_cache, result_encoding=result_encoding)
+    note_summarizer.compile_output_schemas(template["output_schema"] for template in patient_templates.values())
 
     if template_id:
         generate_note_summarization(note_summarizer, patient_info, template_id, patient_templates[template_id])
     else:    
-        # Generate summaries for all templates
-        for key, template in patient_templates.items():
-            generate_note_summarization(note_summarizer, patient_info, key, template)
+        # Generate summaries for all templates in one batch
+        generate_note_summarizations(note_summarizer, patient_info, patient_templates)
 
     # Close the database connection
     note_summarizer.dispose()     
+    sql_cache.close()
+    print(f"Summary cache: {summary_cache.hits} hits, {summary_cache.misses} misses")
+    summary_cache.close()
+    if hasattr(llm_cache, "stats"):
+        print(f"LLM cache: {llm_cache.stats()}")
+        llm_cache.close()
 
     # Delete the database
     delete_database(db_path=DB_PATH)
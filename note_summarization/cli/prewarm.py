@@ -0,0 +1,80 @@
+# %% [markdown]
+# This script pre-warms the summary cache for the upcoming visits of an appointment schedule.
+# The script:
+# 1. Loads the schedule (.csv or .json with first_name, last_name, optional patient_id and visit_time of every visit).
+# 2. Selects the visits of the next horizon_hours hours, earliest visit first.
+# 3. Generates the configured templates of every visit into the summary cache, at most max_per_minute summaries per minute.
+# The app shares the summary cache, so opening the patients in clinic is a cache hit. Within the app, use the
+# prewarm config section or POST /prewarm instead: there pre-warming also yields to live requests.
+#
+# Usage (from the note_summarization directory):
+#   python -m cli.prewarm --schedule data/schedule.csv
+#   python -m cli.prewarm --schedule schedule.json --horizon-hours 12 --max-per-minute 10 --templates medications
+
+
+# %%
+# Import required libraries
+import time
+import asyncio
+import argparse
+
+# Imports needed for LLM cache setup
+from langchain.globals import set_llm_cache
+from core.llm_cache import create_llm_cache
+
+# Imports from custom libraries
+from core.config import ROOT_DIR, Config, setup_openai_api_key
+from core.summarizer import Summarizer
+from core.sql_cache import SQLQueryCache
+from core.summary_cache import SummaryCache
+from core.prewarm import PrewarmJob, load_schedule, select_due_visits
+from core.ns_utils import get_backend_options, get_template_registry
+from core.template_library import patient_templates
+
+# Define constants
+CONFIG_PATH = ROOT_DIR / "config/config.dev.yml"
+
+
+def parse_args() -> argparse.Namespace:
+    prewarm_config = Config.get().get("prewarm", {})
+    parser = argparse.ArgumentParser(description="Pre-warm the summary cache for the upcoming visits of an appointment schedule.")
+    parser.add_argument("--schedule", default=prewarm_config.get("schedule", "data/schedule.csv"), help="Schedule file, .csv or .json.")
+    parser.add_argument("--templates", nargs="+", default=prewarm_config.get("templates") or list(patient_templates.keys()), choices=list(patient_templates.keys()), help="Templates to pre-warm.")
+    parser.add_argument("--horizon-hours", type=float, default=prewarm_config.get("horizon_hours", 24), help="Pre-warm the visits of the next hours.")
+    parser.add_argument("--max-per-minute", type=float, default=prewarm_config.get("max_per_minute", 30), help="Maximum number of summaries per minute.")
+    return parser.parse_args()
+
+
+# Main execution
+if __name__ == "__main__":
+    Config.from_config_file(CONFIG_PATH)
+    config = Config.get()
+    args = parse_args()
+
+    summary_cache_config = config.get("summary_cache", {})
+    if not summary_cache_config.get("enabled", False):
+        raise SystemExit("The summary cache is disabled (summary_cache.enabled), there is nothing to pre-warm.")
+    sql_cache_config = config.get("sql_cache", {})
+
+    visits = select_due_visits(load_schedule(ROOT_DIR / args.schedule), args.horizon_hours)
+    template_registry = get_template_registry(config)
+    templates = {template_id: template_registry[template_id] for template_id in args.templates}
+    print(f"{len(visits)} visits in the next {args.horizon_hours:g} hours, {len(visits) * len(templates)} summaries to pre-warm.")
+
+    setup_openai_api_key()
+    set_llm_cache(create_llm_cache(config.get("llm_cache", {})))
+    sql_cache = SQLQueryCache(ROOT_DIR / sql_cache_config.get("path", "db/sql_cache.db")) if sql_cache_config.get("enabled", False) else None
+    summary_cache = SummaryCache(str(ROOT_DIR / summary_cache_config.get("path", "db/summary_cache.db")))
+    note_summarizer = Summarizer(db_path=str(ROOT_DIR / config["database"]["path"]), sql_cache=sql_cache, summary_cache=summary_cache,
+                                 result_encoding=config.get("summarization", {}).get("result_encoding", "csv"),
+                                 **get_backend_options(config["database"]))
+    note_summarizer.compile_output_schemas(template["output_schema"] for template in templates.values())
+    start_time = time.perf_counter()
+    try:
+        status = asyncio.run(PrewarmJob(note_summarizer, templates, max_per_minute=args.max_per_minute).run(visits))
+    finally:
+        note_summarizer.dispose()
+        if sql_cache is not None:
+            sql_cache.close()
+        summary_cache.close()
+    print(f"Finished in {time.perf_counter() - start_time:.1f}s: {status['ok']} summaries pre-warmed, {status['error']} failed.")
@@ -0,0 +1,222 @@
+# %% [markdown]
+# This script generates a larger synthetic dataset from the sample CSV files, for ingest and query load testing.
+# The script:
+# 1. Generates the observations.csv and claims_transactions.csv files missing from the sample data, from the
+#    encounters and claims of the sample patients (deterministic vital signs, lab results and claim transactions).
+# 2. Writes factor copies of every patient and of all their records. The ids of every copy are remapped consistently
+#    across the files (patients, encounters, claims, conditions, medications, ...), so foreign keys stay valid.
+#    Organizations, providers and payers are shared by all copies and written once.
+#    Copy 0 is the sample data itself, the patients of the other copies get the copy number appended to their last name.
+# Files are streamed row by row, memory does not grow with the factor.
+#
+# Usage (from the note_summarization directory):
+#   python -m cli.scale_data --factor 100 --output data_x100
+# Then point database.data_dir of config/config.dev.yml to the output directory and ingest.
+
+
+# %%
+# Import required libraries
+import os
+import re
+import csv
+import time
+import random
+import argparse
+import hashlib
+from typing import Iterable, Iterator
+
+# Imports from custom libraries
+from core.config import ROOT_DIR, Config
+from core.ingest import CSV_FILES
+
+# Define constants
+CONFIG_PATH = ROOT_DIR / "config/config.dev.yml"
+
+# Files of the entities shared by all the patients, they are not copied
+REFERENCE_FILES = ["organizations.csv", "providers.csv", "payers.csv"]
+UUID_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+# Rows sampled to find the id columns of a file
+_SAMPLE_ROWS = 1000
+
+OBSERVATIONS_HEADER = ["date", "patient", "encounter", "category", "code", "description", "value", "units", "type"]
+# (category, LOINC code, description, units, low, high, decimals) of the generated observations
+VITAL_SIGNS = [
+    ("vital-signs", "8302-2", "Body Height", "cm", 150, 190, 1),
+    ("vital-signs", "29463-7", "Body Weight", "kg", 50, 110, 1),
+    ("vital-signs", "8480-6", "Systolic Blood Pressure", "mm[Hg]", 100, 150, 0),
+    ("vital-signs", "8462-4", "Diastolic Blood Pressure", "mm[Hg]", 60, 95, 0),
+    ("vital-signs", "8867-4", "Heart rate", "/min", 55, 100, 0),
+]
+LAB_RESULTS = [
+    ("laboratory", "2339-0", "Glucose [Mass/volume] in Blood", "mg/dL", 70, 130, 1),
+    ("laboratory", "38483-4", "Creatinine [Mass/volume] in Blood", "mg/dL", 0.6, 1.3, 2),
+    ("laboratory", "2093-3", "Cholesterol [Mass/volume] in Serum or Plasma", "mg/dL", 150, 260, 1),
+    ("laboratory", "4548-4", "Hemoglobin A1c/Hemoglobin.total in Blood", "%", 4.8, 7.5, 1),
+]
+# Encounter classes with vital signs, wellness visits also get lab results
+OBSERVED_ENCOUNTER_CLASSES = {"wellness", "ambulatory", "outpatient", "urgentcare"}
+
+CLAIMS_TRANSACTIONS_HEADER = [
+    "id", "claimid", "chargeid", "patientid", "type", "amount", "method", "fromdate", "todate", "placeofservice",
+    "procedurecode", "modifier1", "modifier2", "diagnosisref1", "diagnosisref2", "diagnosisref3", "diagnosisref4",
+    "units", "departmentid", "notes", "unitamount", "transferoutid", "transfertype", "payments", "adjustments",
+    "transfers", "outstanding", "appointmentid", "linenote", "patientinsuranceid", "feescheduleid", "providerid",
+    "supervisingproviderid",
+]
+
+
+def _read_rows(file_path: str) -> Iterator[dict[str, str]]:
+    with open(file_path, "r", newline="", encoding="utf-8") as file:
+        yield from csv.DictReader(file)
+
+
+def _make_id(*parts: str) -> str:
+    """Deterministic UUID-formatted id."""
+    digest = hashlib.md5(":".join(parts).encode("utf-8")).hexdigest()
+    return f"{digest[:8]}-{digest[8:12]}-{digest[12:16]}-{digest[16:20]}-{digest[20:32]}"
+
+
+def generate_observations(encounters: Iterable[dict[str, str]]) -> Iterator[list[str]]:
+    """Generate vital signs for the observed encounters and lab results for the wellness encounters."""
+    for encounter in encounters:
+        if encounter["encounterclass"] not in OBSERVED_ENCOUNTER_CLASSES:
+            continue
+        # Values only depend on the encounter, so the output does not depend on the order of the files
+        rng = random.Random(encounter["id"])
+        observations = VITAL_SIGNS + (LAB_RESULTS if encounter["encounterclass"] == "wellness" else [])
+        for category, code, description, units, low, high, decimals in observations:
+            value = round(rng.uniform(low, high), decimals)
+            yield [encounter["start"], encounter["patient"], encounter["id"], category, code, description,
+                   str(int(value)) if decimals == 0 else str(value), units, "numeric"]
+
+
+def generate_claims_transactions(claims: Iterable[dict[str, str]], encounters: dict[str, dict[str, str]]) -> Iterator[list[str]]:
+    """Generate a charge and a payment transaction per claim, priced from the encounter of the claim."""
+    for claim in claims:
+        encounter = encounters.get(claim["appointmentid"])
+        if encounter is None:
+            continue
+        amount = float(encounter["base_encounter_cost"] or 0)
+        payments = min(float(encounter["payer_coverage"] or 0), amount)
+        common = {
+            "claimid": claim["id"], "chargeid": "1", "patientid": claim["patientid"], "fromdate": claim["servicedate"],
+            "todate": claim["servicedate"], "placeofservice": encounter["organization"], "procedurecode": encounter["code"],
+            "diagnosisref1": "1", "units": "1", "departmentid": claim["departmentid"], "unitamount": f"{amount:.2f}",
+            "appointmentid": claim["appointmentid"], "patientinsuranceid": claim["primarypatientinsuranceid"],
+            "feescheduleid": "1", "providerid": claim["providerid"], "supervisingproviderid": claim["supervisingproviderid"],
+        }
+        charge = {**common, "id": _make_id(claim["id"], "charge"), "type": "CHARGE", "amount": f"{amount:.2f}", "notes": encounter["description"]}
+        payment = {**common, "id": _make_id(claim["id"], "payment"), "type": "PAYMENT", "method": "ECHECK" if payments else "CASH",
+                   "payments": f"{payments:.2f}", "outstanding": f"{amount - payments:.2f}"}
+        for transaction in (charge, payment):
+            yield [transaction.get(column, "") for column in CLAIMS_TRANSACTIONS_HEADER]
+
+
+def _id_columns(header: list[str], rows: list[list[str]]) -> list[int]:
+    """Return the indexes of the columns holding UUIDs in the sampled rows."""
+    return [index for index in range(len(header)) if any(UUID_PATTERN.match(row[index]) for row in rows if index < len(row))]
+
+
+def write_scaled(file_path: str, header: list[str], rows: Iterable[list[str]], factor: int, reference_ids: set[str], table_name: str) -> int:
+    """Write factor copies of the rows. Returns the number of written rows.
+    In copy k > 0 the first 8 hex digits of every id are replaced by k: ids stay unique and consistent across the files.
+    """
+    rows = iter(rows)
+    sample = [row for _, row in zip(range(_SAMPLE_ROWS), rows)]
+    id_columns = _id_columns(header, sample)
+    last_column = header.index("last") if table_name == "patients" else None
+    written = 0
+    with open(file_path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        # The rows after the sample are buffered in a temporary file, so every copy can re-read them
+        rest_path = file_path + ".rest"
+        with open(rest_path, "w", newline="", encoding="utf-8") as rest_file:
+            csv.writer(rest_file).writerows(rows)
+        try:
+            for copy in range(factor):
+                prefix = f"{copy:08x}"
+                with open(rest_path, "r", newline="", encoding="utf-8") as rest_file:
+                    for row in _chain(sample, csv.reader(rest_file)):
+                        if copy:
+                            row = list(row)
+                            for index in id_columns:
+                                value = row[index]
+                                if value and value not in reference_ids:
+                                    row[index] = prefix + value[8:]
+                            if last_column is not None:
+                                row[last_column] = f"{row[last_column]}-{copy}"
+                        writer.writerow(row)
+                        written += 1
+        finally:
+            os.remove(rest_path)
+    return written
+
+
+def _chain(*iterables: Iterable[list[str]]) -> Iterator[list[str]]:
+    for iterable in iterables:
+        yield from iterable
+
+
+def scale_dataset(source_dir: str, output_dir: str, factor: int) -> dict[str, int]:
+    """Write the scaled dataset of source_dir to output_dir. Returns the number of rows per file."""
+    os.makedirs(output_dir, exist_ok=True)
+    reference_ids = set()
+    counts = {}
+    for file in REFERENCE_FILES:
+        with open(os.path.join(source_dir, file), "r", newline="", encoding="utf-8") as source_file:
+            rows = list(csv.reader(source_file))
+        reference_ids.update(row[0] for row in rows[1:])
+        with open(os.path.join(output_dir, file), "w", newline="", encoding="utf-8") as output_file:
+            csv.writer(output_file).writerows(rows)
+        counts[file] = len(rows) - 1
+
+    encounters_path = os.path.join(source_dir, "encounters.csv")
+    for file in CSV_FILES:
+        if file in REFERENCE_FILES:
+            continue
+        file_path = os.path.join(source_dir, file)
+        table_name = os.path.splitext(file)[0]
+        if os.path.exists(file_path):
+            with open(file_path, "r", newline="", encoding="utf-8") as source_file:
+                reader = csv.reader(source_file)
+                header = next(reader)
+                counts[file] = write_scaled(os.path.join(output_dir, file), header, reader, factor, reference_ids, table_name)
+        elif file == "observations.csv":
+            rows = generate_observations(_read_rows(encounters_path))
+            counts[file] = write_scaled(os.path.join(output_dir, file), OBSERVATIONS_HEADER, rows, factor, reference_ids, table_name)
+        elif file == "claims_transactions.csv":
+            encounters = {encounter["id"]: encounter for encounter in _read_rows(encounters_path)}
+            rows = generate_claims_transactions(_read_rows(os.path.join(source_dir, "claims.csv")), encounters)
+            counts[file] = write_scaled(os.path.join(output_dir, file), CLAIMS_TRANSACTIONS_HEADER, rows, factor, reference_ids, table_name)
+        else:
+            print(f"CSV file '{file_path}' not found, skipping.")
+            continue
+        print(f"{file}: {counts[file]} rows")
+    return counts
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Scale the sample patient data by a factor, for load testing.")
+    parser.add_argument("--factor", type=int, default=10, help="Number of copies of every patient (1 only adds the missing files).")
+    parser.add_argument("--source", help="Directory of the source CSV files. Defaults to database.data_dir.")
+    parser.add_argument("--output", help="Output directory. Defaults to data_x<factor>.")
+    return parser.parse_args()
+
+
+# Main execution
+if __name__ == "__main__":
+    Config.from_config_file(CONFIG_PATH)
+    config = Config.get()
+    args = parse_args()
+    if args.factor < 1:
+        raise SystemExit("The factor must be at least 1.")
+
+    source_dir = str(ROOT_DIR / (args.source or config["database"]["data_dir"]))
+    output_dir = str(ROOT_DIR / (args.output or f"data_x{args.factor}"))
+    if os.path.abspath(source_dir) == os.path.abspath(output_dir):
+        raise SystemExit("The output directory must differ from the source directory.")
+
+    start_time = time.perf_counter()
+    counts = scale_dataset(source_dir, output_dir, args.factor)
+    print(f"{sum(counts.values())} rows written to '{output_dir}' in {time.perf_counter() - start_time:.1f}s.")
@@ -0,0 +1,147 @@
+# This module implements the columnar serving backend of the Summarizer: DuckDB over Parquet files.
+# At ingestion every table of the SQLite database (including the derived patient_timeline) is exported to one
+# Parquet file per table. Every DuckDB connection of the Summarizer is an in-memory database with one view per
+# Parquet file, read through SQLAlchemy (duckdb-engine), so the SQL chain, execute_query and the query library work
+# unchanged. Analytical queries over wide tables (e.g. claims) only read the columns and row groups they need.
+#
+# duckdb and duckdb-engine are optional dependencies, only needed when database.backend is "duckdb".
+
+import os
+import glob
+import logging
+import sqlite3
+import pandas as pd
+from typing import Any
+from datetime import datetime, timezone
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from core.ingest import METADATA_TABLE
+
+# DuckDB types of the SQLite declared column types, anything else is exported as text
+DUCKDB_TYPES = {"INTEGER": "BIGINT", "REAL": "DOUBLE"}
+
+PARQUET_SUFFIX = ".parquet"
+
+
+def _import_duckdb() -> Any:
+    try:
+        import duckdb
+        import duckdb_engine  # noqa: F401, registers the duckdb SQLAlchemy dialect
+    except ImportError as e:
+        raise ImportError("The duckdb backend requires the duckdb and duckdb-engine packages: pip install duckdb duckdb-engine") from e
+    return duckdb
+
+
+def _quote_path(path: str) -> str:
+    return "'" + str(path).replace("'", "''") + "'"
+
+
+def parquet_tables(parquet_dir: str) -> dict[str, str]:
+    """Return the exported tables and the paths of their Parquet files."""
+    paths = sorted(glob.glob(os.path.join(parquet_dir, f"*{PARQUET_SUFFIX}")))
+    return {os.path.basename(path)[:-len(PARQUET_SUFFIX)]: os.path.abspath(path) for path in paths}
+
+
+def stale_parquet_tables(db_path: str, parquet_dir: str) -> list[str]:
+    """Return the tables of the SQLite database whose Parquet file is missing or older than their last ingestion
+    (ingested_at of _ingest_metadata). Derived tables, without metadata, are compared to the last ingestion of any file.
+    """
+    existing = parquet_tables(parquet_dir)
+    conn = sqlite3.connect(db_path)
+    try:
+        table_names = [
+            row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")
+            if not row[0].startswith(("_", "sqlite"))
+        ]
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (METADATA_TABLE,)).fetchone():
+            return [table_name for table_name in table_names if table_name not in existing]
+        ingested = dict(conn.execute(f"SELECT table_name, MAX(ingested_at) FROM {METADATA_TABLE} GROUP BY table_name").fetchall())
+    finally:
+        conn.close()
+    last_ingested = max((ingested_at for ingested_at in ingested.values() if ingested_at), default=None)
+    stale = []
+    for table_name in table_names:
+        if table_name not in existing:
+            stale.append(table_name)
+            continue
+        ingested_at = ingested.get(table_name) or last_ingested
+        exported_at = datetime.fromtimestamp(os.path.getmtime(existing[table_name]), timezone.utc)
+        if ingested_at is not None and datetime.fromisoformat(ingested_at) > exported_at:
+            stale.append(table_name)
+    return stale
+
+
+def export_parquet(db_path: str, parquet_dir: str, tables: list[str] = None, chunk_size: int = 100000) -> dict[str, int]:
+    """Export the tables of the SQLite database to Parquet files. Returns the number of exported rows per table.
+    Only the given tables and the tables without a Parquet file are exported, all tables if tables is None.
+    Parquet files of tables that no longer exist are removed.
+    """
+    duckdb = _import_duckdb()
+    os.makedirs(parquet_dir, exist_ok=True)
+    source = sqlite3.connect(db_path)
+    target = duckdb.connect()
+    exported = {}
+    try:
+        source_tables = [
+            row[0] for row in source.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")
+            if not row[0].startswith(("_", "sqlite"))
+        ]
+        existing = parquet_tables(parquet_dir)
+        for table_name in source_tables:
+            if tables is not None and table_name not in tables and table_name in existing:
+                continue
+            schema = [(row[1], row[2].upper()) for row in source.execute(f'PRAGMA table_info("{table_name}")')]
+            columns = [column for column, _ in schema]
+            target.execute(
+                "CREATE OR REPLACE TABLE export (" + ", ".join(f'"{column}" {DUCKDB_TYPES.get(column_type, "VARCHAR")}' for column, column_type in schema) + ")"
+            )
+            cursor = source.execute(f'SELECT * FROM "{table_name}"')
+            rows = 0
+            while chunk := cursor.fetchmany(chunk_size):
+                target.register("chunk", pd.DataFrame.from_records(chunk, columns=columns))
+                target.execute("INSERT INTO export SELECT * FROM chunk")
+                target.unregister("chunk")
+                rows += len(chunk)
+            # Queries running on the previous file keep reading it until the new one replaces it
+            path = os.path.join(parquet_dir, f"{table_name}{PARQUET_SUFFIX}")
+            target.execute(f"COPY export TO {_quote_path(path + '.tmp')} (FORMAT PARQUET, COMPRESSION ZSTD)")
+            os.replace(path + ".tmp", path)
+            exported[table_name] = rows
+        for table_name in existing.keys() - set(source_tables):
+            os.remove(existing[table_name])
+    finally:
+        target.close()
+        source.close()
+    logging.info(f"Exported {len(exported)} tables to Parquet in '{parquet_dir}': {exported}")
+    return exported
+
+
+def create_duckdb_engine(parquet_dir: str, pool_size: int = 5, threads: int = None, memory_limit: str = None) -> Engine:
+    """Create the engine serving the Parquet files of parquet_dir through DuckDB.
+
+    Args:
+        parquet_dir (str): Directory of the Parquet files exported at ingestion.
+        pool_size (int): Number of pooled connections, sized to the worker thread pool.
+        threads (int): DuckDB threads of every connection.
+        memory_limit (str): DuckDB memory limit of every connection, e.g. "2GB".
+    """
+    _import_duckdb()
+    # Every connection is its own in-memory database, the Parquet files are shared
+    engine = create_engine("duckdb:///:memory:", poolclass=QueuePool, pool_size=pool_size)
+    settings = []
+    if threads is not None:
+        settings.append(f"SET threads = {int(threads)}")
+    if memory_limit is not None:
+        settings.append(f"SET memory_limit = {_quote_path(memory_limit)}")
+
+    @event.listens_for(engine, "connect")
+    def create_views(dbapi_connection: Any, connection_record: Any) -> None:
+        for setting in settings:
+            dbapi_connection.execute(setting)
+        for table_name, path in parquet_tables(parquet_dir).items():
+            dbapi_connection.execute(f'CREATE VIEW "{table_name}" AS SELECT * FROM read_parquet({_quote_path(path)})')
+
+    return engine
@@ -0,0 +1,101 @@
+# This module implements a deterministic local chat model that replaces ChatOpenAI in offline benchmarks.
+# Structured output requests get canned responses: the SQL chain gets the query returned by sql_responder for the
+# question, and summaries get an object built from the requested JSON schema. Every call waits latency_s seconds,
+# standing for the network and generation time of the real model, so that the pipeline overhead can be measured alone.
+# With include_raw, responses come with a raw message whose usage metadata counts the tokens of the prompt and output.
+
+import json
+import time
+import asyncio
+from typing import Any, Callable, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import RunnableLambda
+
+from core.tokens import count_tokens
+
+
+def example_from_schema(schema: dict[str, Any]) -> Any:
+    """Return a deterministic value that is valid against the JSON schema."""
+    if "enum" in schema:
+        return schema["enum"][0]
+    schema_type = schema.get("type", "string")
+    if isinstance(schema_type, list):
+        schema_type = next((item for item in schema_type if item != "null"), "null")
+    if schema_type == "object":
+        return {name: example_from_schema(property_schema) for name, property_schema in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        return [example_from_schema(schema.get("items", {}))]
+    if schema_type == "string":
+        return "2000-01-01" if schema.get("format") == "date" else schema.get("description", "text")
+    if schema_type in ("integer", "number"):
+        return 0
+    if schema_type == "boolean":
+        return False
+    return None
+
+
+def _prompt_text(prompt: Any) -> str:
+    if isinstance(prompt, PromptValue):
+        return prompt.to_string()
+    if isinstance(prompt, list):
+        return "\n".join(message.content if isinstance(message, BaseMessage) else str(message) for message in prompt)
+    return str(prompt)
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic chat model with canned SQL and schema-valid structured output."""
+
+    latency_s: float = 0.0
+    """Seconds waited by every call."""
+    sql_responder: Optional[Callable[[str], str]] = None
+    """Returns the SQL query answering the prompt of the SQL chain."""
+    default_sql: str = "SELECT 1"
+    """SQL query returned when there is no sql_responder or it returns None."""
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _sql_response(self, prompt: Any) -> dict[str, str]:
+        sql = self.sql_responder(_prompt_text(prompt)) if self.sql_responder is not None else None
+        return {"sql": sql or self.default_sql}
+
+    def _structured_response(self, schema: dict[str, Any], prompt: Any) -> dict[str, Any]:
+        # The SQL chain requests the "sql_query" schema (Summarizer._initialize_llm)
+        if schema.get("title") == "sql_query":
+            return self._sql_response(prompt)
+        return example_from_schema(schema)
+
+    def _generate(self, messages: list[BaseMessage], stop: list[str] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency_s)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._sql_response(messages)["sql"]))])
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: list[str] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.latency_s)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._sql_response(messages)["sql"]))])
+
+    def _raw_response(self, schema: dict[str, Any], prompt: Any, include_raw: bool) -> dict[str, Any]:
+        response = self._structured_response(schema, prompt)
+        if not include_raw:
+            return response
+        content = json.dumps(response)
+        input_tokens, output_tokens = count_tokens(_prompt_text(prompt)), count_tokens(content)
+        raw = AIMessage(content=content, usage_metadata={"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens})
+        return {"raw": raw, "parsed": response, "parsing_error": None}
+
+    def with_structured_output(self, schema: dict[str, Any], include_raw: bool = False, **kwargs: Any) -> RunnableLambda:
+        """Return a runnable producing the canned response of the schema, in place of a structured output call."""
+
+        def respond(prompt: Any) -> dict[str, Any]:
+            time.sleep(self.latency_s)
+            return self._raw_response(schema, prompt, include_raw)
+
+        async def arespond(prompt: Any) -> dict[str, Any]:
+            await asyncio.sleep(self.latency_s)
+            return self._raw_response(schema, prompt, include_raw)
+
+        return RunnableLambda(respond, afunc=arespond)
@@ -0,0 +1,477 @@
+# This module implements incremental, checksum-aware ingestion of the patient data CSV files.
+# The checksum, size and row count of every ingested file are recorded in the _ingest_metadata table. On the next run:
+# - unchanged files are skipped,
+# - files that only grew (new rows appended at the end) get the new rows appended to their table,
+# - other changed files are synchronized with their table by natural key, only rows whose key changed are rewritten,
+# - new files, files without a natural key or with a different header replace their table.
+#
+# Files are streamed in chunks, so memory is bounded by the chunk size rather than by the largest file.
+# Independent files are parsed in parallel by a pool of parser threads while a single writer bulk-inserts
+# the chunks of one table at a time, in one transaction per table.
+#
+# After the files, the denormalized patient_timeline table is rebuilt when one of its source tables changed:
+# one row per clinical event (encounter, condition, medication, procedure) with its encounter context,
+# stored in (patient, start) order so that the timeline of a patient is a single indexed range scan.
+
+import os
+import csv
+import queue
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any
+
+CSV_FILES = [
+    'allergies.csv', 'careplans.csv', 'claims.csv', 'claims_transactions.csv', 'conditions.csv',
+    'devices.csv', 'encounters.csv', 'imaging_studies.csv', 'immunizations.csv', 'medications.csv',
+    'observations.csv', 'organizations.csv', 'patients.csv', 'payer_transitions.csv', 'payers.csv',
+    'procedures.csv', 'providers.csv', 'supplies.csv'
+]
+
+# Natural key of every table. Tables without an id column are keyed by patient, encounter, code and date columns.
+NATURAL_KEYS = {
+    "allergies": ["patient", "encounter", "code", "start"],
+    "careplans": ["id"],
+    "claims": ["id"],
+    "claims_transactions": ["id"],
+    "conditions": ["patient", "encounter", "code", "start"],
+    "devices": ["patient", "encounter", "code", "start"],
+    "encounters": ["id"],
+    "imaging_studies": ["id", "instance_uid"],
+    "immunizations": ["patient", "encounter", "code", "date"],
+    "medications": ["patient", "encounter", "code", "start"],
+    "observations": ["patient", "encounter", "code", "date"],
+    "organizations": ["id"],
+    "patients": ["id"],
+    "payer_transitions": ["patient", "start_date", "payer"],
+    "payers": ["id"],
+    "procedures": ["patient", "encounter", "code", "start"],
+    "providers": ["id"],
+    "supplies": ["patient", "encounter", "code", "date"],
+}
+
+# Declared SQLite type of the numeric columns. All other columns (ids, codes, dates, zip codes, free text) are TEXT.
+# Values are inserted as parsed text, SQLite converts them to the declared type (column affinity).
+COLUMN_TYPES = {
+    "claims": {
+        "departmentid": "INTEGER", "patientdepartmentid": "INTEGER",
+        "outstanding1": "REAL", "outstanding2": "REAL", "outstandingp": "REAL",
+        "healthcareclaimtypeid1": "INTEGER", "healthcareclaimtypeid2": "INTEGER",
+    },
+    "claims_transactions": {
+        "chargeid": "INTEGER", "amount": "REAL", "units": "INTEGER", "unitamount": "REAL",
+        "payments": "REAL", "adjustments": "REAL", "transfers": "REAL", "outstanding": "REAL",
+    },
+    "encounters": {"base_encounter_cost": "REAL", "total_claim_cost": "REAL", "payer_coverage": "REAL"},
+    "immunizations": {"base_cost": "REAL"},
+    "medications": {"base_cost": "REAL", "payer_coverage": "REAL", "dispenses": "INTEGER", "totalcost": "REAL"},
+    "organizations": {"lat": "REAL", "lon": "REAL", "revenue": "REAL", "utilization": "INTEGER"},
+    "patients": {"lat": "REAL", "lon": "REAL", "healthcare_expenses": "REAL", "healthcare_coverage": "REAL", "income": "INTEGER"},
+    "payers": {
+        "amount_covered": "REAL", "amount_uncovered": "REAL", "revenue": "REAL",
+        "covered_encounters": "INTEGER", "uncovered_encounters": "INTEGER",
+        "covered_medications": "INTEGER", "uncovered_medications": "INTEGER",
+        "covered_procedures": "INTEGER", "uncovered_procedures": "INTEGER",
+        "covered_immunizations": "INTEGER", "uncovered_immunizations": "INTEGER",
+        "unique_customers": "INTEGER", "qols_avg": "REAL", "member_months": "INTEGER",
+    },
+    "procedures": {"base_cost": "REAL"},
+    "providers": {"lat": "REAL", "lon": "REAL", "utilization": "INTEGER"},
+    "supplies": {"quantity": "INTEGER"},
+}
+
+# Secondary indexes created after ingestion: patient foreign keys with the date column the rows are ordered by,
+# encounter ids, join keys and patient names. Each entry is the list of indexed columns.
+# The ingest.indexes section of the configuration overrides this default index set.
+DEFAULT_INDEXES = {
+    "allergies": [["patient", "start"], ["encounter"]],
+    "careplans": [["patient", "start"], ["encounter"]],
+    "claims": [["patientid", "servicedate"], ["appointmentid"]],
+    "claims_transactions": [["patientid", "fromdate"], ["claimid"]],
+    "conditions": [["patient", "start"], ["encounter"]],
+    "devices": [["patient", "start"], ["encounter"]],
+    "encounters": [["id"], ["patient", "start"]],
+    "imaging_studies": [["patient", "date"], ["encounter"]],
+    "immunizations": [["patient", "date"], ["encounter"]],
+    "medications": [["patient", "start"], ["encounter"]],
+    "observations": [["patient", "date"], ["encounter"]],
+    "organizations": [["id"]],
+    "patients": [["id"], ["last", "first"]],
+    "payer_transitions": [["patient", "start_date"]],
+    "payers": [["id"]],
+    "procedures": [["patient", "start"], ["encounter"]],
+    "providers": [["id"]],
+    "supplies": [["patient", "date"], ["encounter"]],
+    "patient_timeline": [["patient", "start"]],
+}
+
+# Prefix of the managed secondary indexes. Indexes with this prefix that are no longer declared are dropped.
+INDEX_PREFIX = "ix_"
+
+# Connection settings used while ingesting. Durability is relaxed, a failed ingest is simply re-run.
+INGEST_PRAGMAS = [
+    # WAL is persistent: summarizer connections keep reading the previous data while a table is re-ingested
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536",  # 64 MB
+]
+
+METADATA_TABLE = "_ingest_metadata"
+
+TIMELINE_TABLE = "patient_timeline"
+# Clinical events of the timeline: event type -> (source table, SELECT of patient, start, stop, code, description,
+# reasondescription and encounter id). Source tables that were not ingested are left out.
+TIMELINE_EVENTS = {
+    "encounter": ("encounters", "patient, start, stop, code, description, reasondescription, id"),
+    "condition": ("conditions", "patient, start, stop, code, description, NULL, encounter"),
+    "medication": ("medications", "patient, start, stop, code, description, reasondescription, encounter"),
+    "procedure": ("procedures", "patient, start, stop, code, description, reasondescription, encounter"),
+}
+
+# Number of parsed chunks buffered per file while the writer is busy with another table
+_CHUNK_QUEUE_SIZE = 2
+
+
+def file_checksum(file_path: str, size: int = None) -> str:
+    """Return the sha256 checksum of the file, or of its first size bytes."""
+    digest = hashlib.sha256()
+    remaining = os.path.getsize(file_path) if size is None else size
+    with open(file_path, "rb") as file:
+        while remaining > 0:
+            chunk = file.read(min(1024 * 1024, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def table_schema(table_name: str, columns: list[str]) -> list[tuple[str, str]]:
+    """Return the (column, declared type) pairs of the table created for a CSV file with the given header."""
+    column_types = COLUMN_TYPES.get(table_name, {})
+    return [(column, column_types.get(column, "TEXT")) for column in columns]
+
+
+def _read_metadata(conn: sqlite3.Connection) -> dict[str, dict[str, Any]]:
+    conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS {METADATA_TABLE} (
+            file_name TEXT PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            checksum TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            ingested_at TEXT
+        )"""
+    )
+    rows = conn.execute(f"SELECT file_name, table_name, checksum, size, row_count FROM {METADATA_TABLE}").fetchall()
+    return {row[0]: {"table_name": row[1], "checksum": row[2], "size": row[3], "row_count": row[4]} for row in rows}
+
+
+def _write_metadata(conn: sqlite3.Connection, file_name: str, table_name: str, checksum: str, size: int, row_count: int) -> None:
+    conn.execute(
+        f"INSERT OR REPLACE INTO {METADATA_TABLE} VALUES (?, ?, ?, ?, ?, ?)",
+        (file_name, table_name, checksum, size, row_count, datetime.now(timezone.utc).isoformat()),
+    )
+
+
+def _existing_schema(conn: sqlite3.Connection, table_name: str) -> list[tuple[str, str]]:
+    return [(row[1], row[2]) for row in conn.execute(f'PRAGMA table_info("{table_name}")').fetchall()]
+
+
+def _read_header(file_path: str) -> list[str]:
+    with open(file_path, "r", newline="") as file:
+        return next(csv.reader(file), [])
+
+
+def _quote(columns: list[str]) -> str:
+    return ", ".join(f'"{column}"' for column in columns)
+
+
+def _is_append_only(file_path: str, previous: dict[str, Any], size: int) -> bool:
+    """Check that the file only grew: its first previous["size"] bytes are the previously ingested file."""
+    if size <= previous["size"] or previous["size"] == 0:
+        return False
+    with open(file_path, "rb") as file:
+        file.seek(previous["size"] - 1)
+        if file.read(1) != b"\n":
+            return False
+    return file_checksum(file_path, previous["size"]) == previous["checksum"]
+
+
+def _plan_ingest(conn: sqlite3.Connection, file_path: str, previous: dict[str, Any] | None, full_refresh: bool) -> dict[str, Any]:
+    """Decide how a CSV file is ingested: skipped, appended, upserted or replaced."""
+    file_name = os.path.basename(file_path)
+    table_name = file_name.split('.')[0]
+    size = os.path.getsize(file_path)
+    checksum = file_checksum(file_path)
+    header = _read_header(file_path)
+    schema = table_schema(table_name, header)
+    plan = {"file_name": file_name, "file_path": file_path, "table_name": table_name, "checksum": checksum,
+            "size": size, "schema": schema, "offset": None, "previous": previous}
+
+    # Incremental ingestion needs the table to have been created from the same header and column types
+    incremental = not full_refresh and previous is not None and _existing_schema(conn, table_name) == schema
+    if incremental and previous["checksum"] == checksum:
+        plan["action"] = "skipped"
+    elif incremental and _is_append_only(file_path, previous, size):
+        plan["action"] = "appended"
+        plan["offset"] = previous["size"]
+    elif incremental and table_name in NATURAL_KEYS and set(NATURAL_KEYS[table_name]).issubset(header):
+        plan["action"] = "upserted"
+    else:
+        plan["action"] = "replaced"
+    return plan
+
+
+def _put(chunks: queue.Queue, item: Any, stop: threading.Event) -> bool:
+    """Put an item on the chunk queue, giving up when the ingest is stopped."""
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _parse_chunks(plan: dict[str, Any], chunk_size: int, chunks: queue.Queue, stop: threading.Event) -> None:
+    """Parse the CSV file (or its appended tail) into chunks of row tuples. None marks the end of the file."""
+    columns = [column for column, _ in plan["schema"]]
+    try:
+        with open(plan["file_path"], "rb") as file:
+            if plan["offset"] is None:
+                reader = pd.read_csv(file, dtype=str, chunksize=chunk_size)
+            else:
+                file.seek(plan["offset"])
+                reader = pd.read_csv(file, dtype=str, header=None, names=columns, chunksize=chunk_size)
+            for df in reader:
+                # Missing values are NaN, SQLite stores NaN as NULL
+                rows = list(df.itertuples(index=False, name=None))
+                if not _put(chunks, rows, stop):
+                    return
+    except pd.errors.EmptyDataError:
+        # Appended tail with only a trailing newline
+        pass
+    except Exception as e:
+        _put(chunks, e, stop)
+        return
+    _put(chunks, None, stop)
+
+
+def _insert_chunks(conn: sqlite3.Connection, table_name: str, columns: list[str], chunks: queue.Queue) -> int:
+    """Bulk-insert the parsed chunks into the table. Returns the number of inserted rows."""
+    insert = f'INSERT INTO "{table_name}" ({_quote(columns)}) VALUES ({", ".join("?" * len(columns))})'
+    inserted = 0
+    while (rows := chunks.get()) is not None:
+        if isinstance(rows, Exception):
+            raise rows
+        conn.executemany(insert, rows)
+        inserted += len(rows)
+    return inserted
+
+
+def _create_table(conn: sqlite3.Connection, table_name: str, schema: list[tuple[str, str]]) -> None:
+    conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+    column_definitions = ", ".join(f'"{column}" {column_type}' for column, column_type in schema)
+    conn.execute(f'CREATE TABLE "{table_name}" ({column_definitions})')
+
+
+def _sync_rows(conn: sqlite3.Connection, stage_table: str, table_name: str, columns: list[str], key_columns: list[str]) -> int:
+    """Synchronize the table with the staged file rows by natural key. Returns the number of rewritten keys.
+    Keys whose rows were added, modified or removed are deleted from the table and re-inserted from the stage table.
+    Rows are compared with their number of occurrences, so a key whose rows differ only by duplicates is rewritten too.
+    """
+    quoted_columns = _quote(columns)
+    keys = _quote(key_columns)
+    key_match = " AND ".join(f'k."{column}" IS t."{column}"' for column in key_columns)
+    conn.execute("DROP TABLE IF EXISTS temp._changed_keys")
+    conn.execute(
+        f"""CREATE TEMP TABLE _changed_keys AS
+            WITH stage_rows AS (SELECT {quoted_columns}, COUNT(*) AS "_occurrences" FROM "{stage_table}" GROUP BY {quoted_columns}),
+                 table_rows AS (SELECT {quoted_columns}, COUNT(*) AS "_occurrences" FROM "{table_name}" GROUP BY {quoted_columns})
+            SELECT DISTINCT {keys} FROM (SELECT * FROM stage_rows EXCEPT SELECT * FROM table_rows)
+            UNION
+            SELECT DISTINCT {keys} FROM (SELECT * FROM table_rows EXCEPT SELECT * FROM stage_rows)"""
+    )
+    conn.execute(f"CREATE INDEX temp._changed_keys_idx ON _changed_keys ({keys})")
+    changed = conn.execute("SELECT COUNT(*) FROM _changed_keys").fetchone()[0]
+    if changed:
+        conn.execute(f'DELETE FROM "{table_name}" AS t WHERE EXISTS (SELECT 1 FROM _changed_keys k WHERE {key_match})')
+        conn.execute(
+            f'INSERT INTO "{table_name}" ({quoted_columns}) SELECT {quoted_columns} FROM "{stage_table}" AS t '
+            f'WHERE EXISTS (SELECT 1 FROM _changed_keys k WHERE {key_match})'
+        )
+    conn.execute("DROP TABLE temp._changed_keys")
+    return changed
+
+
+def _write_table(conn: sqlite3.Connection, plan: dict[str, Any], chunks: queue.Queue) -> dict[str, Any]:
+    """Write the parsed chunks of a file according to its ingest plan. Runs inside the transaction of the table."""
+    table_name = plan["table_name"]
+    columns = [column for column, _ in plan["schema"]]
+    if plan["action"] == "appended":
+        inserted = _insert_chunks(conn, table_name, columns, chunks)
+        return {"rows": plan["previous"]["row_count"] + inserted, "changed_rows": inserted}
+    if plan["action"] == "upserted":
+        stage_table = f"_stage_{table_name}"
+        _create_table(conn, stage_table, plan["schema"])
+        rows = _insert_chunks(conn, stage_table, columns, chunks)
+        changed = _sync_rows(conn, stage_table, table_name, columns, NATURAL_KEYS[table_name])
+        conn.execute(f'DROP TABLE "{stage_table}"')
+        return {"rows": rows, "changed_rows": changed}
+    _create_table(conn, table_name, plan["schema"])
+    rows = _insert_chunks(conn, table_name, columns, chunks)
+    return {"rows": rows, "changed_rows": rows}
+
+
+def build_patient_timeline(conn: sqlite3.Connection) -> int | None:
+    """Rebuild the patient_timeline table from the ingested event tables. Returns the number of events,
+    or None if the encounters table, which provides the encounter context, was not ingested.
+    """
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if "encounters" not in tables:
+        logging.warning(f"Table 'encounters' not found, {TIMELINE_TABLE} not built.")
+        return None
+    events = " UNION ALL ".join(
+        f"SELECT '{event_type}', {columns} FROM {table_name}"
+        for event_type, (table_name, columns) in TIMELINE_EVENTS.items() if table_name in tables
+    )
+    organization, organization_join = ("o.name", "LEFT JOIN organizations o ON o.id = e.organization") if "organizations" in tables else ("NULL", "")
+    conn.execute(f'DROP TABLE IF EXISTS "{TIMELINE_TABLE}"')
+    conn.execute(
+        f"""CREATE TABLE "{TIMELINE_TABLE}" AS
+            WITH ev(event_type, patient, start, stop, code, description, reasondescription, encounter) AS ({events})
+            SELECT ev.patient, ev.start, ev.stop, ev.event_type, ev.code, ev.description, ev.reasondescription, ev.encounter,
+                   e.encounterclass, e.description AS encounter_description, {organization} AS organization
+            FROM ev
+            LEFT JOIN encounters e ON e.id = ev.encounter
+            {organization_join}
+            ORDER BY ev.patient, ev.start, ev.event_type"""
+    )
+    return conn.execute(f'SELECT COUNT(*) FROM "{TIMELINE_TABLE}"').fetchone()[0]
+
+
+def create_indexes(conn: sqlite3.Connection, indexes: dict[str, list[list[str]]]) -> tuple[list[str], list[str]]:
+    """Create the declared secondary indexes and drop the managed ones that are no longer declared.
+    Returns the names of the created and dropped indexes.
+    """
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    declared = {}
+    for table_name, index_columns in (indexes or {}).items():
+        if table_name not in tables:
+            continue
+        table_columns = {column for column, _ in _existing_schema(conn, table_name)}
+        for columns in index_columns:
+            if not set(columns).issubset(table_columns):
+                logging.warning(f"Index on {table_name}({', '.join(columns)}) skipped, unknown column.")
+                continue
+            declared[f"{INDEX_PREFIX}{table_name}_{'_'.join(columns)}"] = (table_name, columns)
+
+    existing = {
+        row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'") if row[0].startswith(INDEX_PREFIX)
+    }
+    dropped = sorted(existing - declared.keys())
+    created = sorted(declared.keys() - existing)
+    for index_name in dropped:
+        conn.execute(f'DROP INDEX "{index_name}"')
+    for index_name in created:
+        table_name, columns = declared[index_name]
+        conn.execute(f'CREATE INDEX "{index_name}" ON "{table_name}" ({_quote(columns)})')
+    return created, dropped
+
+
+def ingest_csv_files(db_path: str, data_dir: str, full_refresh: bool = False, chunk_size: int = 50000, workers: int = 4,
+                     indexes: dict[str, list[list[str]]] = None) -> dict[str, dict[str, Any]]:
+    """Incrementally ingest the CSV files of data_dir. Every table is written in its own transaction.
+    Afterwards the secondary indexes (DEFAULT_INDEXES unless indexes is given) are created and the tables analyzed.
+    """
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    # Transactions are managed explicitly, one per table
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    for pragma in INGEST_PRAGMAS:
+        conn.execute(pragma)
+    results = {}
+    stop = threading.Event()
+    try:
+        metadata = _read_metadata(conn)
+        plans = []
+        for file in CSV_FILES:
+            file_path = os.path.join(data_dir, file)
+            if not os.path.exists(file_path):
+                logging.warning(f"CSV file '{file_path}' not found, skipping.")
+                continue
+            plans.append(_plan_ingest(conn, file_path, metadata.get(file), full_refresh))
+
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ingest-parser") as executor:
+            # Parsers run ahead of the writer, each one blocks once its chunk queue is full
+            chunk_queues = {}
+            for plan in plans:
+                if plan["action"] != "skipped":
+                    chunk_queues[plan["file_name"]] = queue.Queue(maxsize=_CHUNK_QUEUE_SIZE)
+                    executor.submit(_parse_chunks, plan, chunk_size, chunk_queues[plan["file_name"]], stop)
+            try:
+                for plan in plans:
+                    table_name = plan["table_name"]
+                    if plan["action"] == "skipped":
+                        results[table_name] = {"action": "skipped", "rows": plan["previous"]["row_count"], "changed_rows": 0}
+                        continue
+                    start_time = time.perf_counter()
+                    conn.execute("BEGIN")
+                    try:
+                        result = _write_table(conn, plan, chunk_queues[plan["file_name"]])
+                        _write_metadata(conn, plan["file_name"], table_name, plan["checksum"], plan["size"], result["rows"])
+                        conn.execute("COMMIT")
+                    except BaseException:
+                        conn.execute("ROLLBACK")
+                        raise
+                    elapsed_s = time.perf_counter() - start_time
+                    # Rows parsed from the file in this run
+                    processed_rows = result["changed_rows"] if plan["action"] == "appended" else result["rows"]
+                    results[table_name] = {
+                        "action": plan["action"], **result,
+                        "elapsed_s": round(elapsed_s, 3),
+                        "rows_per_sec": round(processed_rows / elapsed_s) if elapsed_s > 0 else None,
+                    }
+                    logging.info(f"Ingested {plan['file_name']}: {results[table_name]}")
+            finally:
+                # Unblock the parsers of the remaining files when an error aborted the ingest
+                stop.set()
+
+        timeline_sources = {table_name for table_name, _ in TIMELINE_EVENTS.values()} | {"organizations"}
+        timeline_exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (TIMELINE_TABLE,)).fetchone()
+        if not timeline_exists or any(results.get(table_name, {}).get("action", "skipped") != "skipped" for table_name in timeline_sources):
+            start_time = time.perf_counter()
+            conn.execute("BEGIN")
+            try:
+                rows = build_patient_timeline(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            if rows is not None:
+                elapsed_s = time.perf_counter() - start_time
+                results[TIMELINE_TABLE] = {"action": "rebuilt", "rows": rows, "changed_rows": rows, "elapsed_s": round(elapsed_s, 3),
+                                           "rows_per_sec": round(rows / elapsed_s) if elapsed_s > 0 else None}
+                logging.info(f"Built {TIMELINE_TABLE}: {results[TIMELINE_TABLE]}")
+        else:
+            rows = conn.execute(f'SELECT COUNT(*) FROM "{TIMELINE_TABLE}"').fetchone()[0]
+            results[TIMELINE_TABLE] = {"action": "skipped", "rows": rows, "changed_rows": 0}
+
+        # Replaced tables are created without indexes, indexes are built once the rows are loaded
+        start_time = time.perf_counter()
+        conn.execute("BEGIN")
+        created, dropped = create_indexes(conn, DEFAULT_INDEXES if indexes is None else indexes)
+        conn.execute("COMMIT")
+        if created or dropped or any(result["action"] != "skipped" for result in results.values()):
+            # Refresh the statistics used by the query planner to choose between the indexes
+            conn.execute("ANALYZE")
+            logging.info(f"Indexes created: {created}, dropped: {dropped}, tables analyzed in {time.perf_counter() - start_time:.2f}s.")
+    finally:
+        conn.close()
+    return results
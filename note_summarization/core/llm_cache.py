@@ -0,0 +1,197 @@
+# This module implements a persistent LLM response cache for LangChain.
+# Responses are stored in a SQLite file, so they survive restarts and are shared by all uvicorn workers on the host.
+# The cache is bounded by number of entries and total size (least recently used entries are evicted first)
+# and every entry expires after a configurable TTL.
+# Cache hits do not write to the database: access times are buffered and written in batches, and eviction only runs
+# when an insert takes the cache over one of its limits.
+# Replayed messages are marked in their response metadata, so that their usage metadata is not counted as spent tokens.
+
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import Any
+
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.load import dumps, loads
+from langchain_community.cache import InMemoryCache
+
+from core.config import ROOT_DIR
+
+# Response metadata key of the messages replayed from the LLM cache
+CACHE_HIT_METADATA = "llm_cache_hit"
+
+
+def _mark_cache_hit(generations: RETURN_VAL_TYPE) -> RETURN_VAL_TYPE:
+    for generation in generations:
+        if getattr(generation, "message", None) is not None:
+            generation.message.response_metadata[CACHE_HIT_METADATA] = True
+    return generations
+
+
+def is_cache_hit(message: Any) -> bool:
+    """Return True if the message was replayed from the LLM cache instead of generated by the model."""
+    return bool(getattr(message, "response_metadata", {}).get(CACHE_HIT_METADATA))
+
+
+class SQLiteLRUCache(BaseCache):
+    """SQLite-file based LLM cache with LRU eviction, per-entry TTL and hit/miss counters."""
+
+    def __init__(self, cache_path: str, max_entries: int = None, max_bytes: int = None, ttl_seconds: int = None, access_batch_size: int = 100):
+        """Open (or create) the cache database file. Limits set to None are not enforced.
+        Access times of cache hits are written every access_batch_size hits, before an eviction and on close.
+        """
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.access_batch_size = access_batch_size
+        self._lock = threading.Lock()
+        # Access times of the cache hits not written yet, by key
+        self._pending_access = {}
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False, timeout=30)
+        # WAL lets several worker processes read the cache while one of them writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_accessed REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_accessed ON llm_cache (last_accessed)")
+        self._conn.commit()
+
+    @staticmethod
+    def _make_key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> RETURN_VAL_TYPE | None:
+        """Look up the cached generations. Expired entries are removed and count as a miss."""
+        key = self._make_key(prompt, llm_string)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._pending_access[key] = now
+            if len(self._pending_access) >= self.access_batch_size:
+                self._flush_access()
+            self.hits += 1
+        try:
+            return _mark_cache_hit([loads(generation) for generation in json.loads(row[0])])
+        except Exception as e:
+            logging.warning(f"LLM cache entry could not be deserialized and is ignored: {e}")
+            return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        """Store the generations and evict entries over the configured limits."""
+        key = self._make_key(prompt, llm_string)
+        response = json.dumps([dumps(generation) for generation in return_val])
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response.encode("utf-8")), now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _flush_access(self) -> None:
+        """Write the buffered access times of the cache hits."""
+        if self._pending_access:
+            self._conn.executemany(
+                "UPDATE llm_cache SET last_accessed = ? WHERE key = ? AND last_accessed < ?",
+                [(accessed, key, accessed) for key, accessed in self._pending_access.items()],
+            )
+            self._conn.commit()
+            self._pending_access.clear()
+
+    def _evict(self, now: float) -> None:
+        """If the cache is over its entry or size limit, remove expired entries, then the least recently used entries over the limits."""
+        if self.max_entries is None and self.max_bytes is None:
+            return
+        entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        if (self.max_entries is None or entries <= self.max_entries) and (self.max_bytes is None or size <= self.max_bytes):
+            return
+        # The least recently used order includes the hits not written yet
+        self._flush_access()
+        evicted = 0
+        if self.ttl_seconds is not None:
+            evicted += self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,)).rowcount
+        if self.max_entries is not None:
+            evicted += self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+        if self.max_bytes is not None:
+            evicted += self._conn.execute(
+                """DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_accessed DESC, key) AS total_size FROM llm_cache)
+                    WHERE total_size > ?
+                )""",
+                (self.max_bytes,),
+            ).rowcount
+        self.evictions += evicted
+
+    def clear(self, **kwargs: Any) -> None:
+        """Remove all cached responses."""
+        with self._lock:
+            self._pending_access.clear()
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+    def stats(self) -> dict[str, int]:
+        """Return the hit/miss/eviction counters of this process and the current size of the cache."""
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": entries, "bytes": size}
+
+    def close(self) -> None:
+        """Write the buffered access times and close the cache database connection."""
+        with self._lock:
+            self._flush_access()
+            self._conn.close()
+
+
+class MarkedInMemoryCache(InMemoryCache):
+    """In-process LLM cache returning marked copies of the cached generations."""
+
+    def lookup(self, prompt: str, llm_string: str) -> RETURN_VAL_TYPE | None:
+        generations = super().lookup(prompt, llm_string)
+        if generations is None:
+            return None
+        return _mark_cache_hit([generation.model_copy(deep=True) for generation in generations])
+
+
+def create_llm_cache(cache_config: dict[str, Any]) -> BaseCache:
+    """Create the LLM cache described by the llm_cache section of the configuration."""
+    cache_type = cache_config.get("type", "memory")
+    if cache_type == "memory":
+        return MarkedInMemoryCache()
+    if cache_type == "sqlite":
+        cache = SQLiteLRUCache(
+            str(ROOT_DIR / cache_config.get("path", "db/llm_cache.db")),
+            max_entries=cache_config.get("max_entries"),
+            max_bytes=cache_config.get("max_bytes"),
+            ttl_seconds=cache_config.get("ttl_seconds"),
+        )
+        logging.info(f"LLM cache initialized: {cache.cache_path}")
+        return cache
+    raise ValueError(f"Unknown LLM cache type '{cache_type}'.")
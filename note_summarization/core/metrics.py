@@ -0,0 +1,149 @@
+# This module implements the metrics of the summary pipeline, exposed in the Prometheus text format on /metrics.
+# Every summary records, labeled by template:
+# - the duration of each stage (resolve_patient, generate_sql, execute_query, format_data, prepare_prompt,
+#   summary_llm and the total),
+# - the rows returned by each retrieval step, the prompt size in bytes and the prompt and completion tokens,
+# - the summary cache hits and misses and the number of summaries generated or failed.
+# The hit/miss counters of the process-wide caches (patient, SQL, LLM) and of the in-flight request coalescing
+# (hits are requests that joined an identical computation in flight) are read when the metrics are rendered.
+# Metrics are kept in memory per worker process.
+
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+# Histogram buckets of durations in seconds and of sizes (rows, bytes, tokens)
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """Monotonic counter with labels."""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Histogram with cumulative buckets and labels."""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket (the last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.label_names)
+        index = next((index for index, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else _format_value(bound)
+                    bucket_label = f'le="{le}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, bucket_label)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class PipelineMetrics:
+    """Metrics of the summary pipeline of a Summarizer."""
+
+    def __init__(self):
+        self.stage_duration = Histogram("ns_stage_duration_seconds", "Duration of the summary pipeline stages.", ("template", "stage"))
+        self.rows_returned = Histogram("ns_rows_returned", "Rows returned by the retrieval steps.", ("template",), SIZE_BUCKETS)
+        self.prompt_bytes = Histogram("ns_prompt_bytes", "Size of the summary prompts in bytes.", ("template",), SIZE_BUCKETS)
+        # Tokens of every summary call, map-phase chunk calls included, as reported by the model (estimated when it reports none)
+        self.prompt_tokens = Histogram("ns_prompt_tokens", "Tokens of the summary call prompts.", ("template",), SIZE_BUCKETS)
+        self.completion_tokens = Histogram("ns_completion_tokens", "Tokens of the summary call completions.", ("template",), SIZE_BUCKETS)
+        self.summary_cache = Counter("ns_summary_cache_requests_total", "Summary cache lookups.", ("template", "result"))
+        self.summaries = Counter("ns_summaries_total", "Summaries generated, by status.", ("template", "status"))
+        # Process-wide caches with hits and misses attributes, read at render time
+        self._caches = {}
+
+    def track_cache(self, name: str, cache: Any) -> None:
+        """Expose the hits and misses counters of a cache."""
+        if hasattr(cache, "hits") and hasattr(cache, "misses"):
+            self._caches[name] = cache
+
+    @contextmanager
+    def time_stage(self, template: str, stage: str) -> Iterator[None]:
+        """Record the duration of the enclosed block as a pipeline stage, also when it raises."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_duration.observe(time.perf_counter() - start_time, template=template, stage=stage)
+
+    @contextmanager
+    def track_summary(self, template: str) -> Iterator[None]:
+        """Record the total duration and the status (ok, error or cancelled) of the summary generated in the enclosed block."""
+        start_time = time.perf_counter()
+        status = "error"
+        try:
+            yield
+            status = "ok"
+        except (GeneratorExit, asyncio.CancelledError):
+            status = "cancelled"
+            raise
+        finally:
+            self.stage_duration.observe(time.perf_counter() - start_time, template=template, stage="total")
+            self.summaries.inc(template=template, status=status)
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in (self.stage_duration, self.rows_returned, self.prompt_bytes, self.prompt_tokens, self.completion_tokens,
+                       self.summary_cache, self.summaries):
+            lines.extend(metric.render())
+        for counter in ("hits", "misses"):
+            lines.extend([f"# HELP ns_cache_{counter}_total Cache {counter} of this process.", f"# TYPE ns_cache_{counter}_total counter"])
+            for name, cache in sorted(self._caches.items()):
+                lines.append(f'ns_cache_{counter}_total{{cache="{name}"}} {getattr(cache, counter)}')
+        return "\n".join(lines) + "\n"
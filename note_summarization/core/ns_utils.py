@@ -1,29 +1,54 @@
 # Import required libraries
 import os
+import json
+import asyncio
 import logging
-import pandas as pd
-from typing import Any
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable
 from core.summarizer import Summarizer
+from core.ingest import ingest_csv_files
+from core.duckdb_engine import export_parquet, stale_parquet_tables
+from core.config import ROOT_DIR
+from core.summary_cache import fingerprint_summary_inputs
+from core.template_library import patient_templates, build_template_registry
 
-def initialize_database(db_path: str, data_dir: str):
-    """Initialize the SQLite database and import CSV files."""
-    os.makedirs(os.path.dirname(db_path), exist_ok=True)
-    conn = sqlite3.connect(db_path)
-    csv_files = [
-        'allergies.csv', 'careplans.csv', 'claims.csv', 'claims_transactions.csv', 'conditions.csv',
-        'devices.csv', 'encounters.csv', 'imaging_studies.csv', 'immunizations.csv', 'medications.csv',
-        'observations.csv', 'organizations.csv', 'patients.csv', 'payer_transitions.csv', 'payers.csv',
-        'procedures.csv', 'providers.csv', 'supplies.csv'
-    ]
-    for file in csv_files:
-        table_name = file.split('.')[0]
-        file_path = f'{data_dir}/{file}'
-        df = pd.read_csv(file_path)
-        df.to_sql(table_name, conn, if_exists='replace', index=False)
-    conn.close()
+# Supported retrieval engines:
+# - text_to_sql: the LLM generates SQL for each sql_template
+# - query_library: prepared queries from template_library.sql_queries, falling back to text_to_sql for templates without one
+RETRIEVAL_ENGINES = ("text_to_sql", "query_library")
+
+# Prompt of the reduce step of map-reduce summarization, followed by the partial summaries (one JSON object per line)
+REDUCE_PROMPT = (
+    "The patient records were too long to be summarized at once, so they were split into parts and every part was "
+    "summarized separately following these instructions:\n{prompt}\n"
+    "Combine the partial summaries below into a single summary following the same instructions. "
+    "Merge duplicate items and keep the most recent information. Partial summaries, one per line:\n"
+)
+
+# Template label of the metrics of the stages shared by the templates of agenerate_patient_summaries
+BATCH_METRICS_LABEL = "batch"
+
+def initialize_database(db_path: str, data_dir: str, full_refresh: bool = False, chunk_size: int = 50000, workers: int = 4, indexes: dict[str, list[list[str]]] = None,
+                        parquet_dir: str = None):
+    """Initialize the SQLite database and import CSV files.
+    Only new and changed files are ingested, full_refresh re-imports every file.
+    If parquet_dir is given (duckdb backend), the changed tables and the tables whose Parquet file is missing or stale
+    are also exported to Parquet files.
+    """
+    tables = ingest_csv_files(db_path=db_path, data_dir=data_dir, full_refresh=full_refresh, chunk_size=chunk_size, workers=workers, indexes=indexes)
+    if parquet_dir is not None:
+        changed_tables = [table_name for table_name, result in tables.items() if result["action"] != "skipped"]
+        export_parquet(db_path, parquet_dir, tables=None if full_refresh else sorted(set(changed_tables) | set(stale_parquet_tables(db_path, parquet_dir))))
     logging.info(f"Database '{db_path}' initialized.")
-    return {"message": "Database initialized and CSV files imported."}
+    return {"message": "Database initialized and CSV files imported.", "tables": tables}
+
+def sync_parquet(db_path: str, parquet_dir: str) -> dict[str, int]:
+    """Export the tables of an existing database whose Parquet file is missing or stale, e.g. when the backend
+    is switched to duckdb after the database was ingested. Returns the number of exported rows per table."""
+    stale_tables = stale_parquet_tables(db_path, parquet_dir)
+    if not stale_tables:
+        return {}
+    return export_parquet(db_path, parquet_dir, tables=stale_tables)
 
 def delete_database(db_path: str):
     """Delete the SQLite database file if it exists, with error handling."""
@@ -36,34 +61,455 @@ def delete_database(db_path: str):
     else:
         logging.info(f"No database file found at: {db_path}")
 
-def generate_patient_summary(note_summarizer: Summarizer, patient_info: dict[str, Any], template: dict[str, Any]) -> dict[str, Any]:
-    """Generate a patient summary using all templates."""
+def get_backend_options(database_config: dict[str, Any]) -> dict[str, Any]:
+    """Return the Summarizer arguments of the configured serving backend: backend, connection_options and parquet_dir (duckdb only)."""
+    backend = database_config.get("backend", "sqlite")
+    if backend == "duckdb":
+        duckdb_config = database_config.get("duckdb") or {}
+        return {
+            "backend": backend,
+            "parquet_dir": str(ROOT_DIR / duckdb_config.get("parquet_dir", "db/parquet")),
+            "connection_options": duckdb_config.get("connection"),
+        }
+    return {"backend": backend, "connection_options": database_config.get("connection")}
+
+def get_retrieval_engine(retrieval_config: dict[str, Any], template_name: str) -> str:
+    """Return the retrieval engine configured for the template, falling back to the default engine."""
+    template_engines = retrieval_config.get("templates") or {}
+    return template_engines.get(template_name, retrieval_config.get("engine", "text_to_sql"))
+
+def get_token_budget(summarization_config: dict[str, Any], template_name: str) -> int | None:
+    """Return the prompt token budget configured for the template, falling back to the default budget. None means no budget."""
+    template_budgets = summarization_config.get("templates") or {}
+    return template_budgets.get(template_name, summarization_config.get("token_budget"))
+
+def get_template_registry(config: dict[str, Any]) -> dict[str, dict[str, Any]]:
+    """Build the registry of populated templates with the configured retrieval engines and token budgets.
+    Raises ValueError at startup on invalid template references or retrieval engines.
+    """
+    retrieval_engines = {template_name: get_retrieval_engine(config.get("retrieval", {}), template_name) for template_name in patient_templates}
+    unknown_engines = {engine for engine in retrieval_engines.values() if engine not in RETRIEVAL_ENGINES}
+    if unknown_engines:
+        raise ValueError(f"Unknown retrieval engines {sorted(unknown_engines)}. Available engines: {', '.join(RETRIEVAL_ENGINES)}.")
+    token_budgets = {template_name: get_token_budget(config.get("summarization", {}), template_name) for template_name in patient_templates}
+    return build_template_registry(retrieval_engines, token_budgets)
+
+def get_patient_context(patient_info: dict[str, Any], patient_id: str) -> tuple[str, str, dict[str, Any]]:
+    """Return the patient details used in SQL prompts, the patient header of the summary prompts and the SQL bind parameters.
+    SQL prompts refer to the resolved patient id, so generated queries filter on the indexed id instead of joining patients by name.
+    """
     first_name = patient_info["first_name"]
     last_name = patient_info["last_name"]
-    patient_details = f"first name is exactly '{first_name}' last name is exactly '{last_name}'"
-    system_prompt = f"Patient first name: {first_name} last name: {last_name}."
-
-    # Format patient details
-    data_formatted=""
-    for sql_prompt in template['sql_prompts']:
-        sql_prompt = sql_prompt.format(patient_details=patient_details)
-        logging.info(f"SQL Prompt: {sql_prompt}") 
-    
-        query = note_summarizer.generate_sql_query(sql_prompt)
-        logging.info(f"Generated SQL Query: {query}")
-       
-        # logging.info("Before executing query")
-        data = note_summarizer.execute_query(query)
-        logging.info(f"After executing query: {len(data)} rows returned\n")
-        if len(data) != 0:
-            data_formatted += note_summarizer.format_data(data)
-        else:    
-            logging.info(f"No data found for {sql_prompt}.")
+    patient_details = f"with patient id exactly '{patient_id}'"
+    patient_header = f"Patient first name: {first_name} last name: {last_name}."
+    # Patient identity value bound to the cached, parameterized SQL queries
+    parameters = {"patient_id": patient_id}
+    return patient_details, patient_header, parameters
+
+def _resolve_patient_id(note_summarizer: Summarizer, patient_info: dict[str, Any], template_id: str) -> str:
+    """Resolve the patient id of the request. Raises ValueError if the patient does not exist."""
+    with note_summarizer.metrics.time_stage(template_id, "resolve_patient"):
+        patient_id = note_summarizer.resolve_patient(patient_info)
+    if patient_id is None:
+        raise ValueError(f"No data found for the patient {patient_info['first_name']} {patient_info['last_name']}.")
+    return patient_id
+
+async def _aresolve_patient_id(note_summarizer: Summarizer, patient_info: dict[str, Any], template_id: str) -> str:
+    """Asynchronous version of _resolve_patient_id."""
+    with note_summarizer.metrics.time_stage(template_id, "resolve_patient"):
+        patient_id = await note_summarizer.aresolve_patient(patient_info)
+    if patient_id is None:
+        raise ValueError(f"No data found for the patient {patient_info['first_name']} {patient_info['last_name']}.")
+    return patient_id
+
+def _get_retrieval_steps(template: dict[str, Any]) -> list[dict[str, Any]]:
+    """Return one retrieval step per sql_prompt of the template, in template order.
+    The step query is the prepared library query when the template uses the query library, None for text-to-SQL.
+    """
+    retrieval_engine = template.get("retrieval_engine", "text_to_sql")
+    if retrieval_engine not in RETRIEVAL_ENGINES:
+        raise ValueError(f"Unknown retrieval engine '{retrieval_engine}'.")
+    sql_prompts = template['sql_prompts']
+    sql_prompt_ids = template.get("sql_prompt_ids", [None] * len(sql_prompts))
+    sql_queries = template.get("sql_queries", [None] * len(sql_prompts))
+    if retrieval_engine != "query_library":
+        sql_queries = [None] * len(sql_prompts)
+    sql_tables = template.get("sql_tables", [None] * len(sql_prompts))
+    return [
+        {"id": sql_prompt_id, "prompt": sql_prompt, "query": sql_query, "tables": table_names}
+        for sql_prompt_id, sql_prompt, sql_query, table_names in zip(sql_prompt_ids, sql_prompts, sql_queries, sql_tables)
+    ]
+
+def _get_template_id(template: dict[str, Any]) -> str:
+    """Return the id of a populated template. Templates without an id (e.g. json_schemas templates) use their name."""
+    return template.get("id") or template["name"]
+
+def _lookup_summary(note_summarizer: Summarizer, template: dict[str, Any], patient_id: str, system_prompt: str, user_prompt: str) -> tuple[str | None, dict[str, Any] | None]:
+    """Look up the summary cache. Returns the data fingerprint of the prompts and the cached summary, if any."""
+    if note_summarizer.summary_cache is None:
+        return None, None
+    data_fingerprint = fingerprint_summary_inputs(system_prompt, user_prompt, template["output_schema"])
+    summary = note_summarizer.summary_cache.get(_get_template_id(template), patient_id, note_summarizer.model_name, data_fingerprint)
+    note_summarizer.metrics.summary_cache.inc(template=_get_template_id(template), result="miss" if summary is None else "hit")
+    if summary is not None:
+        logging.info(f"Summary cache hit for template {_get_template_id(template)}.")
+    return data_fingerprint, summary
+
+def _store_summary(note_summarizer: Summarizer, template: dict[str, Any], patient_id: str, data_fingerprint: str | None, summary: dict[str, Any]) -> None:
+    """Store a generated summary in the summary cache."""
+    if data_fingerprint is not None:
+        note_summarizer.summary_cache.set(_get_template_id(template), patient_id, note_summarizer.model_name, data_fingerprint, summary)
+
+def _join_step_data(step_data: list[str]) -> str:
+    """Join the encoded results of the retrieval steps, separated by a blank line."""
+    return "\n\n".join(data for data in step_data if data)
+
+def _split_over_budget(note_summarizer: Summarizer, prompt: str, data_formatted: str, token_budget: int | None, preamble_size: Callable[[list[str]], int]) -> list[str] | None:
+    """Split the data into chunks of rows whose prompt fits the token budget.
+    The data consists of results separated by blank lines, every result starts with preamble_size(lines) preamble lines
+    (e.g. the CSV header) that are repeated in every chunk containing rows of the result.
+    Returns None if the prompt fits the budget as is, or if the data can not be reduced by splitting (one row per chunk).
+    """
+    if not token_budget or note_summarizer.count_tokens(note_summarizer.generate_user_prompt(prompt, data_formatted)) <= token_budget:
+        return None
+    chunk_budget = max(token_budget - note_summarizer.count_tokens(prompt), 1)
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    row_count = 0
+    for result in data_formatted.split("\n\n"):
+        lines = result.split("\n")
+        size = preamble_size(lines)
+        preamble = lines[:size]
+        preamble_tokens = note_summarizer.count_tokens("\n".join(preamble)) + 2
+        chunk_preamble = False
+        for line in lines[size:]:
+            line_tokens = note_summarizer.count_tokens(line) + 1
+            if chunk and chunk_tokens + line_tokens + (0 if chunk_preamble else preamble_tokens) > chunk_budget:
+                chunks.append("\n".join(chunk).strip("\n"))
+                chunk = []
+                chunk_tokens = 0
+                chunk_preamble = False
+            if not chunk_preamble:
+                chunk.extend(([""] if chunk else []) + preamble)
+                chunk_tokens += preamble_tokens
+                chunk_preamble = True
+            chunk.append(line)
+            chunk_tokens += line_tokens
+            row_count += 1
+    chunks.append("\n".join(chunk).strip("\n"))
+    if len(chunks) >= row_count:
+        logging.warning(f"Prompt over the token budget of {token_budget} tokens can not be reduced any further.")
+        return None
+    logging.info(f"Prompt over the token budget of {token_budget} tokens, summarizing {len(chunks)} chunks.")
+    return chunks
+
+def _no_preamble(lines: list[str]) -> int:
+    """Partial summaries are one JSON object per line, without preamble."""
+    return 0
+
+def summary_prompts(prompt: str, patient_header: str, data: str) -> tuple[str, str]:
+    """Return the system and user prompts of a summary call.
+    Static content comes first: the instructions of the template are the system prompt, the patient header and data follow
+    in the user prompt, so that the provider can reuse its prompt cache for the prefix shared by all the patients.
+    """
+    return prompt, f"{patient_header}\n{data}"
+
+def _prepare_summary_prompt(note_summarizer: Summarizer, patient_header: str, template: dict[str, Any], data_formatted: str) -> tuple[str, str]:
+    """Return the system and user prompts of the final summary call.
+    Data over the token budget of the template is split into chunks that are summarized in parallel (map),
+    the final call then combines the partial summaries (reduce). Partial summaries that are still over the budget are reduced again.
+    """
+    prompt = template["prompt"]
+    preamble_size = note_summarizer.result_encoder.preamble_size
+    while (chunks := _split_over_budget(note_summarizer, prompt, data_formatted, template.get("token_budget"), preamble_size)) is not None:
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            partial_summaries = list(executor.map(
+                lambda chunk: note_summarizer.get_summary_from_openai(*summary_prompts(prompt, patient_header, chunk), template["output_schema"], template_id=_get_template_id(template)),
+                chunks,
+            ))
+        prompt = REDUCE_PROMPT.format(prompt=template["prompt"])
+        data_formatted = "\n".join(json.dumps(partial_summary) for partial_summary in partial_summaries)
+        preamble_size = _no_preamble
+    return summary_prompts(prompt, patient_header, data_formatted)
+
+async def _aprepare_summary_prompt(note_summarizer: Summarizer, patient_header: str, template: dict[str, Any], data_formatted: str) -> tuple[str, str]:
+    """Asynchronous version of _prepare_summary_prompt. Token counting runs in a worker thread."""
+    prompt = template["prompt"]
+    preamble_size = note_summarizer.result_encoder.preamble_size
+    while (chunks := await asyncio.to_thread(_split_over_budget, note_summarizer, prompt, data_formatted, template.get("token_budget"), preamble_size)) is not None:
+        partial_summaries = await asyncio.gather(*[
+            note_summarizer.aget_summary_from_openai(*summary_prompts(prompt, patient_header, chunk), template["output_schema"], template_id=_get_template_id(template))
+            for chunk in chunks
+        ])
+        prompt = REDUCE_PROMPT.format(prompt=template["prompt"])
+        data_formatted = "\n".join(json.dumps(partial_summary) for partial_summary in partial_summaries)
+        preamble_size = _no_preamble
+    return summary_prompts(prompt, patient_header, data_formatted)
+
+def _log_step_data(note_summarizer: Summarizer, template_id: str, step: dict[str, Any], row_count: int, timings: dict[str, float]) -> None:
+    """Log and record the rows returned for a retrieval step and the time spent executing the query and formatting the rows."""
+    metrics = note_summarizer.metrics
+    metrics.stage_duration.observe(timings["execute_s"], template=template_id, stage="execute_query")
+    metrics.stage_duration.observe(timings["format_s"], template=template_id, stage="format_data")
+    metrics.rows_returned.observe(row_count, template=template_id)
+    logging.info(f"After executing query: {row_count} rows returned in {(timings['execute_s'] + timings['format_s']) * 1000:.1f} ms\n")
+    if row_count == 0:
+        logging.info(f"No data found for {step['prompt']}.")
+
+def _log_summary_prompt(note_summarizer: Summarizer, template_id: str, system_prompt: str, summary_prompt: str) -> None:
+    """Record the size of the final summary prompt. The tokens of every summary call are recorded by the Summarizer."""
+    metrics = note_summarizer.metrics
+    metrics.prompt_bytes.observe(len(system_prompt.encode("utf-8")) + len(summary_prompt.encode("utf-8")), template=template_id)
+
+def _library_query(step: dict[str, Any], patient_details: str, patient_id: str) -> tuple[str, dict[str, Any]] | None:
+    """Return the prepared query and parameters of a query library step, or None for a text-to-SQL step."""
+    if step["query"]:
+        # Prepared query from the query library, no LLM call needed
+        logging.info(f"Library SQL Query: {step['id']}")
+        return step["query"], {"patient_id": patient_id}
+    # Fall back to text-to-SQL for templates without a library query
+    logging.info(f"SQL Prompt: {step['prompt'].format(patient_details=patient_details)}")
+    return None
+
+def _summary_inputs(patient_info: dict[str, Any], template: dict[str, Any], patient_header: str, step_data: list[str]) -> tuple[str, str, str]:
+    """Join the data of the retrieval steps and return it with the system and user prompts of the summary cache lookup."""
+    data_formatted = _join_step_data(step_data)
     if len(data_formatted) == 0:
-        raise ValueError(f"No data found for the patient {first_name} {last_name}.")
+        raise ValueError(f"No data found for the patient {patient_info['first_name']} {patient_info['last_name']}.")
+    return (data_formatted, *summary_prompts(template["prompt"], patient_header, data_formatted))
+
+def _record_summary(note_summarizer: Summarizer, template: dict[str, Any], patient_id: str, data_fingerprint: str | None, system_prompt: str, summary_prompt: str, summary: dict[str, Any]) -> None:
+    """Record the prompt metrics of a generated summary and store it in the summary cache."""
+    _log_summary_prompt(note_summarizer, _get_template_id(template), system_prompt, summary_prompt)
+    _store_summary(note_summarizer, template, patient_id, data_fingerprint, summary)
+
+async def _agather_steps(coroutines: list[Awaitable[str]]) -> list[str]:
+    """Run the retrieval steps concurrently and return their results in order.
+    When a step fails, the steps still running are cancelled before the exception is raised.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+def _missing_tables(note_summarizer: Summarizer, step: dict[str, Any]) -> list[str]:
+    """Return the tables of a retrieval step that are not in the database (e.g. a CSV file that was never ingested).
+    Steps with missing tables are skipped and contribute no data, instead of failing the whole template.
+    """
+    usable_tables = note_summarizer.db.get_usable_table_names()
+    missing_tables = [table for table in step["tables"] or [] if table not in usable_tables]
+    if missing_tables:
+        logging.info(f"No data found for {step['prompt']}: missing tables {', '.join(missing_tables)}.")
+    return missing_tables
+
+def _retrieve_step_data(note_summarizer: Summarizer, step: dict[str, Any], patient_details: str, parameters: dict[str, Any], patient_id: str, template_id: str) -> str:
+    """Retrieve and format the data for a single sql_prompt."""
+    if _missing_tables(note_summarizer, step):
+        return ""
+    library_query = _library_query(step, patient_details, patient_id)
+    if library_query is not None:
+        query, query_parameters = library_query
+    else:
+        with note_summarizer.metrics.time_stage(template_id, "generate_sql"):
+            query, query_parameters = note_summarizer.generate_patient_sql_query(step["prompt"], patient_details, parameters, step["id"], step["tables"])
+        logging.info(f"Generated SQL Query: {query}")
+
+    # Rows are formatted as they are fetched, the raw result set is never held in memory
+    timings = {}
+    data_formatted, row_count = note_summarizer.execute_query_formatted(query, query_parameters, timings=timings)
+    _log_step_data(note_summarizer, template_id, step, row_count, timings)
+    return data_formatted
+
+async def _aretrieve_step_data(note_summarizer: Summarizer, step: dict[str, Any], patient_details: str, parameters: dict[str, Any], patient_id: str, template_id: str, events: asyncio.Queue = None) -> str:
+    """Asynchronous version of _retrieve_step_data. Progress events are put on the events queue, if provided."""
+    missing_tables = _missing_tables(note_summarizer, step)
+    if missing_tables:
+        if events is not None:
+            events.put_nowait(("rows_fetched", {"sql_prompt_id": step["id"], "rows": 0, "elapsed_ms": 0.0, "missing_tables": missing_tables}))
+        return ""
+    library_query = _library_query(step, patient_details, patient_id)
+    if library_query is not None:
+        query, query_parameters = library_query
+    else:
+        with note_summarizer.metrics.time_stage(template_id, "generate_sql"):
+            query, query_parameters = await note_summarizer.agenerate_patient_sql_query(step["prompt"], patient_details, parameters, step["id"], step["tables"])
+        logging.info(f"Generated SQL Query: {query}")
+    if events is not None:
+        events.put_nowait(("sql_generated", {"sql_prompt_id": step["id"], "query": query}))
+
+    timings = {}
+    data_formatted, row_count = await note_summarizer.aexecute_query_formatted(query, query_parameters, timings=timings)
+    elapsed_ms = (timings["execute_s"] + timings["format_s"]) * 1000
+    if events is not None:
+        events.put_nowait(("rows_fetched", {"sql_prompt_id": step["id"], "rows": row_count, "elapsed_ms": round(elapsed_ms, 1)}))
+    _log_step_data(note_summarizer, template_id, step, row_count, timings)
+    return data_formatted
+
+def generate_patient_summary(note_summarizer: Summarizer, patient_info: dict[str, Any], template: dict[str, Any]) -> dict[str, Any]:
+    """Generate a patient summary using all templates."""
+    steps = _get_retrieval_steps(template)
+    template_id = _get_template_id(template)
+    metrics = note_summarizer.metrics
+
+    with metrics.track_summary(template_id):
+        # Resolve the patient once, retrieval steps and the summary cache are keyed by patient id
+        patient_id = _resolve_patient_id(note_summarizer, patient_info, template_id)
+        patient_details, patient_header, parameters = get_patient_context(patient_info, patient_id)
+
+        # Format patient details
+        data_formatted, system_prompt, user_prompt = _summary_inputs(patient_info, template, patient_header, [
+            _retrieve_step_data(note_summarizer, step, patient_details, parameters, patient_id, template_id) for step in steps
+        ])
+        #logging.info(f"User Prompt: {user_prompt}")
+        data_fingerprint, summary = _lookup_summary(note_summarizer, template, patient_id, system_prompt, user_prompt)
+        if summary is None:
+            with metrics.time_stage(template_id, "prepare_prompt"):
+                system_prompt, summary_prompt = _prepare_summary_prompt(note_summarizer, patient_header, template, data_formatted)
+            with metrics.time_stage(template_id, "summary_llm"):
+                summary = note_summarizer.get_summary_from_openai(system_prompt, summary_prompt, template["output_schema"], template_id=template_id)
+            _record_summary(note_summarizer, template, patient_id, data_fingerprint, system_prompt, summary_prompt, summary)
+
+    return summary
+
+def _summary_flight_key(note_summarizer: Summarizer, patient_info: dict[str, Any], template: dict[str, Any]) -> tuple:
+    """Return the key of a summary request: patient, template (with its retrieval engine and token budget) and data generation."""
+    patient = (patient_info["first_name"], patient_info["last_name"], patient_info.get("patient_id"))
+    return (note_summarizer.data_generation, patient, _get_template_id(template), template.get("retrieval_engine"), template.get("token_budget"))
+
+async def agenerate_patient_summary(note_summarizer: Summarizer, patient_info: dict[str, Any], template: dict[str, Any],
+                                    before_summary: Callable[[], Awaitable[None]] = None) -> dict[str, Any]:
+    """Generate a patient summary, running the retrieval steps of the template concurrently.
+    Concurrent requests for the same patient and template share one pipeline run and its summary.
+    before_summary is awaited between the retrieval and the summary cache lookup (e.g. pre-warming waits for live
+    requests there). Such runs are not shared: a live request never waits for a pre-warm run yielding to it.
+    """
+    if before_summary is not None:
+        return await _agenerate_patient_summary(note_summarizer, patient_info, template, before_summary)
+    key = _summary_flight_key(note_summarizer, patient_info, template)
+    return await note_summarizer.summary_flights.run(key, lambda: _agenerate_patient_summary(note_summarizer, patient_info, template))
+
+async def _agenerate_patient_summary(note_summarizer: Summarizer, patient_info: dict[str, Any], template: dict[str, Any],
+                                     before_summary: Callable[[], Awaitable[None]] = None) -> dict[str, Any]:
+    steps = _get_retrieval_steps(template)
+    template_id = _get_template_id(template)
+    metrics = note_summarizer.metrics
+
+    with metrics.track_summary(template_id):
+        patient_id = await _aresolve_patient_id(note_summarizer, patient_info, template_id)
+        patient_details, patient_header, parameters = get_patient_context(patient_info, patient_id)
+
+        # The results come back in template order regardless of completion order
+        step_data = await _agather_steps([
+            _aretrieve_step_data(note_summarizer, step, patient_details, parameters, patient_id, template_id) for step in steps
+        ])
+        data_formatted, system_prompt, user_prompt = _summary_inputs(patient_info, template, patient_header, step_data)
+        if before_summary is not None:
+            # A summary generated meanwhile by a live request is a cache hit
+            await before_summary()
+        data_fingerprint, summary = await asyncio.to_thread(_lookup_summary, note_summarizer, template, patient_id, system_prompt, user_prompt)
+        if summary is None:
+            with metrics.time_stage(template_id, "prepare_prompt"):
+                system_prompt, summary_prompt = await _aprepare_summary_prompt(note_summarizer, patient_header, template, data_formatted)
+            with metrics.time_stage(template_id, "summary_llm"):
+                summary = await note_summarizer.aget_summary_from_openai(system_prompt, summary_prompt, template["output_schema"], template_id=template_id)
+            await asyncio.to_thread(_record_summary, note_summarizer, template, patient_id, data_fingerprint, system_prompt, summary_prompt, summary)
+
+    return summary
+
+async def astream_patient_summary(note_summarizer: Summarizer, patient_info: dict[str, Any], template: dict[str, Any]) -> AsyncIterator[tuple[str, dict[str, Any]]]:
+    """Generate a patient summary, yielding (event, data) progress events as the pipeline runs:
+    sql_generated and rows_fetched for every retrieval step (rows_fetched with missing_tables for a step skipped because
+    its tables are not in the database), summary_partial while the summary is streamed, and finally summary with the complete structured output.
+    """
+    steps = _get_retrieval_steps(template)
+    template_id = _get_template_id(template)
+    metrics = note_summarizer.metrics
+
+    with metrics.track_summary(template_id):
+        patient_id = await _aresolve_patient_id(note_summarizer, patient_info, template_id)
+        patient_details, patient_header, parameters = get_patient_context(patient_info, patient_id)
+
+        # Retrieval steps run concurrently and report their progress through the queue, None marks the end.
+        # Cancelling the retrieval (failed step or closed stream) cancels the steps still running.
+        events = asyncio.Queue()
+        retrieval = asyncio.ensure_future(_agather_steps([
+            _aretrieve_step_data(note_summarizer, step, patient_details, parameters, patient_id, template_id, events) for step in steps
+        ]))
+        retrieval.add_done_callback(lambda _: events.put_nowait(None))
+        try:
+            while (event := await events.get()) is not None:
+                yield event
+        finally:
+            if not retrieval.done():
+                retrieval.cancel()
+        data_formatted, system_prompt, user_prompt = _summary_inputs(patient_info, template, patient_header, await retrieval)
+        data_fingerprint, summary = await asyncio.to_thread(_lookup_summary, note_summarizer, template, patient_id, system_prompt, user_prompt)
+        if summary is None:
+            summary = {}
+            with metrics.time_stage(template_id, "prepare_prompt"):
+                system_prompt, summary_prompt = await _aprepare_summary_prompt(note_summarizer, patient_header, template, data_formatted)
+            # The streamed stage includes the time the client takes to consume the partial summaries
+            with metrics.time_stage(template_id, "summary_llm"):
+                async for summary in note_summarizer.astream_summary_from_openai(system_prompt, summary_prompt, template["output_schema"], template_id=template_id):
+                    yield ("summary_partial", summary)
+            await asyncio.to_thread(_record_summary, note_summarizer, template, patient_id, data_fingerprint, system_prompt, summary_prompt, summary)
+        yield ("summary", summary)
+
+async def agenerate_patient_summaries(note_summarizer: Summarizer, patient_info: dict[str, Any], templates: dict[str, dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    """Generate summaries for several templates of the same patient.
+    Retrieval steps shared by the templates run only once, then the summaries are generated concurrently.
+    A template that fails gets an {"error": ...} section instead of failing the whole batch.
+    """
+
+    # Union of the retrieval steps of all templates, keyed by sql_prompt id (or prompt text) and retrieval engine
+    unique_steps = {}
+    template_step_keys = {}
+    for template_name, template in templates.items():
+        template_step_keys[template_name] = []
+        for step in _get_retrieval_steps(template):
+            key = (step["id"] or step["prompt"], bool(step["query"]))
+            unique_steps.setdefault(key, step)
+            template_step_keys[template_name].append(key)
+
+    patient_id = await _aresolve_patient_id(note_summarizer, patient_info, BATCH_METRICS_LABEL)
+    patient_details, patient_header, parameters = get_patient_context(patient_info, patient_id)
+
+    logging.info(f"Running {len(unique_steps)} unique retrieval steps for {len(templates)} templates.")
+    step_results = await asyncio.gather(*[
+        _aretrieve_step_data(note_summarizer, step, patient_details, parameters, patient_id, BATCH_METRICS_LABEL) for step in unique_steps.values()
+    ], return_exceptions=True)
+    step_data = dict(zip(unique_steps, step_results))
 
-    user_prompt = note_summarizer.generate_user_prompt(template["prompt"], data_formatted)
-    #logging.info(f"User Prompt: {user_prompt}")
-    summary = note_summarizer.get_summary_from_openai(system_prompt, user_prompt, template["output_schema"])
+    async def summarize(template_name: str) -> dict[str, Any]:
+        template = templates[template_name]
+        template_id = _get_template_id(template)
+        metrics = note_summarizer.metrics
+        # The total of a template does not include the shared patient resolution and retrieval steps
+        with metrics.track_summary(template_id):
+            data = [step_data[key] for key in template_step_keys[template_name]]
+            for result in data:
+                if isinstance(result, Exception):
+                    raise result
+            data_formatted, system_prompt, user_prompt = _summary_inputs(patient_info, template, patient_header, data)
+            data_fingerprint, summary = await asyncio.to_thread(_lookup_summary, note_summarizer, template, patient_id, system_prompt, user_prompt)
+            if summary is None:
+                with metrics.time_stage(template_id, "prepare_prompt"):
+                    system_prompt, summary_prompt = await _aprepare_summary_prompt(note_summarizer, patient_header, template, data_formatted)
+                with metrics.time_stage(template_id, "summary_llm"):
+                    summary = await note_summarizer.aget_summary_from_openai(system_prompt, summary_prompt, template["output_schema"], template_id=template_id)
+                await asyncio.to_thread(_record_summary, note_summarizer, template, patient_id, data_fingerprint, system_prompt, summary_prompt, summary)
+        return summary
 
-    return summary
\ No newline at end of file
+    results = await asyncio.gather(*[summarize(template_name) for template_name in templates], return_exceptions=True)
+    summaries = {}
+    for template_name, result in zip(templates, results):
+        if isinstance(result, Exception):
+            logging.error(f"Error generating summary for template {template_name}: {result}")
+            summaries[template_name] = {"error": str(result)}
+        else:
+            summaries[template_name] = result
+    return summaries
@@ -0,0 +1,60 @@
+# This module implements the patient identity resolution stage of the summary pipeline.
+# The patient_info of a request is mapped to the patient id once, through an indexed lookup on the patients table,
+# and the mapping is kept in a bounded LRU cache shared by all requests of the process.
+# Retrieval then filters on the patient id instead of joining patients by name in every query.
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+
+class PatientResolver:
+    """Resolves patient_info to a patient id, caching the name-to-id mapping in a bounded LRU cache."""
+
+    def __init__(self, lookup: Callable[[str, str], str | None], max_entries: int = 1024):
+        """lookup(first_name, last_name) returns the patient id or None if the patient does not exist."""
+        self.lookup = lookup
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def _make_key(patient_info: dict[str, Any]) -> tuple[str, str]:
+        return (patient_info["first_name"], patient_info["last_name"])
+
+    def get_cached(self, patient_info: dict[str, Any]) -> str | None:
+        """Return the patient id if it is given in patient_info or already cached, None otherwise."""
+        if patient_info.get("patient_id"):
+            return patient_info["patient_id"]
+        key = self._make_key(patient_info)
+        with self._lock:
+            patient_id = self._cache.get(key)
+            if patient_id is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            return patient_id
+
+    def resolve(self, patient_info: dict[str, Any]) -> str | None:
+        """Return the patient id of patient_info, or None if the patient does not exist.
+        Unknown patients are not cached, so patients ingested later are found.
+        """
+        patient_id = self.get_cached(patient_info)
+        if patient_id is not None:
+            return patient_id
+        key = self._make_key(patient_info)
+        patient_id = self.lookup(*key)
+        with self._lock:
+            self.misses += 1
+            if patient_id is not None:
+                self._cache[key] = patient_id
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        return patient_id
+
+    def clear(self) -> None:
+        """Remove all cached mappings, e.g. after the patients table was re-ingested."""
+        with self._lock:
+            self._cache.clear()
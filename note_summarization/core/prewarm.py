@@ -0,0 +1,150 @@
+# This module implements the pre-warming of the summary cache from an appointment schedule.
+# A schedule lists the patients of upcoming visits (first_name, last_name, optional patient_id, visit_time), as a CSV
+# or JSON file. The visits in the pre-warm horizon are summarized ahead of time, earliest visit first, with the
+# configured templates, so that opening the patient in clinic is a summary cache hit.
+# Pre-warming runs one summary at a time, at most max_per_minute summaries per minute, and only while no live
+# request is being served: it waits as long as LiveTraffic reports requests in progress, before every summary and
+# again between its retrieval and its summary LLM call.
+
+import os
+import csv
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable
+
+from core.summarizer import Summarizer
+from core.ns_utils import agenerate_patient_summary
+
+SCHEDULE_FIELDS = ("first_name", "last_name", "visit_time")
+
+
+class LiveTraffic:
+    """Counts the live requests in progress. Used as an async context manager around request handling."""
+
+    def __init__(self):
+        self.active = 0
+
+    async def __aenter__(self) -> "LiveTraffic":
+        self.active += 1
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        self.active -= 1
+
+
+def _local_datetime(value: str | datetime) -> datetime:
+    """Parse an ISO visit time. Times with a timezone are converted to naive local time."""
+    visit_time = value if isinstance(value, datetime) else datetime.fromisoformat(str(value).strip())
+    return visit_time.astimezone().replace(tzinfo=None) if visit_time.tzinfo else visit_time
+
+
+def parse_schedule(visits: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Validate the visits of a schedule. Raises ValueError on a visit without name, with a value that is not a string
+    (e.g. a number in a JSON schedule) or with an invalid visit time.
+    """
+    if not isinstance(visits, list):
+        raise ValueError("The schedule must be a list of visits.")
+    schedule = []
+    for index, visit in enumerate(visits):
+        if not isinstance(visit, dict):
+            raise ValueError(f"Visit {index + 1} of the schedule is not an object.")
+        missing = [field for field in SCHEDULE_FIELDS if not visit.get(field)]
+        if missing:
+            raise ValueError(f"Visit {index + 1} of the schedule is missing {', '.join(missing)}.")
+        invalid = [field for field in ("first_name", "last_name", "patient_id") if visit.get(field) and not isinstance(visit[field], str)]
+        if not isinstance(visit["visit_time"], (str, datetime)):
+            invalid.append("visit_time")
+        if invalid:
+            raise ValueError(f"Visit {index + 1} of the schedule has non-string {', '.join(invalid)}.")
+        try:
+            visit_time = _local_datetime(visit["visit_time"])
+        except ValueError:
+            raise ValueError(f"Visit {index + 1} of the schedule has an invalid visit_time '{visit['visit_time']}'.")
+        patient_info = {"first_name": visit["first_name"].strip(), "last_name": visit["last_name"].strip()}
+        if visit.get("patient_id"):
+            patient_info["patient_id"] = visit["patient_id"].strip()
+        schedule.append({"patient_info": patient_info, "visit_time": visit_time})
+    return schedule
+
+
+def load_schedule(path: str) -> list[dict[str, Any]]:
+    """Load a schedule from a .json file (list of visits) or a .csv file with a header row."""
+    with open(path, "r", newline="", encoding="utf-8") as file:
+        if os.path.splitext(path)[1].lower() == ".json":
+            visits = json.load(file)
+        else:
+            visits = list(csv.DictReader(file))
+    return parse_schedule(visits)
+
+
+def select_due_visits(schedule: list[dict[str, Any]], horizon_hours: float, now: datetime = None) -> list[dict[str, Any]]:
+    """Return the visits from now to now + horizon_hours, earliest first, once per patient."""
+    now = now or datetime.now()
+    end = now + timedelta(hours=horizon_hours)
+    due = {}
+    for visit in sorted(schedule, key=lambda visit: visit["visit_time"]):
+        key = (visit["patient_info"].get("patient_id"), visit["patient_info"]["first_name"], visit["patient_info"]["last_name"])
+        if now <= visit["visit_time"] <= end:
+            due.setdefault(key, visit)
+    return list(due.values())
+
+
+class PrewarmJob:
+    """Generates the summaries of scheduled visits into the summary cache, rate capped and yielding to live traffic."""
+
+    def __init__(self, note_summarizer: Summarizer, templates: dict[str, dict[str, Any]], max_per_minute: float = 30,
+                 is_busy: Callable[[], bool] = None, idle_poll_s: float = 0.5):
+        """
+        Args:
+            note_summarizer (Summarizer): Summarizer with the summary cache to warm.
+            templates (dict): Populated templates to generate, by template name.
+            max_per_minute (float): Maximum number of summaries started per minute.
+            is_busy (Callable): Returns True while live requests are served, pre-warming waits until it returns False.
+            idle_poll_s (float): Seconds between two is_busy checks.
+        """
+        self.note_summarizer = note_summarizer
+        self.templates = templates
+        self.min_interval_s = 60 / max_per_minute if max_per_minute else 0
+        self.is_busy = is_busy or (lambda: False)
+        self.idle_poll_s = idle_poll_s
+        self.status = {"state": "idle", "visits": 0, "jobs": 0, "ok": 0, "error": 0, "started_at": None, "finished_at": None}
+
+    async def _wait_for_turn(self, last_start: float | None) -> None:
+        if last_start is not None:
+            await asyncio.sleep(max(0.0, last_start + self.min_interval_s - time.monotonic()))
+        await self._wait_for_idle()
+
+    async def _wait_for_idle(self) -> None:
+        while self.is_busy():
+            await asyncio.sleep(self.idle_poll_s)
+
+    async def run(self, visits: list[dict[str, Any]]) -> dict[str, Any]:
+        """Generate the summaries of the visits. Returns the status of the run."""
+        jobs = [(visit, template_name) for visit in visits for template_name in self.templates]
+        self.status = {"state": "running", "visits": len(visits), "jobs": len(jobs), "ok": 0, "error": 0,
+                       "started_at": datetime.now(timezone.utc).isoformat(), "finished_at": None}
+        logging.info(f"Pre-warming {len(jobs)} summaries of {len(visits)} scheduled visits.")
+        last_start = None
+        try:
+            for visit, template_name in jobs:
+                await self._wait_for_turn(last_start)
+                last_start = time.monotonic()
+                try:
+                    # Live requests that started during the retrieval are also waited for before the summary LLM call
+                    await agenerate_patient_summary(self.note_summarizer, patient_info=visit["patient_info"], template=self.templates[template_name],
+                                                    before_summary=self._wait_for_idle)
+                    self.status["ok"] += 1
+                except Exception as e:
+                    self.status["error"] += 1
+                    logging.error(f"Error pre-warming template {template_name} for patient {visit['patient_info']}: {e}")
+            self.status["state"] = "finished"
+        except asyncio.CancelledError:
+            self.status["state"] = "cancelled"
+            raise
+        finally:
+            self.status["finished_at"] = datetime.now(timezone.utc).isoformat()
+            logging.info(f"Pre-warming {self.status['state']}: {self.status['ok']} summaries generated, {self.status['error']} failed.")
+        return self.status
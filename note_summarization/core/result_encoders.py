@@ -0,0 +1,161 @@
+# This module implements the encoders that serialize query results into the LLM prompt.
+# - plain: one comma separated line per row, without column names (the original format)
+# - csv: CSV with a header row
+# - dictionary: CSV with a header row. Columns with the same value in every row are written once above the table,
+#   and long values repeated across rows (ids, descriptions, codes) are replaced by short @n references defined once.
+# Encoders write the row batches of a result to a text buffer as they are fetched. The dictionary encoder needs the
+# value counts of the whole result, so it buffers the rows of one result before writing them.
+#
+# Every encoded result starts with a preamble (column names, constants, references) followed by one line per row.
+# Line breaks inside values are written as \n, so every row and every preamble definition is exactly one line.
+# The preamble is repeated in every chunk when a result is split to fit a token budget.
+
+import io
+import csv
+from collections import Counter
+from typing import Any, Iterable, Sequence
+
+from core.tokens import count_tokens
+
+# Separator of the name and the value of a dictionary preamble definition, e.g. "patient = 1d6f..." or "@1 = Chronic pain"
+DEFINITION_SEPARATOR = " = "
+
+
+def _single_line(value: Any) -> Any:
+    """Return the value with its line breaks escaped, so that it is written on one line."""
+    if isinstance(value, str) and ("\n" in value or "\r" in value):
+        return value.replace("\r\n", "\\n").replace("\r", "\\n").replace("\n", "\\n")
+    return value
+
+
+def _single_line_rows(rows: Sequence[tuple]) -> Iterable[tuple]:
+    return (tuple(_single_line(value) for value in row) for row in rows)
+
+
+class ResultEncoder:
+    """Base class of the query result encoders."""
+
+    name = None
+
+    def encode(self, columns: Sequence[str], batches: Iterable[Sequence[tuple]]) -> tuple[str, int]:
+        """Encode the row batches of a query result. Returns the encoded text and the number of rows."""
+        raise NotImplementedError
+
+    def preamble_size(self, lines: list[str]) -> int:
+        """Return the number of preamble lines of an encoded result."""
+        return 0
+
+
+class PlainEncoder(ResultEncoder):
+    """Comma separated values without column names."""
+
+    name = "plain"
+
+    def encode(self, columns: Sequence[str], batches: Iterable[Sequence[tuple]]) -> tuple[str, int]:
+        buffer = io.StringIO()
+        row_count = 0
+        for rows in batches:
+            for row in rows:
+                if row_count:
+                    buffer.write("\n")
+                buffer.write(", ".join(str(_single_line(value)) for value in row))
+                row_count += 1
+        return buffer.getvalue(), row_count
+
+
+class CsvEncoder(ResultEncoder):
+    """CSV with a header row. Missing values are empty fields."""
+
+    name = "csv"
+
+    def encode(self, columns: Sequence[str], batches: Iterable[Sequence[tuple]]) -> tuple[str, int]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        row_count = 0
+        for rows in batches:
+            if rows and not row_count:
+                writer.writerow([_single_line(column) for column in columns])
+            writer.writerows(_single_line_rows(rows))
+            row_count += len(rows)
+        return buffer.getvalue().rstrip("\n"), row_count
+
+    def preamble_size(self, lines: list[str]) -> int:
+        return 1 if lines else 0
+
+
+class DictionaryEncoder(ResultEncoder):
+    """CSV with constant columns hoisted above the table and repeated long values replaced by references.
+    The preamble is written from the constant columns and references: one "name = value" definition per line, then the header row.
+    """
+
+    name = "dictionary"
+
+    def __init__(self, min_length: int = 8, min_count: int = 2):
+        """Values shorter than min_length characters or occurring less than min_count times are written as is."""
+        self.min_length = min_length
+        self.min_count = min_count
+
+    def encode(self, columns: Sequence[str], batches: Iterable[Sequence[tuple]]) -> tuple[str, int]:
+        rows = [row for batch in batches for row in batch]
+        if not rows:
+            return "", 0
+        columns = [str(_single_line(column)) for column in columns]
+        values = [["" if value is None else str(_single_line(value)) for value in row] for row in rows]
+
+        # Columns with a single value (e.g. the patient id) are written once, if their name reads as a definition name
+        constant_columns = [] if len(values) == 1 else [
+            index for index in range(len(columns))
+            if _is_definition_name(columns[index]) and all(row[index] == values[0][index] for row in values)
+        ]
+        table_columns = [index for index in range(len(columns)) if index not in constant_columns]
+
+        # References for the long values repeated in the remaining columns, numbered by first occurrence
+        counts = Counter(row[index] for row in values for index in table_columns if len(row[index]) >= self.min_length)
+        references = {}
+        for row in values:
+            for index in table_columns:
+                value = row[index]
+                if counts[value] >= self.min_count and value not in references:
+                    references[value] = f"@{len(references) + 1}"
+
+        buffer = io.StringIO()
+        for index in constant_columns:
+            buffer.write(f"{columns[index]}{DEFINITION_SEPARATOR}{values[0][index]}\n")
+        for value, reference in references.items():
+            buffer.write(f"{reference}{DEFINITION_SEPARATOR}{value}\n")
+        header = [columns[index] for index in table_columns]
+        # A header row that could read as a definition is quoted
+        header_quoting = csv.QUOTE_ALL if any(DEFINITION_SEPARATOR in column for column in header) else csv.QUOTE_MINIMAL
+        csv.writer(buffer, lineterminator="\n", quoting=header_quoting).writerow(header)
+        writer = csv.writer(buffer, lineterminator="\n")
+        for row in values:
+            writer.writerow([references.get(row[index], row[index]) for index in table_columns])
+        return buffer.getvalue().rstrip("\n"), len(rows)
+
+    def preamble_size(self, lines: list[str]) -> int:
+        for index, line in enumerate(lines):
+            name, separator, _ = line.partition(DEFINITION_SEPARATOR)
+            if not separator or not _is_definition_name(name):
+                # Header row
+                return index + 1
+        return len(lines)
+
+
+def _is_definition_name(name: str) -> bool:
+    """Names of the preamble definitions: column names and references that can not be mistaken for a CSV header row."""
+    return bool(name) and not any(character in name for character in ',"') and DEFINITION_SEPARATOR not in name
+
+
+RESULT_ENCODERS = {encoder.name: encoder for encoder in (PlainEncoder, CsvEncoder, DictionaryEncoder)}
+
+
+def get_result_encoder(name: str) -> ResultEncoder:
+    """Return the result encoder registered under the name."""
+    if name not in RESULT_ENCODERS:
+        raise ValueError(f"Unknown result encoding '{name}'. Available encodings: {', '.join(RESULT_ENCODERS)}.")
+    return RESULT_ENCODERS[name]()
+
+
+def count_encoding_tokens(columns: Sequence[str], rows: Sequence[tuple], model_name: str = "gpt-4o") -> dict[str, Any]:
+    """Encode a query result with every encoder and return the number of prompt tokens of each encoding."""
+    return {name: count_tokens(encoder().encode(columns, [rows])[0], model_name) for name, encoder in RESULT_ENCODERS.items()}
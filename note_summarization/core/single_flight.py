@@ -0,0 +1,49 @@
+# This module implements single-flight coalescing of identical concurrent computations.
+# The first caller of a key starts the computation as a task, callers arriving with the same key while it is in flight
+# await the same task and share its result or exception. The key is released as soon as the task finishes, so later
+# callers start a new computation (results are not cached here, see the SQL and summary caches).
+# A cancelled caller (e.g. a disconnected client) does not cancel the computation the other callers are waiting for.
+
+import asyncio
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one in-flight computation."""
+
+    def __init__(self, name: str):
+        self.name = name
+        # Callers that started a computation (misses) and callers that joined one in flight (hits)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._tasks = {}
+
+    async def run(self, key: Hashable, function: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the result of function(), shared with the concurrent callers of the same key."""
+        with self._lock:
+            task = self._tasks.get(key)
+            if task is None:
+                self.misses += 1
+                task = asyncio.ensure_future(function())
+                self._tasks[key] = task
+                task.add_done_callback(lambda done_task: self._release(key, done_task))
+            else:
+                self.hits += 1
+                logging.info(f"Joined in-flight {self.name} computation.")
+        return await asyncio.shield(task)
+
+    def _release(self, key: Hashable, task: asyncio.Future) -> None:
+        with self._lock:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+        # Retrieve the exception of a computation all callers gave up on, so it is not reported as never retrieved
+        if not task.cancelled():
+            task.exception()
+
+    def in_flight(self) -> int:
+        """Return the number of computations in flight."""
+        with self._lock:
+            return len(self._tasks)
@@ -0,0 +1,96 @@
+# This module implements a persistent cache for SQL queries generated by the LLM.
+# Generated queries are stored with the patient identity replaced by named bind parameters (e.g. :patient_id),
+# so that a query generated for one patient can be reused for any other patient without an LLM round trip.
+# Entries are keyed by sql_template id, sql_template text, database schema fingerprint, model name and bind parameter names.
+
+import os
+import re
+import hashlib
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Any
+
+_SQL_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+def parameterize_query(query: str, parameters: dict[str, Any]) -> str | None:
+    """Replace the quoted patient values in the query with named bind parameters.
+    Returns None if the query can not be safely parameterized, e.g. when a value is used in a LIKE pattern.
+    """
+    parameterized_query = query
+    for name, value in parameters.items():
+        value = str(value)
+        if not value:
+            return None
+        # SQLite string literal of the value, with embedded single quotes escaped
+        literal = "'" + value.replace("'", "''") + "'"
+        if literal not in parameterized_query:
+            return None
+        parameterized_query = parameterized_query.replace(literal, f":{name}")
+        # A leftover occurrence inside another literal (e.g. '%Lupe126%') means the value can not be bound
+        for remaining_literal in _SQL_STRING_LITERAL.findall(parameterized_query):
+            if value.lower() in remaining_literal.lower():
+                return None
+    return parameterized_query
+
+
+class SQLQueryCache:
+    """Persistent SQLite-file based cache of parameterized SQL queries."""
+
+    def __init__(self, cache_path: str):
+        """Open (or create) the cache database file."""
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.cache_path = cache_path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # The cache file is shared by the worker threads and processes
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS sql_cache (
+                key TEXT PRIMARY KEY,
+                sql_template_id TEXT,
+                schema_fingerprint TEXT,
+                model_name TEXT,
+                query TEXT NOT NULL,
+                created_at TEXT
+            )"""
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(sql_template_id: str | None, sql_template: str, schema_fingerprint: str, model_name: str, parameter_names: list[str] = ()) -> str:
+        """Build the cache key. The template text is part of the key so that edited templates are regenerated.
+        The bind parameter names are part of the key, as queries filtering by name and by patient id are not interchangeable.
+        """
+        template_hash = hashlib.sha256(sql_template.encode("utf-8")).hexdigest()
+        return "|".join([sql_template_id or "", template_hash, schema_fingerprint, model_name, ",".join(sorted(parameter_names))])
+
+    def get(self, key: str) -> str | None:
+        """Return the cached parameterized query or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT query FROM sql_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, query: str, sql_template_id: str | None, schema_fingerprint: str, model_name: str) -> None:
+        """Store a parameterized query."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sql_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (key, sql_template_id, schema_fingerprint, model_name, query, datetime.now(timezone.utc).isoformat()),
+            )
+            self._conn.commit()
+        logging.info(f"Cached parameterized SQL query for sql_template '{sql_template_id}'.")
+
+    def close(self) -> None:
+        """Close the cache database connection."""
+        with self._lock:
+            self._conn.close()
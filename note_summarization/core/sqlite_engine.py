@@ -0,0 +1,73 @@
+# This module creates the SQLAlchemy engine used by the Summarizer to read the patient database.
+# In read-only serving mode connections are opened with a read-only (optionally immutable) URI and query_only set,
+# so that generated SQL can never modify the data. Every connection is tuned for reads (mmap, page cache) and
+# queries running longer than the timeout are interrupted through the SQLite progress handler.
+# The database is switched to WAL mode at ingestion, so readers are not blocked while /ingest writes.
+
+import time
+import sqlite3
+from typing import Any
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+# Number of SQLite virtual machine instructions between two checks of the query deadline
+_PROGRESS_HANDLER_INSTRUCTIONS = 10000
+
+
+def _make_uri(db_path: str, read_only: bool, immutable: bool) -> str:
+    if not read_only:
+        return f"sqlite:///{db_path}"
+    # immutable=1 also skips locking, it must only be used when the database file is never written while serving
+    options = "mode=ro&immutable=1" if immutable else "mode=ro"
+    return f"sqlite:///file:{db_path}?{options}&uri=true"
+
+
+def create_sqlite_engine(db_path: str, pool_size: int = 5, read_only: bool = False, immutable: bool = False,
+                         mmap_size: int = None, cache_size: int = None, query_timeout_ms: int = None) -> Engine:
+    """Create the engine of the patient database.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+        pool_size (int): Number of pooled connections, sized to the worker thread pool.
+        read_only (bool): Open read-only connections with query_only set.
+        immutable (bool): Open the database as immutable (read_only only), for databases that are never re-ingested while serving.
+        mmap_size (int): PRAGMA mmap_size of every connection, in bytes.
+        cache_size (int): PRAGMA cache_size of every connection (negative values are KiB).
+        query_timeout_ms (int): Queries running longer are interrupted and raise an OperationalError.
+    """
+    engine = create_engine(_make_uri(str(db_path), read_only, immutable), pool_size=pool_size)
+    pragmas = []
+    if read_only:
+        pragmas.append("PRAGMA query_only = 1")
+    if mmap_size is not None:
+        pragmas.append(f"PRAGMA mmap_size = {int(mmap_size)}")
+    if cache_size is not None:
+        pragmas.append(f"PRAGMA cache_size = {int(cache_size)}")
+    pragmas.append("PRAGMA temp_store = MEMORY")
+
+    @event.listens_for(engine, "connect")
+    def configure_connection(dbapi_connection: sqlite3.Connection, connection_record: Any) -> None:
+        for pragma in pragmas:
+            dbapi_connection.execute(pragma)
+        if query_timeout_ms:
+            info = connection_record.info
+            info["deadline"] = None
+            # A non-zero return value interrupts the running statement
+            dbapi_connection.set_progress_handler(
+                lambda: int(info["deadline"] is not None and time.monotonic() > info["deadline"]),
+                _PROGRESS_HANDLER_INSTRUCTIONS,
+            )
+
+    if query_timeout_ms:
+        @event.listens_for(engine, "before_cursor_execute")
+        def start_query_timer(conn, cursor, statement, parameters, context, executemany) -> None:
+            # The deadline also covers fetching the rows of the statement
+            conn.info["deadline"] = time.monotonic() + query_timeout_ms / 1000
+
+        @event.listens_for(engine, "reset")
+        def clear_query_timer(dbapi_connection, connection_record, reset_state) -> None:
+            # Connections returned to the pool must be able to roll back
+            connection_record.info["deadline"] = None
+
+    return engine
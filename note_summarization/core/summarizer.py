@@ -2,19 +2,52 @@
 # %%
 from __future__ import annotations
 
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 # imports needed for SQLiteChain class
-from typing import Any
+from typing import Any, AsyncIterator, Iterable, Iterator
 from pydantic import Field
-from langchain_core.language_models import BaseLanguageModel
+from langchain_core.language_models import BaseChatModel, BaseLanguageModel
 from langchain.prompts.prompt import PromptTemplate
 
 # imports needed for Summarizer class
 from langchain_community.utilities.sql_database import SQLDatabase
+from sqlalchemy import inspect, text
 # Different implementation of ChatOpenAI will be usied to avoid "with_structured_output is not implemented for this model" error
 # from langchain.chat_models import ChatOpenAI
 from langchain_openai import ChatOpenAI
 from langchain.schema import SystemMessage, HumanMessage
 
+from core.sql_cache import SQLQueryCache, parameterize_query
+from core.summary_cache import SummaryCache
+from core.patient_resolver import PatientResolver
+from core.tokens import count_tokens
+from core.result_encoders import get_result_encoder
+from core.metrics import PipelineMetrics
+from core.single_flight import SingleFlight
+from core.sqlite_engine import create_sqlite_engine
+from core.duckdb_engine import create_duckdb_engine
+from core.llm_cache import is_cache_hit
+
+# Serving backends of the Summarizer: SQLite (the ingested database) or DuckDB over the Parquet files exported at ingestion
+DATABASE_BACKENDS = ("sqlite", "duckdb")
+
+# Name and current date expression of the SQL dialects in the SQL generation prompt
+SQL_DIALECTS = {
+    "sqlite": ("SQLite", "date('now')"),
+    "duckdb": ("DuckDB", "current_date"),
+}
+
+# Metrics label of the summary calls made outside of a template (e.g. in benchmarks)
+UNLABELED_TEMPLATE = "none"
+
 # %%
 # Define SQLiteChain class
 class SQLiteChain:
@@ -36,6 +69,8 @@ class SQLiteChain:
     """SQL Database to connect to."""
     system_prompt: PromptTemplate
     """System prompt for the LLM."""
+    chain: Any
+    """System prompt composed with the LLM."""
 
     def __init__(self, llm: BaseLanguageModel, db: SQLDatabase):
         """
@@ -48,11 +83,16 @@ class SQLiteChain:
         self.llm = llm
         self.db = db
         self.system_prompt = self._initialize_prompt()
+        # The prompt and the structured LLM are composed once, the instructions come first and the question last
+        self.chain = self.system_prompt | self.llm
+        # Schema descriptions are computed once per table and kept until the database is re-ingested
+        self._table_info = {}
+        self._table_info_lock = threading.Lock()
       
     def _initialize_prompt(self) -> PromptTemplate:
         """Create a custom prompt template for structured output."""
 
-        sqlite_prompt = """You are a SQLite expert. Given an input question, create a syntactically correct SQLite query to run. 
+        sqlite_prompt = """You are a {dialect} expert. Given an input question, create a syntactically correct {dialect} query to run. 
         The database schema consists of multiple tables, each containing different columns.
         Never query for all columns from a table. You must query only the columns that are needed to answer the question. 
         For each question, assume you know NOTHING except the schema provided.
@@ -67,55 +107,143 @@ class SQLiteChain:
         Do not use any external knowledge or information. Do not use any external APIs or services. Do not use any external libraries or packages. Do not use any external files or resources.
         Wrap each column name in double quotes (") to denote them as delimited identifiers.
         Pay attention to use only the column names you can see in the tables provided. Be careful to not query for columns that do not exist. Also, pay attention to which column is in which table.
-        Pay attention to use date('now') function to get the current date, if the question involves "today".
+        Pay attention to use {current_date} function to get the current date, if the question involves "today".
         Return only the SQL query as the answer. Do not include any explanations, formatting, or additional text.
 
         Only use the following tables: {table_info}
 
         Question: {input}
         """
+        dialect, current_date = SQL_DIALECTS.get(self.db.dialect, SQL_DIALECTS["sqlite"])
         system_prompt = PromptTemplate(
             input_variables=["input", "table_info"],
-            template=sqlite_prompt
+            template=sqlite_prompt,
+            partial_variables={"dialect": dialect, "current_date": current_date}
         )
         return system_prompt
 
-    def invoke(self, prompt: str) -> dict[str, Any]:
+    def reset_table_info(self, db: SQLDatabase = None) -> None:
+        """Drop the cached schema descriptions. Must be called after the database is re-ingested, with db the
+        SQLDatabase rebuilt on the re-ingested database (see Summarizer.refresh_schema), so that the tables created,
+        dropped or altered by the ingestion are reflected again.
+        """
+        with self._table_info_lock:
+            self._table_info = {}
+            if db is not None:
+                self.db = db
+
+    def get_table_info(self, table_names: list[str] = None) -> str:
+        """Return the schema description of the given tables (all usable tables by default)."""
+        usable_tables = self.db.get_usable_table_names()
+        table_names = [table for table in (table_names or []) if table in usable_tables] or list(usable_tables)
+        with self._table_info_lock:
+            for table in table_names:
+                if table not in self._table_info:
+                    self._table_info[table] = self.db.get_table_info([table])
+            return "\n\n".join(self._table_info[table] for table in sorted(table_names))
+
+    def select_tables(self, prompt: str) -> list[str] | None:
+        """Select the tables mentioned in the question. Returns None if no table can be matched."""
+        question = prompt.lower()
+        selected_tables = []
+        for table in self.db.get_usable_table_names():
+            # Every question mentions the patient, so the patients table is not used for matching
+            if table == "patients":
+                continue
+            # Match table names in plural or singular form, e.g. "medications" or "imaging study"
+            names = {table.replace("_", " "), re.sub(r"(ies|s)$", "", table).replace("_", " ")}
+            if any(re.search(rf"\b{re.escape(name)}", question) for name in names):
+                selected_tables.append(table)
+        if not selected_tables:
+            return None
+        # Patients are always needed to filter by patient name
+        return selected_tables + ["patients"]
+
+    def invoke(self, prompt: str, table_names: list[str] = None) -> dict[str, Any]:
         """
         Generate SQL query from a natural language prompt.
         
         Args:
             prompt (str): The natural language prompt to generate the SQL query.
+            table_names (list[str]): Tables to include in the schema description. Selected from the prompt if not provided.
 
         Returns:
             dict: The response containing the generated SQL query.
         """
-        # Combine the system prompt and structured LLM
-        chain = self.system_prompt | self.llm
-
         # Prepare inputs
         inputs = {
             "input": prompt,
-            "table_info": self.db.get_table_info()
+            "table_info": self.get_table_info(table_names or self.select_tables(prompt))
         }
 
         # Invoke the chain
-        response = chain.invoke(inputs)
+        response = self.chain.invoke(inputs)
+        return response
+
+    async def ainvoke(self, prompt: str, table_names: list[str] = None) -> dict[str, Any]:
+        """Asynchronous version of invoke."""
+        # Schema reflection hits the database the first time a table is described, keep it off the event loop
+        table_info = await asyncio.to_thread(self.get_table_info, table_names or self.select_tables(prompt))
+        inputs = {
+            "input": prompt,
+            "table_info": table_info
+        }
+        response = await self.chain.ainvoke(inputs)
         return response
     
 # %%
+def _timed_batches(batches: Iterator[Any], timings: dict[str, float]) -> Iterator[Any]:
+    """Yield the row batches, adding the time spent fetching them to timings["execute_s"]."""
+    batches = iter(batches)
+    while True:
+        start_time = time.perf_counter()
+        batch = next(batches, None)
+        timings["execute_s"] += time.perf_counter() - start_time
+        if batch is None:
+            return
+        yield batch
+
 # Define Summarizer class
 class Summarizer:
-    def __init__(self, db_path: StopIteration, pool_size: int=5,  model_name: str="gpt-4o", temperature: int=0):
+    def __init__(self, db_path: StopIteration, pool_size: int=5,  model_name: str="gpt-4o", temperature: int=0, sql_cache: SQLQueryCache=None, summary_cache: SummaryCache=None, patient_cache_size: int=1024, result_encoding: str="csv", connection_options: dict[str, Any]=None, backend: str="sqlite", parquet_dir: str=None, llm: BaseChatModel=None):
         """Constructor for the Summarizer class"""
 
-        self.db = self._initialize_db_connection(db_path=db_path, pool_size=pool_size)
+        self.backend = backend
+        self.db = self._initialize_db_connection(db_path=db_path, pool_size=pool_size, connection_options=connection_options,
+                                                 backend=backend, parquet_dir=parquet_dir)
         if self.db is None:
             raise ValueError("Database connection not initialized.")
         
+        # Thread pool for SQLite reads issued from async code, sized to the connection pool
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="summarizer-db")
+        self.model_name = model_name
+        self.sql_cache = sql_cache
+        self.summary_cache = summary_cache
+        self.patient_resolver = PatientResolver(self.get_patient_id, max_entries=patient_cache_size)
+        # Serialization of query results in the summary prompts
+        self.result_encoder = get_result_encoder(result_encoding)
+        # Pipeline metrics of this process, exposed on /metrics
+        self.metrics = PipelineMetrics()
+        self.metrics.track_cache("patient", self.patient_resolver)
+        self.metrics.track_cache("sql", sql_cache)
+        # Identical concurrent requests share one in-flight computation, keyed by the data generation
+        self.data_generation = 0
+        self.summary_flights = SingleFlight("summary")
+        self.sql_flights = SingleFlight("SQL generation")
+        self.query_flights = SingleFlight("query execution")
+        self.metrics.track_cache("summary_in_flight", self.summary_flights)
+        self.metrics.track_cache("sql_in_flight", self.sql_flights)
+        self.metrics.track_cache("query_in_flight", self.query_flights)
         self.llm = None
         self.db_chain = None
-        self._initialize_llm(model_name=model_name, temperature=temperature)
+        # Structured output runnables of the summary calls, built once per output schema
+        self._structured_llms = {}
+        self._structured_llms_by_content = {}
+        self._structured_llms_lock = threading.Lock()
+        self.schema_fingerprint = None
+        self.refresh_schema()
+
+        self._initialize_llm(model_name=model_name, temperature=temperature, llm=llm)
         
     def dispose(self):
         """Dispose of the SQLite database connection."""
@@ -123,14 +251,60 @@ class Summarizer:
         # FIXME: This is a temporary fix to avoid "AttributeError: 'SQLDatabase' object has no attribute '_engine'" error        
         if hasattr(self.db, "_engine"):
             self.db._engine.dispose()
+        self.executor.shutdown(wait=False)
+
+    def _initialize_db_connection(self, db_path: str, pool_size: int, connection_options: dict[str, Any]=None, backend: str="sqlite", parquet_dir: str=None) -> SQLDatabase:
+        """Initialize the database connection and LangChain SQLDatabase.
+        connection_options are passed to create_sqlite_engine (read_only, immutable, mmap_size, cache_size, query_timeout_ms)
+        or to create_duckdb_engine (threads, memory_limit).
+        """
+        if backend not in DATABASE_BACKENDS:
+            raise ValueError(f"Unknown database backend '{backend}'. Available backends: {', '.join(DATABASE_BACKENDS)}.")
+        if backend == "duckdb":
+            engine = create_duckdb_engine(parquet_dir, pool_size=pool_size, **(connection_options or {}))
+        else:
+            engine = create_sqlite_engine(db_path, pool_size=pool_size, **(connection_options or {}))
+        return self._create_sql_database(engine)
+
+    def _create_sql_database(self, engine: Any) -> SQLDatabase:
+        """Create the LangChain SQLDatabase of the engine. Its table lists are fixed, so it is re-created after every ingestion."""
+        if self.backend == "duckdb":
+            # The Parquet files are exposed as views
+            return SQLDatabase(engine, view_support=True)
+        # Internal tables (e.g. the ingest metadata) are not part of the schema shown to the LLM
+        internal_tables = [table for table in inspect(engine).get_table_names() if table.startswith("_")]
+        return SQLDatabase(engine, ignore_tables=internal_tables or None)
 
-    def _initialize_db_connection(self, db_path: str, pool_size: int) -> SQLDatabase:
-        """Initialize the SQLite database connection and LangChain SQLDatabase."""
-        db = SQLDatabase.from_uri(f"sqlite:///{db_path}", engine_args = {"pool_size": pool_size})
-        return db
+    def refresh_schema(self) -> None:
+        """Recompute the database schema fingerprint. Must be called after the database is re-ingested."""
+        # Requests started after the ingestion no longer join computations reading the previous data
+        self.data_generation = getattr(self, "data_generation", 0) + 1
+        if self.backend == "duckdb":
+            # New connections create the views of the Parquet files exported by the last ingestion
+            self.db._engine.dispose()
+            inspector = inspect(self.db._engine)
+            schema = [
+                (name, [(column["name"], str(column["type"])) for column in inspector.get_columns(name)])
+                for name in sorted(inspector.get_view_names())
+            ]
+        else:
+            # Only the tables shown to the LLM matter: indexes, planner statistics and internal tables are left out
+            cursor = self.db.run(
+                command="SELECT type, name, sql FROM sqlite_master WHERE type = 'table' AND substr(name, 1, 1) != '_' AND name NOT LIKE 'sqlite%' ORDER BY name",
+                fetch="cursor",
+            )
+            schema = cursor.all()
+            cursor.close()
+        self.schema_fingerprint = hashlib.sha256(repr([tuple(row) for row in schema]).encode("utf-8")).hexdigest()[:16]
+        if self.db_chain is not None:
+            # Tables created or dropped by the ingestion, e.g. patient_timeline, become visible to the SQL chain
+            self.db = self._create_sql_database(self.db._engine)
+            self.db_chain.reset_table_info(self.db)
+        if hasattr(self, "patient_resolver"):
+            self.patient_resolver.clear()
               
-    def _initialize_llm(self, model_name: str, temperature: int) -> None:
-        """Initialize the OpenAI model."""
+    def _initialize_llm(self, model_name: str, temperature: int, llm: BaseChatModel=None) -> None:
+        """Initialize the OpenAI model, or use the given chat model (e.g. core.fake_llm.FakeChatModel in benchmarks)."""
         json_schema_sql = {
             "title": "sql_query",
             "description": "SQL query to retrieve data from a database.",
@@ -145,23 +319,158 @@ class Summarizer:
         }
         # FIXME: using method="json_schema" would require additional compliance with OpenAI specifications:
         # https://platform.openai.com/docs/guides/structured-outputs/supported-schemas?api-mode=chat
-        self.llm = ChatOpenAI(model_name=model_name, temperature=temperature)
+        self.llm = llm if llm is not None else ChatOpenAI(model_name=model_name, temperature=temperature)
         structured_llm = self.llm.with_structured_output(json_schema_sql)#, method="json_schema")
         self.db_chain = SQLiteChain(llm=structured_llm, db=self.db)
+        with self._structured_llms_lock:
+            self._structured_llms = {}
+            self._structured_llms_by_content = {}
+
+    def compile_output_schemas(self, output_schemas: Iterable[dict[str, Any]]) -> None:
+        """Build the structured output runnables of the output schemas at startup, instead of on the first request.
+        The runnables of these schema objects are then found by identity, without hashing the schema.
+        """
+        for output_schema in output_schemas:
+            for include_raw in (False, True):
+                structured_llm = self._get_structured_llm(output_schema, include_raw)
+                with self._structured_llms_lock:
+                    self._structured_llms[(id(output_schema), include_raw)] = (output_schema, structured_llm)
+
+    def _get_structured_llm(self, output_schema: dict[str, Any], include_raw: bool = False) -> Any:
+        """Return the structured output runnable of the output schema, built on first use.
+        With include_raw, the runnable returns the raw model message (with its token usage) along with the parsed output.
+        """
+        entry = self._structured_llms.get((id(output_schema), include_raw))
+        # The entry keeps its schema alive, so its id can not be reused by another object
+        if entry is not None and entry[0] is output_schema:
+            return entry[1]
+        key = (json.dumps(output_schema, sort_keys=True), include_raw)
+        with self._structured_llms_lock:
+            structured_llm = self._structured_llms_by_content.get(key)
+            if structured_llm is None:
+                structured_llm = self.llm.with_structured_output(output_schema, include_raw=include_raw)
+                self._structured_llms_by_content[key] = structured_llm
+        return structured_llm
     
-    def generate_sql_query(self, prompt: str) -> str:
+    def generate_sql_query(self, prompt: str, table_names: list[str]=None) -> str:
         """Generate SQL query"""
-        response = self.db_chain.invoke(prompt)
+        response = self.db_chain.invoke(prompt, table_names)
         sql_query = response['sql']
         return sql_query
 
-    def execute_query(self, query: str) -> Any:
+    async def agenerate_sql_query(self, prompt: str, table_names: list[str]=None) -> str:
+        """Asynchronous version of generate_sql_query."""
+        response = await self.db_chain.ainvoke(prompt, table_names)
+        return response['sql']
+
+    def generate_patient_sql_query(self, sql_template: str, patient_details: str, parameters: dict[str, Any], sql_template_id: str=None, table_names: list[str]=None) -> tuple[str, dict[str, Any]]:
+        """Generate SQL query for a patient. Returns the query and its bind parameters.
+        Queries are cached with the patient identity replaced by bind parameters, so cache hits skip the LLM call.
+        """
+        prompt, key, cached_query = self._lookup_patient_sql_query(sql_template, patient_details, parameters, sql_template_id)
+        if cached_query is not None:
+            return cached_query, parameters
+        query = self.generate_sql_query(prompt, table_names)
+        return self._store_patient_sql_query(key, query, parameters, sql_template_id)
+
+    async def agenerate_patient_sql_query(self, sql_template: str, patient_details: str, parameters: dict[str, Any], sql_template_id: str=None, table_names: list[str]=None) -> tuple[str, dict[str, Any]]:
+        """Asynchronous version of generate_patient_sql_query. Concurrent calls for the same patient and sql_template share one LLM call."""
+        key = (self.data_generation, sql_template_id, sql_template, patient_details, tuple(sorted(parameters.items())), tuple(table_names or ()))
+        query, query_parameters = await self.sql_flights.run(
+            key, lambda: self._agenerate_patient_sql_query(sql_template, patient_details, parameters, sql_template_id, table_names)
+        )
+        return query, dict(query_parameters)
+
+    async def _agenerate_patient_sql_query(self, sql_template: str, patient_details: str, parameters: dict[str, Any], sql_template_id: str, table_names: list[str]) -> tuple[str, dict[str, Any]]:
+        prompt, key, cached_query = await asyncio.to_thread(self._lookup_patient_sql_query, sql_template, patient_details, parameters, sql_template_id)
+        if cached_query is not None:
+            return cached_query, parameters
+        query = await self.agenerate_sql_query(prompt, table_names)
+        return await asyncio.to_thread(self._store_patient_sql_query, key, query, parameters, sql_template_id)
+
+    def _lookup_patient_sql_query(self, sql_template: str, patient_details: str, parameters: dict[str, Any], sql_template_id: str) -> tuple[str, str | None, str | None]:
+        """Format the SQL prompt and look up the cached query. Returns the prompt, the cache key and the cached query."""
+        prompt = sql_template.format(patient_details=patient_details)
+        if self.sql_cache is None:
+            return prompt, None, None
+        key = SQLQueryCache.make_key(sql_template_id, sql_template, self.schema_fingerprint, self.model_name, list(parameters))
+        query = self.sql_cache.get(key)
+        if query is not None:
+            logging.info(f"SQL cache hit for sql_template '{sql_template_id}'.")
+        return prompt, key, query
+
+    def _store_patient_sql_query(self, key: str | None, query: str, parameters: dict[str, Any], sql_template_id: str) -> tuple[str, dict[str, Any]]:
+        """Parameterize and cache a generated query. Returns the query and its bind parameters."""
+        if key is None:
+            return query, {}
+        parameterized_query = parameterize_query(query, parameters)
+        if parameterized_query is None:
+            logging.info(f"SQL query for sql_template '{sql_template_id}' could not be parameterized and will not be cached.")
+            return query, {}
+        self.sql_cache.set(key, parameterized_query, sql_template_id, self.schema_fingerprint, self.model_name)
+        return parameterized_query, parameters
+
+    def get_patient_id(self, first_name: str, last_name: str) -> str | None:
+        """Look up the patient id by exact first and last name."""
+        rows = self.execute_query('SELECT id FROM patients WHERE first = :first_name AND last = :last_name',
+                                  {"first_name": first_name, "last_name": last_name})
+        return rows[0][0] if rows else None
+
+    def resolve_patient(self, patient_info: dict[str, Any]) -> str | None:
+        """Resolve the patient_info of a request to the patient id. Returns None if the patient does not exist."""
+        return self.patient_resolver.resolve(patient_info)
+
+    async def aresolve_patient(self, patient_info: dict[str, Any]) -> str | None:
+        """Asynchronous version of resolve_patient. Cached patients are resolved without leaving the event loop."""
+        patient_id = self.patient_resolver.get_cached(patient_info)
+        if patient_id is not None:
+            return patient_id
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.patient_resolver.resolve, patient_info)
+
+    def execute_query(self, query: str, parameters: dict[str, Any]=None) -> Any:
         """Execute SQL query on SQLite database and fetch results."""
-        cursor = self.db.run(command = query, fetch="cursor")
+        cursor = self.db.run(command = query, fetch="cursor", parameters=parameters)
         rows = cursor.all()
         cursor.close()
         return rows
-    
+
+    def execute_query_formatted(self, query: str, parameters: dict[str, Any]=None, batch_size: int=1000, timings: dict[str, float]=None) -> tuple[str, int]:
+        """Execute SQL query and encode the rows with the result encoder as they are fetched, batch_size rows at a time.
+        Returns the encoded result and the number of rows.
+        If timings is given, the seconds spent executing the query and fetching the rows (execute_s) and encoding them (format_s) are stored in it.
+        """
+        start_time = time.perf_counter()
+        with self.db._engine.connect() as connection:
+            result = connection.execute(text(query), parameters or {})
+            if timings is None:
+                return self.result_encoder.encode(list(result.keys()), result.partitions(batch_size))
+            timings["execute_s"] = time.perf_counter() - start_time
+            encoded = self.result_encoder.encode(list(result.keys()), _timed_batches(result.partitions(batch_size), timings))
+        timings["format_s"] = time.perf_counter() - start_time - timings["execute_s"]
+        return encoded
+
+    async def aexecute_query_formatted(self, query: str, parameters: dict[str, Any]=None, batch_size: int=1000, timings: dict[str, float]=None) -> tuple[str, int]:
+        """Asynchronous version of execute_query_formatted, running in the database thread pool.
+        Concurrent executions of the same query with the same parameters share one execution and its timings.
+        """
+        loop = asyncio.get_running_loop()
+        key = (self.data_generation, query, tuple(sorted((parameters or {}).items())), batch_size)
+        encoded, query_timings = await self.query_flights.run(
+            key, lambda: loop.run_in_executor(self.executor, self._execute_query_formatted_timed, query, parameters, batch_size)
+        )
+        if timings is not None:
+            timings.update(query_timings)
+        return encoded
+
+    def _execute_query_formatted_timed(self, query: str, parameters: dict[str, Any], batch_size: int) -> tuple[tuple[str, int], dict[str, float]]:
+        timings = {}
+        return self.execute_query_formatted(query, parameters, batch_size, timings), timings
+
+    def count_tokens(self, text: str) -> int:
+        """Return the number of tokens of the text for the summarization model."""
+        return count_tokens(text, self.model_name)
+
     def format_data(self, data: Any) -> str:
         """Format extracted data into the prompt."""
         formatted_rows = "\n".join([", ".join(map(str, row)) for row in data])
@@ -171,16 +480,61 @@ class Summarizer:
         """Format extracted data into the prompt."""
         return f"{prompt}{data}"
     
-    def get_summary_from_openai(self, system_prompt: str, user_prompt: str, output_schema: dict[str, Any]) -> dict[str, Any]:
-        """Send prompt to OpenAI model and get a response."""
+    def get_summary_from_openai(self, system_prompt: str, user_prompt: str, output_schema: dict[str, Any], template_id: str = None) -> dict[str, Any]:
+        """Send prompt to OpenAI model and get a response.
+        The token usage of the call is recorded under template_id.
+        """
         # Create a list of BaseMessages
         messages = [
             SystemMessage(content=system_prompt),
             HumanMessage(content=user_prompt)
         ]
         # Invoke the structured LLM client with the list of messages
-        structured_llm = self.llm.with_structured_output(output_schema)
-        response = structured_llm.invoke(messages)
+        response = self._get_structured_llm(output_schema, include_raw=True).invoke(messages)
 
         # Return the content of the response
-        return response
+        return self._parse_structured_response(response, system_prompt, user_prompt, template_id)
+
+    async def aget_summary_from_openai(self, system_prompt: str, user_prompt: str, output_schema: dict[str, Any], template_id: str = None) -> dict[str, Any]:
+        """Asynchronous version of get_summary_from_openai."""
+        messages = [
+            SystemMessage(content=system_prompt),
+            HumanMessage(content=user_prompt)
+        ]
+        response = await self._get_structured_llm(output_schema, include_raw=True).ainvoke(messages)
+        return self._parse_structured_response(response, system_prompt, user_prompt, template_id)
+
+    async def astream_summary_from_openai(self, system_prompt: str, user_prompt: str, output_schema: dict[str, Any], template_id: str = None) -> AsyncIterator[dict[str, Any]]:
+        """Stream the structured summary. Yields progressively more complete partial objects, the last one is the final summary.
+        Streamed chunks carry no token usage, the tokens of the call are estimated.
+        """
+        messages = [
+            SystemMessage(content=system_prompt),
+            HumanMessage(content=user_prompt)
+        ]
+        partial_response = {}
+        async for partial_response in self._get_structured_llm(output_schema).astream(messages):
+            yield partial_response
+        self._record_token_usage(template_id, system_prompt, user_prompt, partial_response)
+
+    def _parse_structured_response(self, response: dict[str, Any], system_prompt: str, user_prompt: str, template_id: str | None) -> dict[str, Any]:
+        """Return the parsed output of an include_raw structured output response and record the token usage of the call.
+        Responses replayed from the LLM cache spent no tokens and are not recorded.
+        """
+        if response.get("parsing_error") is not None:
+            raise response["parsing_error"]
+        if not is_cache_hit(response["raw"]):
+            self._record_token_usage(template_id, system_prompt, user_prompt, response["parsed"], getattr(response["raw"], "usage_metadata", None))
+        return response["parsed"]
+
+    def _record_token_usage(self, template_id: str | None, system_prompt: str, user_prompt: str, summary: Any, usage: dict[str, int] = None) -> None:
+        """Record the prompt and completion tokens of a summary call: the usage reported by the model,
+        or an estimate from the prompts and the output when the response has no usage metadata.
+        """
+        if usage:
+            prompt_tokens, completion_tokens = usage["input_tokens"], usage["output_tokens"]
+        else:
+            prompt_tokens = self.count_tokens(system_prompt) + self.count_tokens(user_prompt)
+            completion_tokens = self.count_tokens(json.dumps(summary))
+        self.metrics.prompt_tokens.observe(prompt_tokens, template=template_id or UNLABELED_TEMPLATE)
+        self.metrics.completion_tokens.observe(completion_tokens, template=template_id or UNLABELED_TEMPLATE)
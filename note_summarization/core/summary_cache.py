@@ -0,0 +1,95 @@
+# This module implements a persistent cache of finished patient summaries.
+# A summary is stored per template, patient and model together with a fingerprint of the prompts it was generated from.
+# The fingerprint covers the retrieved patient rows, so once new data for a patient is ingested the fingerprint
+# no longer matches and the stale summary is regenerated and replaced.
+# Summaries that are never requested again (e.g. of patients no longer in the data, or of other models or templates)
+# are removed by prune, run at startup and after every ingestion: entries older than a TTL, then the oldest entries
+# over a maximum number of entries.
+
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+
+def fingerprint_summary_inputs(system_prompt: str, user_prompt: str, output_schema: dict[str, Any]) -> str:
+    """Return the content hash of everything the summary LLM call depends on."""
+    payload = json.dumps([system_prompt, user_prompt, output_schema], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SummaryCache:
+    """Persistent SQLite-file based cache of generated summaries."""
+
+    def __init__(self, cache_path: str):
+        """Open (or create) the cache database file."""
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.cache_path = cache_path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS summary_cache (
+                template_id TEXT NOT NULL,
+                patient_id TEXT NOT NULL,
+                model_name TEXT NOT NULL,
+                data_fingerprint TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                created_at TEXT,
+                PRIMARY KEY (template_id, patient_id, model_name)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS summary_cache_created_at ON summary_cache (created_at)")
+        self._conn.commit()
+
+    def get(self, template_id: str, patient_id: str, model_name: str, data_fingerprint: str) -> dict[str, Any] | None:
+        """Return the cached summary if it was generated from the same data, otherwise None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary FROM summary_cache WHERE template_id = ? AND patient_id = ? AND model_name = ? AND data_fingerprint = ?",
+                (template_id, patient_id, model_name, data_fingerprint),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, template_id: str, patient_id: str, model_name: str, data_fingerprint: str, summary: dict[str, Any]) -> None:
+        """Store the summary, replacing the one generated from older data."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summary_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (template_id, patient_id, model_name, data_fingerprint, json.dumps(summary), datetime.now(timezone.utc).isoformat()),
+            )
+            self._conn.commit()
+
+    def prune(self, max_entries: int = None, ttl_seconds: int = None) -> int:
+        """Delete the entries created more than ttl_seconds ago, then the oldest entries over max_entries.
+        Limits set to None are not enforced. Returns the number of deleted entries.
+        """
+        deleted = 0
+        with self._lock:
+            if ttl_seconds is not None:
+                # created_at values are UTC ISO timestamps, ordered as text
+                expired_before = (datetime.now(timezone.utc) - timedelta(seconds=ttl_seconds)).isoformat()
+                deleted += self._conn.execute("DELETE FROM summary_cache WHERE created_at < ? OR created_at IS NULL", (expired_before,)).rowcount
+            if max_entries is not None:
+                deleted += self._conn.execute(
+                    "DELETE FROM summary_cache WHERE rowid IN (SELECT rowid FROM summary_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (max_entries,),
+                ).rowcount
+            self._conn.commit()
+        return deleted
+
+    def close(self) -> None:
+        """Close the cache database connection."""
+        with self._lock:
+            self._conn.close()
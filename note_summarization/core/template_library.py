@@ -15,7 +15,57 @@ sql_templates = {
   "insurance_sql": "Retrieve all insurance and payer information associated with the patient {patient_details}.",
   "hospitalizations_sql": "Retrieve all hospital visits for the patient {patient_details}.",
   "polypharmacy_sql": "Retrieve the total count of medications currently prescribed to the patient {patient_details}.",
-  "immunizations_sql": "Retrieve ALL immunizations for the patient {patient_details}."
+  "immunizations_sql": "Retrieve ALL immunizations for the patient {patient_details}.",
+  "timeline_sql": "Retrieve the clinical timeline (encounters, conditions, medications and procedures ordered by start date) of the patient {patient_details} from the patient_timeline table."
+}
+
+# Tables relevant to each SQL template. Only the schema of these tables is sent to the LLM when generating SQL.
+sql_template_tables = {
+  "demographics_sql": ["patients"],
+  "conditions_sql": ["conditions", "patients"],
+  "allergies_sql": ["allergies", "patients"],
+  "encounters_sql": ["encounters", "organizations", "patients"],
+  "medications_sql": ["medications", "patients"],
+  "labs_sql": ["observations", "patients"],
+  "imaging_sql": ["imaging_studies", "patients"],
+  "insurance_sql": ["payer_transitions", "payers", "patients"],
+  "hospitalizations_sql": ["encounters", "organizations", "patients"],
+  "polypharmacy_sql": ["medications", "patients"],
+  "immunizations_sql": ["immunizations", "patients"],
+  "timeline_sql": ["patient_timeline", "patients"]
+}
+
+# Prepared SQLite queries for the SQL templates above, keyed by the same ids.
+# They are used instead of LLM generated SQL when the "query_library" retrieval engine is selected for a template.
+# All queries are bound to the :patient_id parameter.
+sql_queries = {
+  "demographics_sql": """SELECT first, last, prefix, suffix, birthdate, deathdate, gender, race, ethnicity, marital, birthplace, address, city, state, zip
+    FROM patients WHERE id = :patient_id""",
+  "conditions_sql": """SELECT start, stop, code, description, CASE WHEN stop IS NULL THEN 'active' ELSE 'resolved' END AS status
+    FROM conditions WHERE patient = :patient_id ORDER BY start""",
+  "allergies_sql": """SELECT start, stop, description, type, category, reaction1, description1, severity1, reaction2, description2, severity2
+    FROM allergies WHERE patient = :patient_id ORDER BY start""",
+  "encounters_sql": """SELECT e.start, e.stop, e.encounterclass, e.description, e.reasondescription, o.name, o.address, o.city, o.state
+    FROM encounters e LEFT JOIN organizations o ON o.id = e.organization WHERE e.patient = :patient_id ORDER BY e.start""",
+  "medications_sql": """SELECT start, stop, code, description, dispenses, reasondescription
+    FROM medications WHERE patient = :patient_id ORDER BY start""",
+  "labs_sql": """SELECT date, description, value, units, type
+    FROM observations WHERE patient = :patient_id AND category = 'laboratory' ORDER BY date""",
+  "imaging_sql": """SELECT date, bodysite_description, modality_description, sop_description
+    FROM imaging_studies WHERE patient = :patient_id ORDER BY date""",
+  "insurance_sql": """SELECT pt.start_date, pt.end_date, pt.plan_ownership, pt.owner_name, p.name AS payer, sp.name AS secondary_payer
+    FROM payer_transitions pt LEFT JOIN payers p ON p.id = pt.payer LEFT JOIN payers sp ON sp.id = pt.secondary_payer
+    WHERE pt.patient = :patient_id ORDER BY pt.start_date""",
+  "hospitalizations_sql": """SELECT e.start, e.stop, e.encounterclass, e.description, e.reasondescription, o.name
+    FROM encounters e LEFT JOIN organizations o ON o.id = e.organization
+    WHERE e.patient = :patient_id AND e.encounterclass IN ('inpatient', 'emergency') ORDER BY e.start""",
+  "polypharmacy_sql": """SELECT COUNT(DISTINCT code) AS current_medications
+    FROM medications WHERE patient = :patient_id AND stop IS NULL""",
+  "immunizations_sql": """SELECT date, code, description
+    FROM immunizations WHERE patient = :patient_id ORDER BY date""",
+  # Single range scan over the timeline built at ingestion (core/ingest.py)
+  "timeline_sql": """SELECT start, stop, event_type, code, description, reasondescription, encounterclass, organization
+    FROM patient_timeline WHERE patient = :patient_id ORDER BY start"""
 }
 
 # User prompt templates for generating patient summaries
@@ -242,9 +292,7 @@ patient_templates = {
         "name": "Visit Priorities (*)",
         "prompt": "visit_priorities",
         "sql_prompts": [
-            "encounters_sql",
-            "conditions_sql",
-            "medications_sql"
+            "timeline_sql"
         ],
         "output_schema": "visit_priorities",
         "output_template": "visit_priorities"
@@ -253,10 +301,8 @@ patient_templates = {
         "name": "Critical Changes (*)",
         "prompt": "critical_changes",
         "sql_prompts": [
-            "encounters_sql",
-            "conditions_sql",
-            "labs_sql",
-            "medications_sql"
+            "timeline_sql",
+            "labs_sql"
         ],
         "output_schema": "critical_changes",
         "output_template": "critical_changes"
@@ -334,4 +380,73 @@ patient_templates = {
         "output_schema": "default_output_schema",
         "output_template": "default_output_template"
     }
-}
\ No newline at end of file
+}
+
+def populate_template(template_name: str, retrieval_engine: str = "text_to_sql", token_budget: int = None) -> dict:
+    """Format the template to be used to answer the question. Specificalliy, it will replace the prompt, sql_templates and output_schema with the actual templates:
+    {
+        "id",
+        "prompt",
+        "sql_prompts": [],
+        "sql_prompt_ids": [],
+        "sql_queries": [],
+        "sql_tables": [],
+        "retrieval_engine",
+        "token_budget",
+        "output_schema",
+        "output_template"
+    }
+    """
+    template = patient_templates[template_name]
+    populated_template = template.copy()
+    populated_template["id"] = template_name
+    populated_template["prompt"] = prompt_templates[template["prompt"]]
+    populated_template["output_schema"] = output_schemas[template["output_schema"]]
+    populated_template["retrieval_engine"] = retrieval_engine
+    populated_template["token_budget"] = token_budget
+    sql_prompts = template.get("sql_prompts", [])
+    populated_template["sql_prompts"] = []
+    populated_template["sql_prompt_ids"] = []
+    populated_template["sql_queries"] = []
+    populated_template["sql_tables"] = []
+    for sql_prompt in sql_prompts:
+        populated_template["sql_prompts"].append(sql_templates[sql_prompt])
+        populated_template["sql_prompt_ids"].append(sql_prompt)
+        populated_template["sql_queries"].append(sql_queries.get(sql_prompt))
+        populated_template["sql_tables"].append(sql_template_tables.get(sql_prompt))
+    return populated_template
+
+
+def validate_templates() -> None:
+    """Check that every template references existing prompts, SQL templates and output schemas. Raises ValueError listing all invalid references."""
+    errors = []
+    for template_name, template in patient_templates.items():
+        if template.get("prompt") not in prompt_templates:
+            errors.append(f"{template_name}: unknown prompt '{template.get('prompt')}'")
+        if template.get("output_schema") not in output_schemas:
+            errors.append(f"{template_name}: unknown output_schema '{template.get('output_schema')}'")
+        if not template.get("output_template"):
+            errors.append(f"{template_name}: missing output_template")
+        for sql_prompt in template.get("sql_prompts", []):
+            if sql_prompt not in sql_templates:
+                errors.append(f"{template_name}: unknown sql_prompt '{sql_prompt}'")
+            elif "{patient_details}" not in sql_templates[sql_prompt]:
+                errors.append(f"{template_name}: sql_prompt '{sql_prompt}' does not reference {{patient_details}}")
+    for sql_prompt in sql_queries:
+        if sql_prompt not in sql_templates:
+            errors.append(f"query library: no sql_template for '{sql_prompt}'")
+    if errors:
+        raise ValueError("Invalid template library: " + "; ".join(errors))
+
+
+def build_template_registry(retrieval_engines: dict[str, str] = None, token_budgets: dict[str, int] = None) -> dict[str, dict]:
+    """Validate the template library and populate every template once, with its retrieval engine and token budget.
+    The populated templates are shared by all requests and must not be modified.
+    """
+    validate_templates()
+    retrieval_engines = retrieval_engines or {}
+    token_budgets = token_budgets or {}
+    return {
+        template_name: populate_template(template_name, retrieval_engines.get(template_name, "text_to_sql"), token_budgets.get(template_name))
+        for template_name in patient_templates
+    }
@@ -0,0 +1,32 @@
+# This module counts prompt tokens for the per-template token budgets.
+# tiktoken downloads its encodings on first use. When the encoding is not available (e.g. no network access),
+# the count falls back to an estimate of CHARS_PER_TOKEN characters per token.
+
+import logging
+from functools import lru_cache
+
+import tiktoken
+
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding | None:
+    """Return the tiktoken encoding of the model, or None if it can not be loaded."""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            # Model unknown to tiktoken, use the encoding of the current OpenAI models
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logging.warning(f"tiktoken encoding for '{model_name}' not available, token counts are estimated: {e}")
+        return None
+
+
+def count_tokens(text: str, model_name: str = "gpt-4o") -> int:
+    """Return the number of tokens of the text for the model."""
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
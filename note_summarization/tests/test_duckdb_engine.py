@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+from core.duckdb_engine import parquet_tables, stale_parquet_tables
+from core.ingest import ingest_csv_files
+from core.ns_utils import sync_parquet
+
+HEADER = "id,start,stop,patient,encounter,code,description,reasoncode,reasondescription\n"
+ROWS = "c1,2020-01-01,,p1,e1,1,Diabetes plan,,\nc2,2021-01-01,,p1,e2,2,Exercise plan,,\n"
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """An ingested database with a careplans table, without Parquet files."""
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "careplans.csv").write_text(HEADER + ROWS, encoding="utf-8")
+    db_path = str(tmp_path / "db" / "test.db")
+    ingest_csv_files(db_path=db_path, data_dir=str(tmp_path / "data"))
+    return db_path
+
+
+def _touch(path, mtime):
+    path.write_bytes(b"")
+    os.utime(path, (mtime, mtime))
+
+
+def test_tables_without_parquet_files_are_stale(tmp_path, db_path):
+    assert stale_parquet_tables(db_path, str(tmp_path / "parquet")) == ["careplans"]
+    (tmp_path / "parquet").mkdir()
+    assert stale_parquet_tables(db_path, str(tmp_path / "parquet")) == ["careplans"]
+
+
+def test_parquet_files_older_than_ingestion_are_stale(tmp_path, db_path):
+    (tmp_path / "parquet").mkdir()
+    _touch(tmp_path / "parquet" / "careplans.parquet", 0)
+    assert stale_parquet_tables(db_path, str(tmp_path / "parquet")) == ["careplans"]
+    _touch(tmp_path / "parquet" / "careplans.parquet", 4102444800)  # 2100-01-01
+    assert stale_parquet_tables(db_path, str(tmp_path / "parquet")) == []
+
+
+def test_sync_parquet_exports_existing_database(tmp_path, db_path):
+    duckdb = pytest.importorskip("duckdb")
+    pytest.importorskip("duckdb_engine")
+    parquet_dir = str(tmp_path / "parquet")
+    # The database was ingested before the backend was switched to duckdb
+    assert sync_parquet(db_path, parquet_dir) == {"careplans": 2}
+    assert sync_parquet(db_path, parquet_dir) == {}
+    conn = duckdb.connect()
+    try:
+        rows = conn.execute(f"SELECT id, description FROM read_parquet('{parquet_tables(parquet_dir)['careplans']}') ORDER BY id").fetchall()
+    finally:
+        conn.close()
+    assert rows == [("c1", "Diabetes plan"), ("c2", "Exercise plan")]
@@ -0,0 +1,144 @@
+import sqlite3
+
+import pytest
+
+from core.ingest import _create_table, _plan_ingest, _sync_rows, file_checksum, ingest_csv_files, table_schema
+
+HEADER = "id,start,stop,patient,encounter,code,description,reasoncode,reasondescription\n"
+ROWS = "c1,2020-01-01,,p1,e1,1,Diabetes plan,,\nc2,2021-01-01,,p1,e2,2,Exercise plan,,\n"
+PLAN_HEADER = "id,patient,start\n"
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    (tmp_path / "data").mkdir()
+    return tmp_path / "data"
+
+
+def _ingest(tmp_path, data_dir, content, full_refresh=False):
+    """Write careplans.csv and ingest the data directory. Returns the result of the careplans file."""
+    (data_dir / "careplans.csv").write_text(content, encoding="utf-8")
+    return ingest_csv_files(db_path=str(tmp_path / "db" / "test.db"), data_dir=str(data_dir), full_refresh=full_refresh)["careplans"]
+
+
+def _table_rows(tmp_path):
+    conn = sqlite3.connect(tmp_path / "db" / "test.db")
+    try:
+        return conn.execute("SELECT id, start, description FROM careplans ORDER BY id, start").fetchall()
+    finally:
+        conn.close()
+
+
+def test_new_file_is_replaced(tmp_path, data_dir):
+    result = _ingest(tmp_path, data_dir, HEADER + ROWS)
+    assert (result["action"], result["rows"]) == ("replaced", 2)
+
+
+def test_unchanged_file_is_skipped(tmp_path, data_dir):
+    _ingest(tmp_path, data_dir, HEADER + ROWS)
+    result = _ingest(tmp_path, data_dir, HEADER + ROWS)
+    assert (result["action"], result["rows"], result["changed_rows"]) == ("skipped", 2, 0)
+
+
+def test_appended_rows_are_inserted(tmp_path, data_dir):
+    _ingest(tmp_path, data_dir, HEADER + ROWS)
+    result = _ingest(tmp_path, data_dir, HEADER + ROWS + "c3,2022-01-01,,p1,e3,3,Diet plan,,\n")
+    assert (result["action"], result["rows"], result["changed_rows"]) == ("appended", 3, 1)
+    assert [row[0] for row in _table_rows(tmp_path)] == ["c1", "c2", "c3"]
+
+
+def test_modified_rows_are_upserted_by_natural_key(tmp_path, data_dir):
+    _ingest(tmp_path, data_dir, HEADER + ROWS)
+    result = _ingest(tmp_path, data_dir, HEADER + "c1,2020-01-01,,p1,e1,1,Diabetes plan,,\nc2,2021-01-01,,p1,e2,2,Walking plan,,\n")
+    assert (result["action"], result["changed_rows"]) == ("upserted", 1)
+    assert _table_rows(tmp_path) == [("c1", "2020-01-01", "Diabetes plan"), ("c2", "2021-01-01", "Walking plan")]
+
+
+def test_removed_rows_are_deleted(tmp_path, data_dir):
+    _ingest(tmp_path, data_dir, HEADER + ROWS)
+    result = _ingest(tmp_path, data_dir, HEADER + "c1,2020-01-01,,p1,e1,1,Diabetes plan,,\n")
+    assert (result["action"], result["changed_rows"]) == ("upserted", 1)
+    assert [row[0] for row in _table_rows(tmp_path)] == ["c1"]
+
+
+def test_full_refresh_replaces_the_table(tmp_path, data_dir):
+    _ingest(tmp_path, data_dir, HEADER + ROWS)
+    result = _ingest(tmp_path, data_dir, HEADER + ROWS, full_refresh=True)
+    assert result["action"] == "replaced"
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    yield conn
+    conn.close()
+
+
+def _write(path, content):
+    path.write_text(content, encoding="utf-8")
+    return str(path)
+
+
+def _ingested(conn, file_path, table_name, header):
+    """Create the table of the file and return its ingest metadata."""
+    _create_table(conn, table_name, table_schema(table_name, header))
+    with open(file_path, "rb") as file:
+        size = len(file.read())
+    return {"checksum": file_checksum(file_path), "size": size, "row_count": 1}
+
+
+def test_plan_new_file_is_replaced(conn, tmp_path):
+    file_path = _write(tmp_path / "encounters.csv", PLAN_HEADER + "e1,p1,2020\n")
+    plan = _plan_ingest(conn, file_path, None, full_refresh=False)
+    assert (plan["action"], plan["table_name"]) == ("replaced", "encounters")
+
+
+def test_plan_unchanged_file_is_skipped(conn, tmp_path):
+    file_path = _write(tmp_path / "encounters.csv", PLAN_HEADER + "e1,p1,2020\n")
+    previous = _ingested(conn, file_path, "encounters", ["id", "patient", "start"])
+    assert _plan_ingest(conn, file_path, previous, full_refresh=False)["action"] == "skipped"
+
+
+def test_plan_full_refresh_is_replaced(conn, tmp_path):
+    file_path = _write(tmp_path / "encounters.csv", PLAN_HEADER + "e1,p1,2020\n")
+    previous = _ingested(conn, file_path, "encounters", ["id", "patient", "start"])
+    assert _plan_ingest(conn, file_path, previous, full_refresh=True)["action"] == "replaced"
+
+
+def test_plan_grown_file_is_appended(conn, tmp_path):
+    file_path = _write(tmp_path / "encounters.csv", PLAN_HEADER + "e1,p1,2020\n")
+    previous = _ingested(conn, file_path, "encounters", ["id", "patient", "start"])
+    _write(tmp_path / "encounters.csv", PLAN_HEADER + "e1,p1,2020\ne2,p1,2021\n")
+    plan = _plan_ingest(conn, file_path, previous, full_refresh=False)
+    assert (plan["action"], plan["offset"]) == ("appended", previous["size"])
+
+
+def test_plan_modified_file_with_natural_key_is_upserted(conn, tmp_path):
+    file_path = _write(tmp_path / "encounters.csv", PLAN_HEADER + "e1,p1,2020\n")
+    previous = _ingested(conn, file_path, "encounters", ["id", "patient", "start"])
+    _write(tmp_path / "encounters.csv", PLAN_HEADER + "e1,p1,2019\n")
+    assert _plan_ingest(conn, file_path, previous, full_refresh=False)["action"] == "upserted"
+
+
+def test_plan_modified_file_without_natural_key_is_replaced(conn, tmp_path):
+    file_path = _write(tmp_path / "notes.csv", "A,B\n1,2\n")
+    previous = _ingested(conn, file_path, "notes", ["A", "B"])
+    _write(tmp_path / "notes.csv", "A,B\n1,3\n")
+    assert _plan_ingest(conn, file_path, previous, full_refresh=False)["action"] == "replaced"
+
+
+def test_plan_changed_header_is_replaced(conn, tmp_path):
+    file_path = _write(tmp_path / "encounters.csv", PLAN_HEADER + "e1,p1,2020\n")
+    previous = _ingested(conn, file_path, "encounters", ["id", "patient", "start"])
+    _write(tmp_path / "encounters.csv", "id,patient,start,stop\ne1,p1,2020,2021\n")
+    assert _plan_ingest(conn, file_path, previous, full_refresh=False)["action"] == "replaced"
+
+
+def test_sync_rows_counts_duplicate_rows(conn):
+    for table_name in ("encounters", "_stage_encounters"):
+        conn.execute(f'CREATE TABLE "{table_name}" (id TEXT, start TEXT)')
+    conn.executemany("INSERT INTO encounters VALUES (?, ?)", [("e1", "2020"), ("e2", None)])
+    conn.executemany("INSERT INTO _stage_encounters VALUES (?, ?)", [("e1", "2020"), ("e1", "2020"), ("e2", None)])
+    assert _sync_rows(conn, "_stage_encounters", "encounters", ["id", "start"], ["id"]) == 1
+    assert sorted(conn.execute("SELECT * FROM encounters").fetchall(), key=str) == [("e1", "2020"), ("e1", "2020"), ("e2", None)]
+    assert _sync_rows(conn, "_stage_encounters", "encounters", ["id", "start"], ["id"]) == 0
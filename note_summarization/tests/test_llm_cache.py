@@ -0,0 +1,37 @@
+import pytest
+from langchain_core.globals import set_llm_cache
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import AIMessage
+
+from core.llm_cache import create_llm_cache, is_cache_hit
+from core.summarizer import Summarizer
+
+USAGE = {"input_tokens": 100, "output_tokens": 10, "total_tokens": 110}
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def llm_cache(request, tmp_path):
+    cache = create_llm_cache({"type": request.param, "path": str(tmp_path / "llm_cache.db")})
+    set_llm_cache(cache)
+    yield cache
+    set_llm_cache(None)
+    if hasattr(cache, "close"):
+        cache.close()
+
+
+def test_replayed_responses_are_marked(llm_cache):
+    model = FakeListChatModel(responses=["first", "second"])
+    responses = [model.invoke("prompt") for _ in range(3)]
+    assert [response.content for response in responses] == ["first"] * 3
+    assert [is_cache_hit(response) for response in responses] == [False, True, True]
+
+
+def test_token_usage_of_replayed_responses_is_not_recorded():
+    summarizer = Summarizer.__new__(Summarizer)
+    observed = []
+    summarizer._record_token_usage = lambda template_id, system_prompt, user_prompt, summary, usage=None: observed.append(usage)
+    generated = AIMessage(content="{}", usage_metadata=USAGE)
+    replayed = AIMessage(content="{}", usage_metadata=USAGE, response_metadata={"llm_cache_hit": True})
+    for raw in (generated, replayed):
+        summarizer._parse_structured_response({"raw": raw, "parsed": {}, "parsing_error": None}, "system", "user", "medications")
+    assert observed == [USAGE]
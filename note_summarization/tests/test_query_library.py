@@ -0,0 +1,152 @@
+import os
+import re
+import csv
+import sqlite3
+
+import pytest
+
+from core import template_library
+from core.config import ROOT_DIR
+from core.fake_llm import FakeChatModel
+from core.ingest import ingest_csv_files
+from core.ns_utils import _get_retrieval_steps, _retrieve_step_data, get_patient_context
+from core.summarizer import Summarizer
+from core.template_library import patient_templates, populate_template, sql_queries, sql_template_tables, validate_templates
+
+DATA_DIR = ROOT_DIR / "data"
+# Reference tables shared by all patients, copied as is
+SHARED_FILES = ("organizations.csv", "payers.csv", "providers.csv")
+# Column holding the patient id, for the files where it is not "patient"
+PATIENT_COLUMNS = {"patients.csv": "id", "claims.csv": "patientid", "claims_transactions.csv": "patientid"}
+# The bundled data has no observations, labs_sql is checked on these rows
+OBSERVATIONS_HEADER = ["date", "patient", "encounter", "category", "code", "description", "value", "units", "type"]
+
+
+def _fixture_patients() -> list[str]:
+    """Two patients of the bundled data with rows in most of the tables queried by the library."""
+    patient_sets = []
+    for file_name in ("conditions.csv", "medications.csv", "allergies.csv", "imaging_studies.csv", "immunizations.csv", "payer_transitions.csv"):
+        with open(DATA_DIR / file_name, newline="", encoding="utf-8") as file:
+            patient_sets.append({row["patient"] for row in csv.DictReader(file)})
+    return sorted(set.intersection(*patient_sets))[:2]
+
+
+def _write_fixture(data_dir, patient_ids: list[str]) -> None:
+    """Write the rows of the given patients of the bundled CSV files, and lab observations, to data_dir."""
+    os.makedirs(data_dir, exist_ok=True)
+    for file_name in sorted(os.listdir(DATA_DIR)):
+        with open(DATA_DIR / file_name, newline="", encoding="utf-8") as source, open(data_dir / file_name, "w", newline="", encoding="utf-8") as target:
+            reader = csv.reader(source)
+            header = next(reader)
+            writer = csv.writer(target)
+            writer.writerow(header)
+            patient_column = header.index(PATIENT_COLUMNS.get(file_name, "patient")) if file_name not in SHARED_FILES else None
+            writer.writerows(row for row in reader if patient_column is None or row[patient_column] in patient_ids)
+    with open(data_dir / "observations.csv", "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(OBSERVATIONS_HEADER)
+        for index, patient_id in enumerate(patient_ids):
+            writer.writerow(["2020-01-01", patient_id, "", "laboratory", "2339-0", "Glucose", str(90 + index), "mg/dL", "numeric"])
+            writer.writerow(["2020-01-01", patient_id, "", "vital-signs", "8302-2", "Body Height", "170", "cm", "numeric"])
+
+
+@pytest.fixture(scope="module")
+def databases(tmp_path_factory):
+    """Databases ingested from the rows of one patient and of two patients. Returns the patient ids and the database paths."""
+    patient_ids = _fixture_patients()
+    assert len(patient_ids) == 2
+    root = tmp_path_factory.mktemp("query_library")
+    db_paths = {}
+    for name, ids in (("one", patient_ids[:1]), ("both", patient_ids)):
+        _write_fixture(root / name, ids)
+        db_paths[name] = str(root / f"{name}.db")
+        ingest_csv_files(db_path=db_paths[name], data_dir=str(root / name))
+    return patient_ids, db_paths
+
+
+def _run(db_path: str, query: str, patient_id: str) -> list[tuple]:
+    conn = sqlite3.connect(db_path)
+    try:
+        return sorted(conn.execute(query, {"patient_id": patient_id}).fetchall(), key=repr)
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("sql_prompt_id", sorted(sql_queries))
+def test_library_query_is_bound_to_patient_id(sql_prompt_id):
+    assert set(re.findall(r":(\w+)", sql_queries[sql_prompt_id])) == {"patient_id"}
+
+
+@pytest.mark.parametrize("sql_prompt_id", sorted(sql_queries))
+def test_library_query_tables_are_declared(sql_prompt_id):
+    # Steps are skipped when their declared tables are missing, so the declaration must cover every table of the query
+    tables = set(re.findall(r"(?:FROM|JOIN)\s+(\w+)", sql_queries[sql_prompt_id]))
+    assert tables <= set(sql_template_tables[sql_prompt_id])
+
+
+@pytest.mark.parametrize("sql_prompt_id", sorted(sql_queries))
+def test_library_query_returns_only_the_patient_rows(databases, sql_prompt_id):
+    (patient_id, _), db_paths = databases
+    rows = _run(db_paths["both"], sql_queries[sql_prompt_id], patient_id)
+    # The rows of the other patient do not change the result
+    assert rows == _run(db_paths["one"], sql_queries[sql_prompt_id], patient_id)
+
+
+def test_library_queries_return_data(databases):
+    (patient_id, other_patient_id), db_paths = databases
+    empty = [sql_prompt_id for sql_prompt_id, query in sql_queries.items() if not _run(db_paths["both"], query, patient_id)]
+    # Hospitalizations depend on the encounters of the patient, every other query has fixture rows
+    assert set(empty) <= {"hospitalizations_sql"}
+    assert _run(db_paths["both"], sql_queries["labs_sql"], patient_id) != _run(db_paths["both"], sql_queries["labs_sql"], other_patient_id)
+
+
+def test_labs_sql_returns_laboratory_observations(databases):
+    (patient_id, _), db_paths = databases
+    assert _run(db_paths["both"], sql_queries["labs_sql"], patient_id) == [("2020-01-01", "Glucose", "90", "mg/dL", "numeric")]
+
+
+def test_timeline_sql_is_ordered_by_start(databases):
+    (patient_id, _), db_paths = databases
+    conn = sqlite3.connect(db_paths["both"])
+    try:
+        rows = conn.execute(sql_queries["timeline_sql"], {"patient_id": patient_id}).fetchall()
+    finally:
+        conn.close()
+    assert [row[0] for row in rows] == sorted(row[0] for row in rows)
+    assert {"encounter", "condition", "medication"} <= {row[2] for row in rows}
+
+
+def test_retrieval_steps_use_library_queries_only_with_query_library():
+    template_name = next(name for name, template in patient_templates.items() if any(sql_prompt in sql_queries for sql_prompt in template["sql_prompts"]))
+    library_steps = _get_retrieval_steps(populate_template(template_name, "query_library"))
+    assert [step["query"] for step in library_steps] == [sql_queries.get(step["id"]) for step in library_steps]
+    assert all(step["tables"] == sql_template_tables.get(step["id"]) for step in library_steps)
+    assert all(step["query"] is None for step in _get_retrieval_steps(populate_template(template_name, "text_to_sql")))
+
+
+def test_query_library_step_runs_without_llm(databases):
+    (patient_id, _), db_paths = databases
+
+    def no_sql(prompt):
+        raise AssertionError("The query library step generated SQL with the LLM.")
+
+    summarizer = Summarizer(db_path=db_paths["both"], llm=FakeChatModel(sql_responder=no_sql))
+    try:
+        step = next(step for step in _get_retrieval_steps(populate_template("medications", "query_library")) if step["id"] == "medications_sql")
+        patient_details, _, parameters = get_patient_context({"first_name": "", "last_name": ""}, patient_id)
+        data = _retrieve_step_data(summarizer, step, patient_details, parameters, patient_id, "medications")
+    finally:
+        summarizer.dispose()
+    assert data.count("\n") == len(_run(db_paths["both"], sql_queries["medications_sql"], patient_id))
+
+
+def test_validate_templates_rejects_unknown_query(monkeypatch):
+    monkeypatch.setitem(patient_templates, "broken", {**patient_templates["medications"], "sql_prompts": ["medications_sql", "unknown_sql"]})
+    with pytest.raises(ValueError, match="broken: unknown sql_prompt 'unknown_sql'"):
+        validate_templates()
+
+
+def test_validate_templates_rejects_library_query_without_sql_template(monkeypatch):
+    monkeypatch.setitem(template_library.sql_queries, "orphan_sql", "SELECT 1 WHERE :patient_id IS NOT NULL")
+    with pytest.raises(ValueError, match="no sql_template for 'orphan_sql'"):
+        validate_templates()
@@ -0,0 +1,67 @@
+import pytest
+
+from core.result_encoders import RESULT_ENCODERS, CsvEncoder, DictionaryEncoder, PlainEncoder, get_result_encoder
+
+COLUMNS = ["patient", "start", "description"]
+ROWS = [
+    ("1d6f", "2020-01-01", "Chronic pain"),
+    ("1d6f", "2021-01-01", "Chronic pain"),
+    ("1d6f", "2022-01-01", "Hypertension"),
+]
+
+
+def test_plain_encoder():
+    assert PlainEncoder().encode(COLUMNS, [ROWS[:2]]) == ("1d6f, 2020-01-01, Chronic pain\n1d6f, 2021-01-01, Chronic pain", 2)
+
+
+def test_csv_encoder_header_and_batches():
+    text, row_count = CsvEncoder().encode(COLUMNS, [ROWS[:1], ROWS[1:]])
+    assert row_count == 3
+    assert text.split("\n") == ["patient,start,description", "1d6f,2020-01-01,Chronic pain", "1d6f,2021-01-01,Chronic pain", "1d6f,2022-01-01,Hypertension"]
+    assert CsvEncoder().preamble_size(text.split("\n")) == 1
+
+
+def test_dictionary_encoder_constants_and_references():
+    encoder = DictionaryEncoder()
+    text, row_count = encoder.encode(COLUMNS, [ROWS])
+    assert row_count == 3
+    assert text.split("\n") == [
+        "patient = 1d6f",
+        "@1 = Chronic pain",
+        "start,description",
+        "2020-01-01,@1",
+        "2021-01-01,@1",
+        "2022-01-01,Hypertension",
+    ]
+    assert encoder.preamble_size(text.split("\n")) == 3
+
+
+def test_dictionary_encoder_single_row_has_no_constants():
+    text, _ = DictionaryEncoder().encode(COLUMNS, [ROWS[:1]])
+    assert text == "patient,start,description\n1d6f,2020-01-01,Chronic pain"
+
+
+@pytest.mark.parametrize("name", RESULT_ENCODERS)
+def test_encoders_empty_result(name):
+    assert get_result_encoder(name).encode(COLUMNS, [[]]) == ("", 0)
+
+
+@pytest.mark.parametrize("name", RESULT_ENCODERS)
+def test_encoders_keep_every_row_on_one_line(name):
+    encoder = get_result_encoder(name)
+    rows = [("1d6f", "2020-01-01", "first line\nsecond line = x"), ("1d6f", "2021-01-01", "first line\nsecond line = x")]
+    lines = encoder.encode(COLUMNS, [rows])[0].split("\n")
+    assert len(lines) - encoder.preamble_size(lines) == len(rows)
+
+
+def test_dictionary_encoder_header_that_reads_as_definition():
+    encoder = DictionaryEncoder()
+    text, _ = encoder.encode(["a = b", "c"], [[("1", "2"), ("1", "3")]])
+    lines = text.split("\n")
+    assert lines[0] == '"a = b","c"'
+    assert encoder.preamble_size(lines) == 1
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        get_result_encoder("xml")
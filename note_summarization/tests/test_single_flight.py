@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from core.single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_computation():
+    flight = SingleFlight("test")
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        return await asyncio.gather(*[flight.run("key", compute) for _ in range(5)])
+
+    assert asyncio.run(main()) == ["result"] * 5
+    assert len(calls) == 1
+    assert (flight.misses, flight.hits) == (1, 4)
+    assert flight.in_flight() == 0
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight("test")
+
+    async def main():
+        return await asyncio.gather(flight.run("a", lambda: asyncio.sleep(0.01, "a")), flight.run("b", lambda: asyncio.sleep(0.01, "b")))
+
+    assert asyncio.run(main()) == ["a", "b"]
+    assert (flight.misses, flight.hits) == (2, 0)
+
+
+def test_key_is_released_after_completion():
+    flight = SingleFlight("test")
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return len(calls)
+
+    async def main():
+        return [await flight.run("key", compute), await flight.run("key", compute)]
+
+    assert asyncio.run(main()) == [1, 2]
+
+
+def test_exception_is_shared_by_the_callers():
+    flight = SingleFlight("test")
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    async def main():
+        return await asyncio.gather(*[flight.run("key", compute) for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flight.misses == 1
+    assert flight.in_flight() == 0
+
+
+def test_cancelled_caller_does_not_cancel_the_computation():
+    flight = SingleFlight("test")
+
+    async def compute():
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def main():
+        first = asyncio.ensure_future(flight.run("key", compute))
+        second = asyncio.ensure_future(flight.run("key", compute))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == "result"
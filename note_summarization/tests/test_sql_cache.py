@@ -0,0 +1,80 @@
+import pytest
+
+from core.fake_llm import FakeChatModel
+from core.ingest import ingest_csv_files
+from core.ns_utils import get_patient_context
+from core.sql_cache import SQLQueryCache, parameterize_query
+from core.summarizer import Summarizer
+
+
+def test_parameterize_query_binds_patient_values():
+    query = "SELECT * FROM patients WHERE first = 'Lupe126' AND last = 'Rippin620'"
+    parameterized = parameterize_query(query, {"first_name": "Lupe126", "last_name": "Rippin620"})
+    assert parameterized == "SELECT * FROM patients WHERE first = :first_name AND last = :last_name"
+
+
+def test_parameterize_query_escaped_quotes():
+    query = "SELECT * FROM patients WHERE last = 'O''Brien'"
+    assert parameterize_query(query, {"last_name": "O'Brien"}) == "SELECT * FROM patients WHERE last = :last_name"
+
+
+def test_parameterize_query_value_in_like_pattern():
+    query = "SELECT * FROM patients WHERE first = 'Lupe126' OR first LIKE '%lupe126%'"
+    assert parameterize_query(query, {"first_name": "Lupe126"}) is None
+
+
+def test_parameterize_query_value_not_in_query():
+    query = "SELECT * FROM patients WHERE id = 'abc'"
+    assert parameterize_query(query, {"patient_id": "def"}) is None
+
+
+def test_parameterize_query_empty_value():
+    assert parameterize_query("SELECT 1", {"patient_id": ""}) is None
+
+
+def test_parameterize_query_without_parameters():
+    assert parameterize_query("SELECT 1", {}) == "SELECT 1"
+
+
+HEADER = "id,start,stop,patient,encounter,code,description,reasoncode,reasondescription\n"
+ROWS = "c1,2020-01-01,,p1,e1,1,Diabetes plan,,\nc2,2021-01-01,,p2,e2,2,Exercise plan,,\n"
+SQL_TEMPLATE = "List the care plans of the patient {patient_details}."
+
+
+@pytest.fixture
+def summarizer(tmp_path):
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "careplans.csv").write_text(HEADER + ROWS, encoding="utf-8")
+    ingest_csv_files(db_path=str(tmp_path / "test.db"), data_dir=str(tmp_path / "data"))
+    sql_cache = SQLQueryCache(str(tmp_path / "sql_cache.db"))
+    summarizer = Summarizer(db_path=str(tmp_path / "test.db"), sql_cache=sql_cache, llm=FakeChatModel())
+    yield summarizer
+    summarizer.dispose()
+    sql_cache.close()
+
+
+def _lookup(summarizer, patient_id):
+    patient_details, _, parameters = get_patient_context({"first_name": "", "last_name": ""}, patient_id)
+    return summarizer._lookup_patient_sql_query(SQL_TEMPLATE, patient_details, parameters, "careplans_sql"), parameters
+
+
+def test_patient_query_round_trip(summarizer):
+    (_, key, cached_query), parameters = _lookup(summarizer, "p1")
+    assert cached_query is None
+    query, bound_parameters = summarizer._store_patient_sql_query(key, "SELECT id FROM careplans WHERE patient = 'p1'", parameters, "careplans_sql")
+    assert (query, bound_parameters) == ("SELECT id FROM careplans WHERE patient = :patient_id", {"patient_id": "p1"})
+    # The query generated for p1 is reused for p2, bound to the id of p2
+    (_, other_key, cached_query), other_parameters = _lookup(summarizer, "p2")
+    assert (other_key, cached_query) == (key, query)
+    assert summarizer.execute_query(cached_query, other_parameters) == [("c2",)]
+
+
+def test_patient_query_misses_when_schema_changes(summarizer, tmp_path):
+    (_, key, _), parameters = _lookup(summarizer, "p1")
+    summarizer._store_patient_sql_query(key, "SELECT id FROM careplans WHERE patient = 'p1'", parameters, "careplans_sql")
+    (tmp_path / "data" / "allergies.csv").write_text("start,stop,patient,encounter,code,description\n2020-01-01,,p1,e1,1,Pollen\n", encoding="utf-8")
+    ingest_csv_files(db_path=str(tmp_path / "test.db"), data_dir=str(tmp_path / "data"))
+    summarizer.refresh_schema()
+    (_, new_key, cached_query), _ = _lookup(summarizer, "p1")
+    assert new_key != key
+    assert cached_query is None
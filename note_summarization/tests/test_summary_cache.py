@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta, timezone
+
+from core.summary_cache import SummaryCache, fingerprint_summary_inputs
+
+SCHEMA = {"title": "summary", "type": "object", "properties": {"medications": {"type": "array"}}}
+
+
+def test_fingerprint_is_deterministic():
+    assert fingerprint_summary_inputs("system", "user", SCHEMA) == fingerprint_summary_inputs("system", "user", dict(SCHEMA))
+
+
+def test_fingerprint_ignores_schema_key_order():
+    reordered = {"properties": SCHEMA["properties"], "type": "object", "title": "summary"}
+    assert fingerprint_summary_inputs("system", "user", SCHEMA) == fingerprint_summary_inputs("system", "user", reordered)
+
+
+def test_fingerprint_changes_with_every_input():
+    fingerprint = fingerprint_summary_inputs("system", "user", SCHEMA)
+    assert fingerprint_summary_inputs("other system", "user", SCHEMA) != fingerprint
+    assert fingerprint_summary_inputs("system", "other user", SCHEMA) != fingerprint
+    assert fingerprint_summary_inputs("system", "user", {**SCHEMA, "title": "other"}) != fingerprint
+
+
+def test_fingerprint_keeps_prompt_boundaries():
+    # The same text split differently between the prompts is a different input
+    assert fingerprint_summary_inputs("ab", "c", SCHEMA) != fingerprint_summary_inputs("a", "bc", SCHEMA)
+
+
+def _cache_with_entries(tmp_path, created_ats):
+    cache = SummaryCache(str(tmp_path / "summary_cache.db"))
+    for index, created_at in enumerate(created_ats):
+        cache.set("medications", f"p{index}", "gpt-4o", "fingerprint", {"medications": []})
+        cache._conn.execute("UPDATE summary_cache SET created_at = ? WHERE patient_id = ?", (created_at, f"p{index}"))
+    cache._conn.commit()
+    return cache
+
+
+def _patients(cache):
+    return [row[0] for row in cache._conn.execute("SELECT patient_id FROM summary_cache ORDER BY patient_id")]
+
+
+def test_prune_deletes_expired_entries(tmp_path):
+    now = datetime.now(timezone.utc)
+    cache = _cache_with_entries(tmp_path, [(now - timedelta(days=40)).isoformat(), (now - timedelta(days=1)).isoformat()])
+    try:
+        assert cache.prune(ttl_seconds=30 * 86400) == 1
+        assert _patients(cache) == ["p1"]
+        assert cache.get("medications", "p1", "gpt-4o", "fingerprint") == {"medications": []}
+    finally:
+        cache.close()
+
+
+def test_prune_keeps_the_newest_entries(tmp_path):
+    cache = _cache_with_entries(tmp_path, ["2026-01-03T00:00:00+00:00", "2026-01-01T00:00:00+00:00", "2026-01-02T00:00:00+00:00"])
+    try:
+        assert cache.prune(max_entries=2) == 1
+        assert _patients(cache) == ["p0", "p2"]
+        assert cache.prune() == 0
+    finally:
+        cache.close()